@@ -0,0 +1,289 @@
+"""Scale benchmarks of Vestory.
+
+Each operation runs in its own process, with the synthetic
+tree as working directory, and reports its wall time and peak
+RSS. The size of `vestory.json` is measured after each operation.
+
+The results are compared with `benchmarks/baseline.json`, the
+median of five runs of the "small" scenario; scenarios not in the
+baseline are not compared.
+
+The benchmarks should run in the root directory, for example:
+
+    python3 benchmarks/bench_vestory.py --scenario small
+    python3 benchmarks/bench_vestory.py --scenario medium --baseline medium.json
+    python3 benchmarks/bench_vestory.py --scenario small --output results.json --no-baseline
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from shutil import rmtree
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+
+# increases of the wall time below this many seconds
+# are noise of short operations, not regressions
+MIN_TIME_INCREASE = 0.05
+
+sys.path.insert(0, BENCH_DIR)
+
+import generator
+
+SCENARIOS = {
+    'small': {
+        'files': 100,
+        'file_size': 2 * 1024,
+        'binary_ratio': 0.1,
+        'changes': 20,
+        'files_per_change': 5
+    },
+    'medium': {
+        'files': 5000,
+        'file_size': 4 * 1024,
+        'binary_ratio': 0.1,
+        'changes': 500,
+        'files_per_change': 10
+    },
+    'large': {
+        'files': 100000,
+        'file_size': 4 * 1024,
+        'binary_ratio': 0.1,
+        'changes': 10000,
+        'files_per_change': 10
+    }
+}
+
+# operations of a scenario, in order. "history" and
+# "modify" prepare the tree for the next operations.
+OPERATIONS = (
+    'init_repo',
+    'add_files',
+    'submit_change_all',
+    'history',
+    'modify',
+    'get_files_changed',
+    'submit_change',
+    'get_changes',
+    'join_changes'
+)
+
+
+def _run_operation(operation: str, params: dict) -> None:
+    # runs inside the child process, in the tree directory
+    import vestory
+
+    with open(params['files_list']) as file_r:
+        files = json.load(file_r)
+
+    if operation == 'init_repo':
+        vestory.init_repo('Bench', 'bench@mail.com')
+    elif operation == 'add_files':
+        vestory.add_files(files)
+    elif operation == 'submit_change_all':
+        vestory.submit_change(files, 'first change')
+    elif operation == 'history':
+        generator.generate_history(
+            './', files, params['changes'],
+            params['files_per_change'], params['seed']
+        )
+    elif operation == 'modify':
+        generator.modify_files('./', files, params['files_per_change'], params['seed'] - 1)
+    elif operation == 'get_files_changed':
+        vestory.get_files_changed()
+    elif operation == 'submit_change':
+        vestory.submit_change(vestory.get_files_changed(), 'last change')
+    elif operation == 'get_changes':
+        with vestory.open_repository():
+            for change_token in vestory.get_changes().values():
+                vestory.decode_change(change_token)
+    elif operation == 'join_changes':
+        vestory.join_changes()
+
+
+def run_child(operation: str, params: dict) -> None:
+    start = time.perf_counter()
+    _run_operation(operation, params)
+    wall_time = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'wall_time': wall_time, 'peak_rss_kb': peak_rss}))
+
+
+def run_scenario(name: str, params: dict, workdir: str) -> dict:
+    tree_dir = os.path.join(workdir, 'tree')
+    files_list = os.path.join(workdir, 'files.json')
+
+    if os.path.isdir(tree_dir):
+        rmtree(tree_dir)
+
+    print(f'[{name}] generating {params["files"]} files...', file=sys.stderr)
+
+    files = generator.generate_tree(
+        tree_dir, params['files'], params['file_size'],
+        params['binary_ratio'], params['seed']
+    )
+
+    with open(files_list, 'w') as file_w:
+        json.dump(files, file_w)
+
+    child_params = dict(params, files_list=files_list)
+    env = dict(os.environ, PYTHONPATH=ROOT_DIR)
+    results = []
+
+    for operation in OPERATIONS:
+        print(f'[{name}] {operation}...', file=sys.stderr)
+
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__),
+             '--child', operation, '--params', json.dumps(child_params)],
+            cwd=tree_dir, env=env, check=True,
+            stdout=subprocess.PIPE, text=True
+        ).stdout
+
+        result = json.loads(output.strip().splitlines()[-1])
+        result['operation'] = operation
+
+        vestory_file = os.path.join(tree_dir, '.vestory', 'vestory.json')
+        result['vestory_json_size'] = os.path.getsize(vestory_file)
+        results.append(result)
+
+    return {'scenario': name, 'params': params, 'results': results}
+
+
+def compare(results: list, baseline: list, tolerance: float) -> list:
+    """Compares results with a baseline.
+
+    :param results: Benchmark results.
+    :type results: list
+    :param baseline: Baseline results.
+    :type baseline: list
+    :param tolerance: Allowed increase, as a fraction.
+    :type tolerance: float
+    :return: Returns a list of regressions.
+    :rtype: list
+    """
+
+    baseline_results = {}
+
+    for scenario in baseline:
+        for result in scenario['results']:
+            baseline_results[(scenario['scenario'], result['operation'])] = result
+
+    regressions = []
+
+    for scenario in results:
+        for result in scenario['results']:
+            previous = baseline_results.get((scenario['scenario'], result['operation']))
+            if not previous:
+                continue
+
+            for metric in ('wall_time', 'peak_rss_kb', 'vestory_json_size'):
+                if metric == 'wall_time' and result[metric] - previous[metric] < MIN_TIME_INCREASE:
+                    continue
+
+                if result[metric] > previous[metric] * (1 + tolerance):
+                    regressions.append(
+                        (scenario['scenario'], result['operation'],
+                         metric, previous[metric], result[metric])
+                    )
+
+    return regressions
+
+
+def print_results(results: list) -> None:
+    print(f'{"scenario":<16} {"operation":<20} {"time (s)":>10} '
+          f'{"peak RSS (MB)":>14} {"vestory.json (KB)":>18}')
+
+    for scenario in results:
+        for result in scenario['results']:
+            print(f'{scenario["scenario"]:<16} {result["operation"]:<20} '
+                  f'{result["wall_time"]:>10.3f} '
+                  f'{result["peak_rss_kb"] / 1024:>14.1f} '
+                  f'{result["vestory_json_size"] / 1024:>18.1f}')
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Scale benchmarks of Vestory')
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS),
+                        help='predefined scenario (default: small)')
+    parser.add_argument('--files', type=int, help='number of files')
+    parser.add_argument('--file-size', type=int, help='size of each file, in bytes')
+    parser.add_argument('--binary-ratio', type=float, help='fraction of binary files')
+    parser.add_argument('--changes', type=int, help='number of changes in the history')
+    parser.add_argument('--files-per-change', type=int, help='files changed by each change')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--workdir', help='directory for the synthetic trees')
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='compare the results with a JSON baseline (default: benchmarks/baseline.json)')
+    parser.add_argument('--no-baseline', action='store_true', help='do not compare the results')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed increase over the baseline (default: 0.2)')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--params', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, json.loads(args.params))
+        return 0
+
+    custom = {
+        'files': args.files,
+        'file_size': args.file_size,
+        'binary_ratio': args.binary_ratio,
+        'changes': args.changes,
+        'files_per_change': args.files_per_change
+    }
+    custom = {name: value for name, value in custom.items() if value is not None}
+
+    scenarios = []
+
+    for name in args.scenario or ['small']:
+        params = dict(SCENARIOS[name], seed=args.seed, **custom)
+        scenarios.append((name if not custom else f'{name}-custom', params))
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='vestory-bench-')
+    results = []
+
+    try:
+        for name, params in scenarios:
+            results.append(run_scenario(name, params, workdir))
+    finally:
+        if not args.workdir:
+            rmtree(workdir)
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as file_w:
+            json.dump(results, file_w, indent=4)
+
+    if not args.no_baseline:
+        with open(args.baseline) as file_r:
+            baseline = json.load(file_r)
+
+        regressions = compare(results, baseline, args.tolerance)
+
+        for scenario, operation, metric, previous, current in regressions:
+            print(f'\033[31mREGRESSION\033[m {scenario}/{operation}: '
+                  f'{metric} {previous:.3f} -> {current:.3f}')
+
+        if regressions:
+            return 1
+
+        print('\033[32mno regressions\033[m')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,145 @@
+import os
+import random
+
+WORDS = (
+    'version', 'history', 'change', 'file', 'submit', 'join', 'track',
+    'commit', 'token', 'author', 'status', 'ignore', 'delta', 'line'
+)
+
+# maximum number of files in each directory
+FILES_PER_DIR = 100
+
+
+def _text_content(rand: random.Random, size: int) -> bytes:
+    lines = []
+    length = 0
+
+    while length < size:
+        line = ' '.join(rand.choice(WORDS) for __ in range(rand.randint(1, 12)))
+        lines.append(line + '\n')
+        length += len(line) + 1
+
+    return ''.join(lines).encode()
+
+
+def _binary_content(rand: random.Random, size: int) -> bytes:
+    # a NUL byte at the start makes the content invalid UTF-8
+    return b'\x00\xff' + rand.randbytes(max(size - 2, 0))
+
+
+def generate_tree(
+    root: str,
+    files: int,
+    file_size: int,
+    binary_ratio: float = 0.0,
+    seed: int = 0
+) -> list:
+    """Creates a synthetic working tree.
+
+    :param root: Directory of the tree.
+    :type root: str
+    :param files: Number of files.
+    :type files: int
+    :param file_size: Approximate size of each file, in bytes.
+    :type file_size: int
+    :param binary_ratio: Fraction of binary files, defaults to 0.0
+    :type binary_ratio: float, optional
+    :param seed: Random seed, defaults to 0
+    :type seed: int, optional
+    :return: Returns the created files, relative to the root.
+    :rtype: list
+    """
+
+    rand = random.Random(seed)
+    created_files = []
+
+    for i in range(files):
+        dirname = os.path.join(root, f'dir-{i // FILES_PER_DIR}')
+        os.makedirs(dirname, exist_ok=True)
+
+        if rand.random() < binary_ratio:
+            filename = f'file-{i}.bin'
+            content = _binary_content(rand, file_size)
+        else:
+            filename = f'file-{i}.txt'
+            content = _text_content(rand, file_size)
+
+        with open(os.path.join(dirname, filename), 'wb') as file_w:
+            file_w.write(content)
+
+        created_files.append(os.path.join('./', os.path.relpath(dirname, root), filename))
+
+    return created_files
+
+
+def modify_files(root: str, files: list, count: int, seed: int = 0) -> list:
+    """Changes some files of a tree: text files get lines
+    inserted and removed, binary files get new bytes.
+
+    :param root: Directory of the tree.
+    :type root: str
+    :param files: Files of the tree.
+    :type files: list
+    :param count: Number of files to change.
+    :type count: int
+    :param seed: Random seed, defaults to 0
+    :type seed: int, optional
+    :return: Returns the changed files.
+    :rtype: list
+    """
+
+    rand = random.Random(seed)
+    changed_files = rand.sample(files, min(count, len(files)))
+
+    for filepath in changed_files:
+        filepath = os.path.join(root, filepath)
+
+        if filepath.endswith('.bin'):
+            with open(filepath, 'ab') as file_a:
+                file_a.write(rand.randbytes(64))
+            continue
+
+        with open(filepath, 'rb') as file_r:
+            lines = file_r.read().splitlines(True)
+
+        position = rand.randint(0, len(lines))
+        lines.insert(position, _text_content(rand, 40))
+
+        if len(lines) > 2:
+            del lines[rand.randrange(len(lines))]
+
+        with open(filepath, 'wb') as file_w:
+            file_w.write(b''.join(lines))
+
+    return changed_files
+
+
+def generate_history(
+    root: str,
+    files: list,
+    changes: int,
+    files_per_change: int,
+    seed: int = 0
+) -> None:
+    """Submits changes to the repository of a tree.
+    Must run with the tree as working directory.
+
+    :param root: Directory of the tree.
+    :type root: str
+    :param files: Files of the tree.
+    :type files: list
+    :param changes: Number of changes to submit.
+    :type changes: int
+    :param files_per_change: Files changed by each change.
+    :type files_per_change: int
+    :param seed: Random seed, defaults to 0
+    :type seed: int, optional
+    """
+
+    # the repository paths come from the working
+    # directory at import time
+    import vestory
+
+    for i in range(changes):
+        changed_files = modify_files(root, files, files_per_change, seed + i)
+        vestory.submit_change(changed_files, f'synthetic change {i}')
@@ -0,0 +1,171 @@
+"""Startup budget of the Vestory CLI.
+
+Measures the import time of `vestory.__main__` with
+`python -X importtime` and the wall time of `vestory status`
+in a repository without changes. Fails if a measure is over
+its budget or if a module that must be imported lazily is
+loaded on startup.
+
+The benchmark should run in the root directory, for example:
+
+    python3 benchmarks/startup.py
+    python3 benchmarks/startup.py --import-budget 30 --runs 20
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from shutil import rmtree
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+
+# modules used only by some commands, they
+# must not be imported to parse the arguments
+LAZY_MODULES = (
+    'base64',
+    'concurrent.futures',
+    'datetime',
+    'hashlib',
+    'json',
+    'lzma',
+    'mmap',
+    'random',
+    'sqlite3',
+    'threading',
+    'typing',
+    'utoken',
+    'zlib'
+)
+
+_IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|\s*(\S+)$')
+
+
+def _get_env(pycache_dir: str, home_dir: str) -> dict:
+    env = dict(os.environ, PYTHONPATH=ROOT_DIR, PYTHONPYCACHEPREFIX=pycache_dir, HOME=home_dir)
+
+    # startup is measured with the bytecode
+    # already compiled, as in an installed package
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    return env
+
+
+def measure_import(env: dict) -> int:
+    """Returns the cumulative import time of
+    `vestory.__main__`, in microseconds.
+
+    :param env: Environment of the child process.
+    :type env: dict
+    :return: Returns the import time, in microseconds.
+    :rtype: int
+    """
+
+    output = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import vestory.__main__'],
+        env=env, check=True, stderr=subprocess.PIPE, text=True
+    ).stderr
+
+    for line in output.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+
+        if match and match.group(3) == 'vestory.__main__':
+            return int(match.group(2))
+
+    raise RuntimeError('vestory.__main__ not found in the importtime output')
+
+
+def get_startup_modules(env: dict) -> list:
+    code = 'import sys, vestory.__main__; print("\\n".join(sys.modules))'
+    output = subprocess.run(
+        [sys.executable, '-c', code],
+        env=env, check=True, stdout=subprocess.PIPE, text=True
+    ).stdout
+
+    modules = output.splitlines()
+    return [name for name in LAZY_MODULES if name in modules]
+
+
+def measure_status(env: dict, repo_dir: str) -> float:
+    code = 'import sys; sys.argv = ["vestory", "status"]; from vestory.__main__ import main; main()'
+
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, '-c', code],
+        env=env, cwd=repo_dir, check=True, stdout=subprocess.DEVNULL
+    )
+
+    return time.perf_counter() - start
+
+
+def create_repo(env: dict, repo_dir: str, files: int) -> None:
+    os.makedirs(repo_dir)
+
+    for i in range(files):
+        with open(os.path.join(repo_dir, f'file_{i}.txt'), 'w') as file_w:
+            file_w.write(f'file {i}\n' * 20)
+
+    code = ('import vestory; vestory.init_repo("Bench", "bench@mail.com"); '
+            'files = vestory.get_all_files(); vestory.add_files(files); '
+            'vestory.submit_change(files, "first change")')
+
+    subprocess.run([sys.executable, '-c', code], env=env, cwd=repo_dir, check=True)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Startup budget of the Vestory CLI')
+    parser.add_argument('--runs', type=int, default=10, help='runs of each measure (default: 10)')
+    parser.add_argument('--files', type=int, default=100,
+                        help='files of the repository used by "status" (default: 100)')
+    parser.add_argument('--import-budget', type=float, default=40.0,
+                        help='budget of the import time, in ms (default: 40)')
+    parser.add_argument('--status-budget', type=float, default=100.0,
+                        help='budget of "vestory status", in ms (default: 100)')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='vestory-startup-')
+    env = _get_env(os.path.join(workdir, 'pycache'), workdir)
+
+    try:
+        # first run compiles the bytecode
+        measure_import(env)
+        import_time = min(measure_import(env) for __ in range(args.runs)) / 1000
+        startup_modules = get_startup_modules(env)
+
+        repo_dir = os.path.join(workdir, 'repo')
+        create_repo(env, repo_dir, args.files)
+        measure_status(env, repo_dir)
+        status_time = min(measure_status(env, repo_dir) for __ in range(args.runs)) * 1000
+    finally:
+        rmtree(workdir)
+
+    print(f'{"measure":<24} {"best (ms)":>10} {"budget (ms)":>12}')
+    print(f'{"import vestory.__main__":<24} {import_time:>10.2f} {args.import_budget:>12.2f}')
+    print(f'{"vestory status":<24} {status_time:>10.2f} {args.status_budget:>12.2f}')
+
+    failed = False
+
+    if import_time > args.import_budget:
+        print(f'\033[31mOVER BUDGET\033[m import time: {import_time:.2f} ms')
+        failed = True
+
+    if status_time > args.status_budget:
+        print(f'\033[31mOVER BUDGET\033[m vestory status: {status_time:.2f} ms')
+        failed = True
+
+    if startup_modules:
+        print(f'\033[31mEAGER IMPORT\033[m {", ".join(startup_modules)}')
+        failed = True
+
+    if failed:
+        return 1
+
+    print('\033[32mwithin budget\033[m')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
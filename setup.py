@@ -1,12 +1,12 @@
 from setuptools import setup
 from setuptools.command.install import install
-from vestory import vestory_config
 
 
 class Prepare(install):
     def run(self):
         install.run(self)
         # create config file in home diretory
+        from vestory import vestory_config
         vestory_config.create_config()
 
 
@@ -1,6 +1,7 @@
 import json
 import os
 import sys
+import time
 
 sys.path.insert(0, './')
 
@@ -50,6 +51,17 @@ class TestVestory(SeqTest):
         self.is_true(os.path.isdir('./.vestory'), 'Repo is not created')
         self.is_true(os.path.isfile('./.vestory/vestory.json'), 'Vestory file not found')
 
+    def test_lazy_paths(self):
+        # repository paths follow the current directory
+        repo_path = os.path.join(os.getcwd(), '.vestory')
+        self.is_true(vestory.version_control.REPO_PATH == repo_path, msg_error='Wrong repository path')
+
+        self.is_true(vestory.check_repo_exists(), msg_error='Repository not found')
+
+        os.chdir('tests')
+        self.is_false(vestory.check_repo_exists(), msg_error='Repository path resolved on import')
+        os.chdir('..')
+
     def test_get_repo_key(self):
         key = vestory.get_repo_key()
         self.is_true(len(key) == 32, msg_error='Invalid repo key')
@@ -67,11 +79,42 @@ class TestVestory(SeqTest):
         tracked_files = len(vestory_config['tracking_files'])
         self.check_any_value(tracked_files, len(self.files), 'File not added')
 
+    def test_ignore_matcher(self):
+        matcher = vestory.IgnoreMatcher(['./tests/test_files/iamignored', '*.log', '!keep.log', 'build/'])
+
+        self.is_true(matcher.is_ignored('./tests/test_files/iamignored'), 'File not ignored')
+        self.is_true(matcher.is_ignored('./logs/app.log'), 'Glob not ignored')
+        self.is_false(matcher.is_ignored('./keep.log'), 'Negation not applied')
+        self.is_true(matcher.is_ignored('./build/app/main.o'), 'Directory not ignored')
+        self.is_false(matcher.is_ignored('./build'), 'Directory rule applied to file')
+
+        # rules are relative to the walked directory
+        matcher = vestory.IgnoreMatcher(['iamignored', '.*'])
+        walked_files = list(vestory.walk_files('./tests/test_files', matcher))
+        self.is_true(sorted(walked_files) == sorted(self.files), 'Incorrect walked files')
+
+        # links to directories are not files, and are not followed
+        os.symlink('.', './tests/test_files/linked-dir')
+        walked_files = list(vestory.walk_files('./tests/test_files', matcher))
+        os.remove('./tests/test_files/linked-dir')
+        self.is_true(sorted(walked_files) == sorted(self.files), 'Link to a directory walked')
+
     def test_submit(self):
         self.change_id = vestory.submit_change(self.files, 'first submit')
         change_info = vestory.get_change_info_by_id(self.change_id)
         self.is_true(isinstance(change_info, dict), msg_error='Change info not found')
 
+    def test_object_store(self):
+        change_info = vestory.get_change_info_by_id(self.change_id)
+        objects = {info['object'] for info in change_info['changed_files'].values()}
+
+        # all files have the same content
+        self.is_true(len(objects) == 1, msg_error='Duplicated content stored')
+
+        object_id = objects.pop()
+        object_path = os.path.join('./.vestory/objects', object_id[:2], object_id[2:])
+        self.is_true(os.path.isfile(object_path), msg_error='Object not found')
+
     def test_change_file(self):
         for file in self.files:
             with open(file, 'a') as file_u:
@@ -85,6 +128,50 @@ class TestVestory(SeqTest):
         diff = vestory.check_diff(joined_changes, change)
         self.is_true(change == diff, msg_error='Incorrect difference')
 
+    def test_diff_lines(self):
+        old_lines = ['a\n', 'b\n', 'c\n', 'd\n']
+        new_lines = ['new\n', 'a\n', 'b\n', 'd\n']
+
+        hunks = vestory.diff_lines(old_lines, new_lines)
+        self.is_true(hunks == [[0, 0, ['new\n']], [2, 3, []]], msg_error='Incorrect hunks')
+
+        lines = vestory.apply_hunks(old_lines, hunks)
+        self.is_true(lines == new_lines, msg_error='Incorrect hunks apply')
+
+        # a large file with many repeated lines and
+        # scattered edits
+        old_lines = ['\n', '}\n', '    return None\n', 'def function():\n'] * 1000
+        new_lines = list(old_lines)
+
+        for i in range(0, len(new_lines), 40):
+            new_lines[i] = f'edit {i}\n'
+
+        start = time.perf_counter()
+        hunks = vestory.diff_lines(old_lines, new_lines)
+        elapsed = time.perf_counter() - start
+
+        self.is_true(elapsed < 2, msg_error=f'Slow diff of repeated lines ({elapsed:.1f} s)')
+        self.is_true(len(hunks) == 100, msg_error='Edits not found')
+        self.is_true(vestory.apply_hunks(old_lines, hunks) == new_lines, msg_error='Incorrect hunks apply')
+
+    def test_delta_encoding(self):
+        hunks = [[0, 0, ['new\n', 'ção\r\n']], [2, 3, []], [300, 301, ['x' * 200]]]
+
+        for compression in ('zlib', 'lzma', 'none'):
+            delta = vestory.encode_delta(hunks, compression, 9)
+            self.is_true(vestory.decode_delta(delta) == {'hunks': hunks}, msg_error='Incorrect delta decoding')
+
+        # contents stored before the encoding
+        legacy_delta = b'{"hunks": [[0, 1, ["a\\n"]]]}'
+        self.is_true(vestory.decode_delta(legacy_delta) == {'hunks': [[0, 1, ['a\n']]]}, 'Legacy delta not decoded')
+
+        try:
+            vestory.decode_delta(vestory.encode_delta(hunks)[:-4])
+        except ValueError:
+            self.is_true(True)
+        else:
+            self.is_true(False, msg_error='Truncated delta decoded')
+
     def test_check_file_has_changed(self):
         for file in self.files:
             self.is_true(vestory.check_file_has_changed(file), 'Change not detected')
@@ -93,18 +180,68 @@ class TestVestory(SeqTest):
         changed_files = vestory.get_files_changed()
         self.is_true(len(changed_files) == 10, 'Error getting files changed')
 
+    def test_watcher(self):
+        inotify = vestory.watch.Inotify()
+        watcher = vestory.watch.Watcher(os.path.abspath('./.vestory'), inotify)
+
+        # every tracked file starts dirty
+        candidates = watcher.get_candidates()
+        self.is_true(sorted(candidates) == sorted(self.files), msg_error='Tracked files not dirty')
+
+        watcher.prune(candidates)
+        self.is_true(watcher.get_candidates() == {}, msg_error='Candidates not pruned')
+
+        with open(self.files[0], 'a') as file_w:
+            file_w.write('')
+
+        candidates = watcher.get_candidates()
+        self.is_true(list(candidates) == [self.files[0]], msg_error='Change not watched')
+
+        # a file touched during the check stays dirty
+        with open(self.files[0], 'a') as file_w:
+            file_w.write('')
+
+        watcher.prune(candidates)
+        self.is_true(list(watcher.get_candidates()) == [self.files[0]], msg_error='Event lost')
+        inotify.close()
+
+    def test_trace(self):
+        vestory.trace.tracer.enable()
+        vestory.get_files_changed()
+        vestory.trace.tracer.enabled = False
+
+        summary = vestory.trace.tracer.summary()
+        self.is_true('config.load' in summary, msg_error='Config load not traced')
+        self.is_true(vestory.trace.tracer.counters['bytes.read'] > 0, msg_error='Bytes read not counted')
+
     def test_submit_change(self):
-        change_id = vestory.submit_change(self.files, 'add more lines')
+        # the files are prepared by a pool of processes
+        change_id = vestory.submit_change(self.files, 'add more lines', jobs=4)
         change_info = vestory.get_change_info_by_id(change_id)
         changed_files = list(change_info['changed_files'].keys())
 
         self.is_true(isinstance(change_info, dict), msg_error='Change not found')        
-        self.is_true(len(changed_files) == len(self.files), msg_error='Some files were not found')
+        self.is_true(changed_files == self.files, msg_error='Some files were not found')
+
+        # equal files have equal changes, as in a serial submit
+        stored = {(info['object'], info['snapshot']) for info in change_info['changed_files'].values()}
+        self.is_true(len(stored) == 1, msg_error='Parallel submit not deterministic')
 
     def test_check_file_has_changed_2(self):
         for file in self.files:
             self.is_false(vestory.check_file_has_changed(file), 'Change detected')
 
+    def test_index(self):
+        with open('./.vestory/index') as file_r:
+            index = json.load(file_r)
+
+        tracked_files = vestory.get_files_tracked()
+
+        for file in self.files:
+            size, mtime_ns, inode, file_hash = index[file]
+            self.is_true(size == os.stat(file).st_size, msg_error='Incorrect index size')
+            self.is_true(file_hash == tracked_files[file], msg_error='Incorrect index hash')
+
     def test_count_changes(self):
         changes = vestory.get_changes()
         len_changes = len(changes.keys())
@@ -128,10 +265,397 @@ class TestVestory(SeqTest):
             msg_error='Incorrect change join'
         )
 
+    def test_head_cache(self):
+        heads = vestory.repository.Repository('./.vestory').heads
+        last_hash = vestory.get_file_changes(self.files[0])[-1][1]['hash']
+
+        content = heads.get(self.files[0], last_hash)
+        self.is_true(content == b'Welcome to my file!\nMore lines here!', msg_error='Head not stored')
+
+        # a head not matching the last change is not used
+        heads.put(self.files[0], b'tampered')
+        self.is_none(heads.get(self.files[0], last_hash), msg_error='Tampered head used')
+
+        # the changes are replayed and the head stored again
+        rewritten = [file for file, rewritten in vestory.join_files([self.files[0]]) if rewritten]
+        self.is_true(rewritten == [], msg_error='Incorrect join with tampered head')
+        self.is_true(heads.get(self.files[0], last_hash) == content, msg_error='Head not stored again')
+
+    def test_join_files(self):
+        rewritten = [file for file, rewritten in vestory.join_files() if rewritten]
+        self.is_true(rewritten == [], msg_error='Unchanged files rewritten')
+
+        with open(self.files[0], 'w') as file_w:
+            file_w.write('Not committed')
+
+        rewritten = [file for file, rewritten in vestory.join_files([self.files[0]]) if rewritten]
+        self.is_true(rewritten == [self.files[0]], msg_error='Incorrect files rewritten')
+
+        with open(self.files[0]) as file_r:
+            content = file_r.read()
+
+        self.is_true(content == 'Welcome to my file!\nMore lines here!', msg_error='Incorrect file join')
+
+        def failing_chunks():
+            yield b'partial'
+            raise ValueError('interrupted')
+
+        try:
+            vestory.version_control._write_file_atomic(self.files[0], failing_chunks())
+        except ValueError:
+            self.is_true(True)
+        else:
+            self.is_true(False, msg_error='Write error not raised')
+
+        with open(self.files[0]) as file_r:
+            self.is_true(file_r.read() == content, msg_error='File changed by failed write')
+
+        temp_files = [name for name in os.listdir(os.path.dirname(self.files[0])) if name.endswith('.tmp')]
+        self.is_true(temp_files == [], msg_error='Temporary file not removed')
+
+    def test_file_delta_chain(self):
+        delta_chain = vestory.get_file_delta_chain(self.files[0])
+        snapshots = [file_info['snapshot'] for __, file_info in delta_chain]
+        self.is_true(snapshots == [True, False], msg_error='Incorrect delta chain')
+
     def test_get_changes_by_author(self):
         author_changes = vestory.get_changes_by_author('test@mail.com')
         self.is_true(len(author_changes) == 2, msg_error='Author changes incorrect')
 
+    def test_get_log(self):
+        entries = list(vestory.get_log())
+        change_ids = list(vestory.get_changes())
+
+        # last changes first
+        self.is_true([entry['id'] for entry in entries] == change_ids[::-1], msg_error='Log order incorrect')
+
+        last_entry = list(vestory.get_log(limit=1))
+        self.is_true(last_entry == entries[:1], msg_error='Log limit incorrect')
+
+        self.is_true(list(vestory.get_log(author='nobody')) == [], msg_error='Log author filter incorrect')
+        self.is_true(list(vestory.get_log(since='9999')) == [], msg_error='Log date filter incorrect')
+
+        path_entries = list(vestory.get_log(paths=['tests/test_files']))
+        self.is_true(len(path_entries) == len(entries), msg_error='Log path filter incorrect')
+
+    def test_history_chain(self):
+        tokens = list(vestory.get_changes().values())
+        last_change = vestory.integrity.decode_without_key(tokens[-1])
+
+        self.is_true(last_change['parent'] == vestory.integrity.link_digest(tokens[-2]), msg_error='Change not linked')
+        self.is_true(vestory.verify_history() == 0, msg_error='Verified changes before the checkpoint')
+
+        with open('./.vestory/vestory.json') as file_r:
+            vestory_file = json.load(file_r)
+
+        # history without its last change
+        truncated_file = json.loads(json.dumps(vestory_file))
+        truncated_file['changes'].popitem()
+
+        with open('./.vestory/vestory.json', 'w') as file_w:
+            json.dump(truncated_file, file_w)
+
+        try:
+            vestory.verify_history()
+        except vestory.InvalidChangeError:
+            self.is_true(True)
+        else:
+            self.is_true(False, msg_error='Truncated history not detected')
+
+        with open('./.vestory/vestory.json', 'w') as file_w:
+            json.dump(vestory_file, file_w, ensure_ascii=False, indent=4)
+
+    def test_file_index(self):
+        with open('./.vestory/vestory.json') as file_r:
+            file_changes = json.load(file_r)['file_changes']
+
+        self.is_true(len(file_changes[self.files[0]]) == 2, msg_error='Incorrect file index')
+
+        vestory.rebuild_file_index()
+
+        with open('./.vestory/vestory.json') as file_r:
+            rebuilt_file_changes = json.load(file_r)['file_changes']
+
+        self.is_true(file_changes == rebuilt_file_changes, msg_error='Incorrect file index rebuild')
+
+    def test_change_cache(self):
+        # one file per change, in a directory of the key
+        key_dirs = os.listdir('./.vestory/cache/changes')
+        cached_changes = os.listdir(os.path.join('./.vestory/cache/changes', key_dirs[0]))
+        self.is_true(len(key_dirs) == 1 and len(cached_changes) == 2, msg_error='Changes not cached')
+
+        # cached changes are not changed through the results
+        change_info = vestory.get_change_info_by_id(self.change_id)
+        change_info['comment'] = 'changed'
+        change_info['changed_files'].clear()
+
+        change_info = vestory.get_change_info_by_id(self.change_id)
+        self.is_true(change_info['comment'] == 'first submit', msg_error='Cached change modified')
+        self.is_true(len(change_info['changed_files']) > 0, msg_error='Cached files modified')
+
+    def test_fsck(self):
+        self.is_true(vestory.fsck(jobs=2) == [], msg_error='Problems found in a valid history')
+
+        change_info = vestory.get_change_info_by_id(self.change_id)
+        object_id = change_info['changed_files'][self.files[0]]['object']
+        object_path = f'./.vestory/objects/{object_id[:2]}/{object_id[2:]}'
+
+        with open(object_path, 'rb') as file_r:
+            object_data = file_r.read()
+
+        with open(object_path, 'wb') as file_w:
+            file_w.write(b'r{"0": "tampered"}')
+
+        problems = vestory.fsck(jobs=1)
+        self.is_true(problems and problems[0][0] == self.change_id, msg_error='Tampered content not found')
+        self.is_true(vestory.fsck(full=False, jobs=1) == [], msg_error='Content verified in quick mode')
+
+        with open(object_path, 'wb') as file_w:
+            file_w.write(object_data)
+
+    def test_large_file(self):
+        large_file = './tests/test_files/large'
+        content = ''.join(f'line {i}\n' for i in range(20000)).encode()
+
+        with open(large_file, 'wb') as file_w:
+            file_w.write(content)
+
+        vestory.set_repo_setting('large_file_threshold', 64 * 1024)
+        vestory.add_files([large_file])
+        change_id = vestory.submit_change([large_file], 'large file')
+        vestory.set_repo_setting('large_file_threshold', 64 * 1024 * 1024)
+
+        # stored whole, without a delta of its lines
+        file_info = vestory.get_change_info_by_id(change_id)['changed_files'][large_file]
+        self.is_true(file_info['binary'] and file_info['size'] == len(content), msg_error='Large file not streamed')
+        self.is_true(file_info['hash'] == vestory.hashing.hash_bytes(content), msg_error='Incorrect large file hash')
+
+        os.remove(large_file)
+        rewritten = [file for file, rewritten in vestory.join_files([large_file]) if rewritten]
+        self.is_true(rewritten == [large_file], msg_error='Large file not joined')
+
+        with open(large_file, 'rb') as file_r:
+            self.is_true(file_r.read() == content, msg_error='Incorrect large file join')
+
+        self.is_true(vestory.fsck(jobs=1) == [], msg_error='Large file not verified')
+
+    def test_migrate(self):
+        with open(self.files[0], 'rb') as file_r:
+            file_hash = vestory.hashing.hash_bytes(file_r.read())
+
+        self.is_true(vestory.hashing.hash_file(self.files[0]) == file_hash, msg_error='Incorrect file hash')
+
+        changed_files = vestory.get_files_changed()
+
+        # downgrades the repository to the format 1
+        with open('./.vestory/vestory.json') as file_r:
+            vestory_file = json.load(file_r)
+
+        vestory_file.pop('format_version')
+
+        for file in vestory_file['tracking_files']:
+            vestory_file['tracking_files'][file] = vestory.hashing.legacy_hash_file(file).raw_hash
+
+        with open('./.vestory/vestory.json', 'w') as file_w:
+            json.dump(vestory_file, file_w, ensure_ascii=False)
+
+        try:
+            vestory.get_files_changed()
+        except vestory.RepoFormatError:
+            self.is_true(True)
+        else:
+            self.is_true(False, msg_error='Outdated format not detected')
+
+        self.is_true(vestory.migrate(), msg_error='Repository not migrated')
+        self.is_false(vestory.migrate(), msg_error='Repository migrated twice')
+        self.is_true(vestory.get_files_changed() == changed_files, msg_error='Incorrect hashes after migrate')
+        self.is_true(vestory.fsck(jobs=1) == [], msg_error='History invalid after migrate')
+
+    def test_lock(self):
+        # another process holding the repository
+        other_lock = vestory.lock.RepoLock('./.vestory/lock')
+        other_lock.acquire(exclusive=True)
+
+        try:
+            with vestory.open_repository(exclusive=False, timeout=0.1):
+                pass
+        except vestory.LockTimeoutError:
+            self.is_true(True)
+        else:
+            self.is_true(False, msg_error='Locked repository opened')
+        finally:
+            other_lock.release()
+
+        # readers share the repository
+        other_lock.acquire(exclusive=False)
+
+        with vestory.open_repository(exclusive=False, timeout=0.1) as repo:
+            self.is_true(repo.lock.shared, msg_error='Shared lock not taken')
+
+        try:
+            with vestory.open_repository(timeout=0.1):
+                vestory.set_repo_setting('snapshot_interval', 5)
+        except vestory.LockTimeoutError:
+            self.is_true(True)
+        else:
+            self.is_true(False, msg_error='Repository changed during a read')
+        finally:
+            other_lock.release()
+
+        with vestory.open_repository(exclusive=False):
+            try:
+                vestory.set_repo_setting('snapshot_interval', 5)
+            except RuntimeError:
+                self.is_true(True)
+            else:
+                self.is_true(False, msg_error='Shared lock used to change the repository')
+
+        self.is_true(vestory.get_repo_setting('snapshot_interval') == 10, msg_error='Setting changed')
+        self.is_false(any(file.endswith('.tmp') for file in os.listdir('./.vestory')),
+                      msg_error='Temporary files left')
+
+    def test_storage(self):
+        changes = list(vestory.get_changes().items())
+        file_changes = vestory.get_file_changes(self.files[0])
+        author_changes = vestory.get_changes_by_author('test@mail.com')
+
+        self.is_true(vestory.convert_storage('sqlite'), msg_error='Repository not converted')
+        self.is_false(vestory.convert_storage('sqlite'), msg_error='Repository converted twice')
+        self.is_false(os.path.isfile('./.vestory/vestory.json'), msg_error='JSON storage not removed')
+
+        self.is_true(list(vestory.get_changes().items()) == changes, msg_error='Incorrect changes')
+        self.is_true(vestory.get_file_changes(self.files[0]) == file_changes, msg_error='Incorrect file changes')
+        self.is_true(vestory.get_changes_by_author('test@mail.com') == author_changes,
+                     msg_error='Incorrect changes of the author')
+        self.is_true(vestory.get_change_info_by_id(self.change_id)['comment'] == 'first submit',
+                     msg_error='Change not found')
+
+        tracked_files = dict(vestory.get_files_tracked())
+        new_file = './tests/test_files/sqlite-file'
+
+        with open(new_file, 'w') as file_w:
+            file_w.write('tracked in SQLite')
+
+        vestory.add_files([new_file])
+        tracked_after_add = vestory.get_files_tracked()
+        self.is_true(set(tracked_after_add) == set(tracked_files) | {new_file}, msg_error='File not added')
+
+        with vestory.open_repository() as repo:
+            repo.set_tracked_files(tracked_files)
+
+        os.remove(new_file)
+        self.is_true(vestory.get_files_tracked() == tracked_files, msg_error='Tracked files not updated')
+
+        vestory.set_repo_setting('snapshot_interval', 10)
+        self.is_true(vestory.get_repo_setting('snapshot_interval') == 10, msg_error='Setting not saved')
+
+        for name, value in (('snapshot_interval', 'ten'), ('snapshot_interval', 0),
+                            ('snapshot_interval', True), ('change_cache', 1),
+                            ('delta_compression', 'gzip'), ('delta_compression_level', 42),
+                            ('delta_compression_level', -1), ('large_file_threshold', 0),
+                            ('large_file_threshold', -1), ('large_file_threshold', 1.5)):
+            try:
+                vestory.set_repo_setting(name, value)
+            except ValueError:
+                self.is_true(True)
+            else:
+                self.is_true(False, msg_error=f'Invalid value of "{name}" saved')
+
+        self.is_true(vestory.get_repo_setting('snapshot_interval') == 10, msg_error='Invalid setting saved')
+        self.is_true(vestory.get_repo_setting('change_cache') is True, msg_error='Invalid setting saved')
+        self.is_true(vestory.get_repo_setting('delta_compression') == 'zlib', msg_error='Invalid setting saved')
+        self.is_true(vestory.get_repo_setting('large_file_threshold') == 64 * 1024 * 1024,
+                     msg_error='Invalid setting saved')
+        self.is_true(vestory.fsck(jobs=1) == [], msg_error='History invalid in SQLite storage')
+
+        self.is_true(vestory.convert_storage('json'), msg_error='Repository not converted back')
+        self.is_false(os.path.isfile('./.vestory/vestory.db'), msg_error='SQLite storage not removed')
+        self.is_true(list(vestory.get_changes().items()) == changes, msg_error='Changes lost in conversion')
+
+    def test_gc(self):
+        # change made before the object store, with
+        # the content inside the token
+        legacy_info = {
+            'author': 'Jaedson',
+            'author_email': 'test@mail.com',
+            'date': '2022-01-01 00:00:00',
+            'comment': 'legacy change',
+            'changed_files': {
+                './tests/test_files/legacy': {
+                    'file_id': 'legacy',
+                    'hash': 'legacy',
+                    'content': 'eyIwIjogImxlZ2FjeSJ9'
+                }
+            }
+        }
+
+        with vestory.open_repository() as repo:
+            legacy_token = vestory.integrity.create_token(legacy_info, repo.key)
+            repo.add_change('legacy', legacy_token, legacy_info['changed_files'])
+
+        stats = vestory.gc()
+        self.is_true(stats['resigned'] == 1, msg_error='Legacy change not signed again')
+        self.is_true(vestory.verify_history() == 0, msg_error='Chain not rebuilt')
+        self.is_true(os.listdir('./.vestory/objects') == ['pack'], msg_error='Loose objects not removed')
+
+        repo = vestory.repository.Repository('./.vestory')
+
+        for change_token in repo.changes.values():
+            change_info = vestory.integrity.decode_token(change_token, repo.key)
+            self.is_true(isinstance(change_info, dict), msg_error='Token not verifiable')
+
+        file_info = vestory.get_change_info_by_id('legacy')['changed_files']['./tests/test_files/legacy']
+        self.is_true(repo.objects.get(file_info['object']) == b'{"0": "legacy"}', msg_error='Content not packed')
+
+        joined_changes = vestory.join_changes()
+        self.is_true(self.files[0] in joined_changes, msg_error='Packed file not joined')
+
+    def test_foreign_change(self):
+        # changes of other authors cannot be verified with
+        # the repository key and are kept as unverified
+        with vestory.open_repository() as repo:
+            last_token = repo.get_changes_from(0)[-1][1]
+            foreign_info = {
+                'author': 'Other',
+                'author_email': 'other@mail.com',
+                'date': '2023-01-01 00:00:00',
+                'comment': 'foreign change',
+                'parent': vestory.integrity.link_digest(last_token),
+                'changed_files': {}
+            }
+
+            foreign_token = vestory.integrity.create_token(foreign_info, 'other key')
+            repo.add_change('foreign', foreign_token)
+
+        self.is_true(vestory.verify_history() == 1, msg_error='Foreign change not accepted by verify')
+        self.is_true(vestory.fsck(full=False, jobs=1) == [], msg_error='Foreign change reported by fsck')
+        self.is_true(vestory.gc()['resigned'] == 0, msg_error='Foreign change signed again by gc')
+        self.is_true(vestory.get_change_info_by_id('foreign')['comment'] == 'foreign change',
+                     msg_error='Foreign change not decoded')
+
+        # changes of the repository author must be verified
+        with vestory.open_repository() as repo:
+            forged_info = dict(foreign_info, author_email='test@mail.com',
+                               parent=vestory.integrity.link_digest(foreign_token))
+            repo.add_change('forged', vestory.integrity.create_token(forged_info, 'other key'))
+
+        for check in (vestory.verify_history, vestory.gc):
+            try:
+                check()
+            except vestory.InvalidChangeError:
+                self.is_true(True)
+            else:
+                self.is_true(False, msg_error='Forged change accepted')
+
+        problems = vestory.fsck(full=False, jobs=1)
+        self.is_true(problems == [('forged', 'invalid token')], msg_error='Forged change not reported by fsck')
+
+        with vestory.open_repository() as repo:
+            del repo.changes['forged']
+            repo.mark_dirty()
+
+        self.is_true(vestory.verify_history() == 0, msg_error='History changed by forged change')
+
     def test_invalidating_change(self):
         with open('./.vestory/vestory.json') as file_r:
             vestory_file = json.load(file_r)
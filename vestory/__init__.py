@@ -1,5 +1,36 @@
-from .version_control import *
+import importlib
 
 __author__ = 'Jaedson Silva'
 __author_email__ = 'imunknowuser@protonmail.com'
 __version__ = '1.2.0'
+
+
+def _version_control():
+    return importlib.import_module('.version_control', __name__)
+
+
+def __getattr__(name: str):
+    # the public API is imported on the first use, so
+    # "import vestory" (and the CLI) loads only what it needs
+    if name == '__all__':
+        return [n for n in dir(_version_control()) if not n.startswith('_')]
+
+    if not name.startswith('__'):
+        try:
+            return importlib.import_module(f'.{name}', __name__)
+        except ModuleNotFoundError as error:
+            if error.name != f'{__name__}.{name}':
+                raise
+
+        version_control = _version_control()
+
+        if hasattr(version_control, name):
+            value = getattr(version_control, name)
+            globals()[name] = value
+            return value
+
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__() -> list:
+    return sorted(set(globals()) | set(dir(_version_control())))
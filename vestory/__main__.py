@@ -1,22 +1,334 @@
+# annotations are not evaluated, so the startup of
+# the CLI does not import `typing`
+from __future__ import annotations
+
 import os
+import sys
 
 from argeasy import ArgEasy
 
-from .version_control import (InvalidChangeError, add_files, check_repo_exists,
-                              decode_change, get_changes, get_files_changed,
-                              get_files_tracked, init_repo, join_changes,
-                              submit_change)
+from . import trace
+from .exceptions import InvalidChangeError, LockTimeoutError, RepoFormatError
 from .vestory_config import get_author, set_author_email, set_author_name
 
-EXEC_PATH = os.getcwd()
 
+def _print_change(change_id: str, change_info: dict) -> None:
+    date = change_info.get('date')
+    comment = change_info.get('comment')
+    author = change_info.get('author')
+    author_email = change_info.get('author_email')
+
+    print(f'\033[33m{date} - {change_id}\033[m')
+    print(f'Author: {author} ({author_email})')
+    print(f'Comment: {comment}\n')
+
+
+def _get_jobs(args) -> int | None:
+    if args.jobs is None:
+        return None
+
+    try:
+        jobs = int(args.jobs)
+    except ValueError:
+        jobs = 0
+
+    if jobs < 1:
+        print('error: "--jobs" must be a positive integer')
+        raise SystemExit(1)
+
+    return jobs
+
+
+def _get_lock_timeout(args) -> float | None:
+    if args.locktimeout is None:
+        return None
+
+    try:
+        timeout = float(args.locktimeout)
+    except ValueError:
+        timeout = -1
+
+    if timeout < 0:
+        print('error: "--lock-timeout" must be a number of seconds')
+        raise SystemExit(1)
+
+    return timeout
+
+
+def _is_read_only(args) -> bool:
+    # these commands share the repository with other
+    # readers; the others wait for an exclusive lock
+    if args.setting is not None:
+        return len(args.setting) == 1
+
+    return bool(args.log or args.history or args.status or args.join or args.fsck)
+
+
+def _confirm_join() -> bool:
+    print('\033[33mwarning: the "join" command will '
+        'replace the current files.\033[m')
+
+    while True:
+        confirm = input('\033[1m> Do you wish to proceed? [y/n] ').strip().lower()
+        if confirm not in ('y', 'n'):
+            print('\033[31mSelect an option between "y" and "n"\033[m')
+            continue
+        else:
+            break
+
+    return confirm == 'y'
+
+
+def _run_command(args) -> None:
+    # the modules of the commands are imported only
+    # after the arguments are parsed
+    from .repository import DEFAULT_SETTINGS
+    from .storage import BACKENDS
+    from .version_control import (add_files, convert_storage, fsck, gc,
+                                  get_all_files, get_change_info_by_id,
+                                  get_file_changes, get_files_changed, get_log,
+                                  get_repo_setting, join_files, migrate,
+                                  rebuild_file_index, rebuild_log,
+                                  set_repo_setting, submit_change,
+                                  verify_history)
+
+    jobs = _get_jobs(args)
+
+    if args.add is not None:
+        if args.a:
+            files_to_add = get_all_files()
+        else:
+            files_to_add = args.add
+
+        add_files(files_to_add, jobs)
+    elif args.submit is not None:
+        comment = args.c
+        changed_files = get_files_changed(jobs)
+
+        if not changed_files:
+            print('No changes to be submitted.')
+            return None
+
+        # only the changed files are submitted, so the
+        # tracked files are not checked a second time
+        if args.a:
+            if not comment:
+                print('error: a comment on the change is required. Use "-c."')
+                return None
+            files_to_submit = changed_files
+        elif args.ac:
+            files_to_submit = changed_files
+            comment = args.ac
+        else:
+            if not args.submit:
+                print('error: specify the files to be submitted')
+                return None
+            files_to_submit = args.submit
+
+        len_files = len(files_to_submit)
+
+        try:
+            change_id = submit_change(files_to_submit, comment, jobs)
+        except InvalidChangeError as error:
+            print(f'\033[31merror: {error}\033[m')
+            print('use "vestory fsck" to check the history.')
+            raise SystemExit(1)
+
+        print(f'{len_files} changed (ID: {change_id})')
+    elif args.log:
+        limit = None
+
+        if args.n is not None:
+            try:
+                limit = int(args.n)
+            except ValueError:
+                print('error: "-n" must be an integer')
+                return None
+
+        try:
+            # last changes first, printed as they are read
+            for entry in get_log(limit, args.author, args.since, args.until, args.path):
+                _print_change(entry['id'], entry)
+        except InvalidChangeError as error:
+            print(f'error: invalid changes detected: {error}')
+            print('use "vestory reindex" after restoring the history.')
+    elif args.history:
+        filepath = args.history
+
+        if not filepath.startswith('./'):
+            filepath = os.path.join('./', filepath)
+
+        try:
+            file_changes = get_file_changes(filepath)
+        except InvalidChangeError as error:
+            print(f'error: {error}')
+            return None
+
+        if not file_changes:
+            print(f'error: no changes found for "{filepath}"')
+
+        # last changes first
+        for change_id, __ in reversed(file_changes):
+            _print_change(change_id, get_change_info_by_id(change_id))
+    elif args.setting is not None:
+        if not args.setting or len(args.setting) > 2:
+            print('error: use "vestory setting <name> [value]"')
+            return None
+
+        import json
+
+        name = args.setting[0]
+
+        if name not in DEFAULT_SETTINGS:
+            print(f'error: setting "{name}" not found')
+            return None
+
+        if len(args.setting) == 1:
+            print(f'{name} = {json.dumps(get_repo_setting(name))}')
+            return None
+
+        value = args.setting[1]
+
+        # numbers and booleans are given as JSON
+        try:
+            value = json.loads(value)
+        except json.JSONDecodeError:
+            pass
+
+        try:
+            set_repo_setting(name, value)
+        except ValueError as error:
+            print(f'error: {error}')
+            return None
 
-def write_file(filepath: str, content: str) -> None:
-    with open(filepath, 'w') as file_w:
-        file_w.write(content)
+        print(f'{name} = {json.dumps(value)}')
+    elif args.fsck:
+        if args.quick and args.full:
+            print('error: use only one of "--quick" and "--full"')
+            return None
+
+        problems = fsck(full=not args.quick, jobs=jobs)
+
+        for change_id, problem in problems:
+            print(f'\033[31m    {change_id}: {problem}\033[m')
+
+        if problems:
+            invalid_changes = len({change_id for change_id, __ in problems})
+            print(f'\n{invalid_changes} corrupt or tampered changes found')
+            raise SystemExit(1)
+
+        print('\033[32mno problems found\033[m')
+    elif args.verify:
+        try:
+            verified_changes = verify_history()
+        except InvalidChangeError as error:
+            print(f'\033[31merror: {error}\033[m')
+            raise SystemExit(1)
+
+        print(f'\033[32m{verified_changes} new changes verified\033[m')
+    elif args.gc:
+        stats = gc()
+        size_before, size_after = stats['vestory_size']
+
+        print(f'{stats["changes"]} changes, {stats["resigned"]} signed again')
+        print(f'{stats["objects"]} objects packed ({stats["pack_size"] / 1024:.1f} KB), '
+              f'{stats["removed"]} removed')
+        print(f'{stats["vestory_file"]}: {size_before / 1024:.1f} KB -> {size_after / 1024:.1f} KB')
+    elif args.storage is not None:
+        if len(args.storage) != 1 or args.storage[0] not in BACKENDS:
+            print(f'error: use "vestory storage [{"|".join(BACKENDS)}]"')
+            return None
+
+        backend = args.storage[0]
+
+        if convert_storage(backend):
+            print(f'\033[32mrepository converted to the "{backend}" storage\033[m')
+        else:
+            print(f'repository already uses the "{backend}" storage')
+    elif args.migrate:
+        if migrate():
+            print('\033[32mrepository migrated to the current format\033[m')
+        else:
+            print('repository already in the current format')
+    elif args.reindex:
+        try:
+            rebuild_file_index()
+            rebuild_log()
+        except InvalidChangeError as error:
+            print(f'error: {error}')
+            return None
+
+        print('\033[32mindex of file changes and log rebuilt\033[m')
+    elif args.status:
+        changed_files = get_files_changed(jobs)
+
+        if not changed_files:
+            print('\033[32mno changes detected\033[m')
+        else:
+            print('files to submit:')
+            for file in changed_files:
+                print(f'\033[31m    changed: {file}\033[m')
+
+        print('\nuse "vestory submit -a" to submit changes.')
+        print('to add files, use "vestory add".')
+    elif args.join:
+        unchanged_files = 0
+
+        for filepath, rewritten in join_files(args.path, jobs):
+            if rewritten:
+                print(f'\033[32mfile "{filepath}" successfully completed\033[m')
+            else:
+                unchanged_files += 1
+
+        if unchanged_files:
+            print(f'{unchanged_files} files already up to date')
+
+        print('\nDone.')
+
+    return None
+
+
+def _run_watch(args) -> None:
+    from . import watch
+    from .version_control import get_repo_path
+
+    repo_path = get_repo_path()
+
+    if args.stop:
+        if watch.stop(repo_path):
+            print('\033[32mwatch daemon stopped\033[m')
+        else:
+            print('error: the watch daemon is not running')
+
+        return None
+
+    def ready(tracked_files: int) -> None:
+        print(f'\033[32mwatching {tracked_files} files '
+              f'(socket: {watch.get_socket_path(repo_path)})\033[m', flush=True)
+
+    try:
+        watch.serve(repo_path, ready)
+    except OSError as error:
+        print(f'error: {error}')
+    except KeyboardInterrupt:
+        pass
+
+    return None
 
 
 def main():
+    trace_value = trace.setup_from_env()
+
+    try:
+        with trace.span('command', argv=' '.join(sys.argv[1:])):
+            _main()
+    finally:
+        trace.report(trace_value)
+
+    return None
+
+
+def _main() -> None:
     parser = ArgEasy(
         description='Controle de versões Vestory.\n'
         'Visite https://github.com/jaedsonpys/vestory para obter ajuda.',
@@ -30,6 +342,15 @@ def main():
     parser.add_argument('log', 'View history of changes', 'store_true')
     parser.add_argument('status', 'View status of files', 'store_true')
     parser.add_argument('join', 'Join changes of files', action='store_true')
+    parser.add_argument('history', 'View history of changes of a file')
+    parser.add_argument('setting', 'View or change a setting of the repository', 'append')
+    parser.add_argument('reindex', 'Rebuild the index of file changes', action='store_true')
+    parser.add_argument('fsck', 'Verify the integrity of the history', action='store_true')
+    parser.add_argument('verify', 'Verify the changes made after the last verification', action='store_true')
+    parser.add_argument('gc', 'Repack the history in a compressed pack file', action='store_true')
+    parser.add_argument('watch', 'Watch tracked files to answer status faster', action='store_true')
+    parser.add_argument('migrate', 'Upgrade the repository to the current format', action='store_true')
+    parser.add_argument('storage', 'Convert the repository to a storage: json or sqlite', 'append')
 
     # config
     parser.add_argument('config', 'Add config to Vestory', action='store_true')
@@ -39,8 +360,25 @@ def main():
     parser.add_flag('-a', 'Select all files', action='store_true')
     parser.add_flag('-c', 'Comment the change')
     parser.add_flag('-ac', 'Select all files and comment the change')
+    parser.add_flag('--jobs', 'Number of workers used to hash and join files')
+    parser.add_flag('--path', 'Select only these files or directories', action='append')
+    parser.add_flag('--profile', 'Show the time spent in each phase', action='store_true')
+    parser.add_flag('-n', 'Number of changes shown by "log"')
+    parser.add_flag('--author', 'Show only the changes of an author')
+    parser.add_flag('--since', 'Show only the changes since a date (YYYY-MM-DD)')
+    parser.add_flag('--until', 'Show only the changes until a date (YYYY-MM-DD)')
+    parser.add_flag('--quick', 'Verify only the change tokens', action='store_true')
+    parser.add_flag('--full', 'Verify the tokens and every version of every file', action='store_true')
+    parser.add_flag('--stop', 'Stop the watch daemon', action='store_true')
+    parser.add_flag('--lock-timeout', 'Seconds to wait for a repository used by another command')
 
     args = parser.get_args()
+
+    if args.profile:
+        trace.tracer.enable()
+
+    from .version_control import check_repo_exists, init_repo, open_repository
+
     repo_exists = check_repo_exists()
 
     if args.version or args.help:
@@ -60,114 +398,32 @@ def main():
         return None
 
     if args.init:
+        exec_path = os.getcwd()
+
         if repo_exists:
-            print(f'\033[31mJá existe um repositório em "{EXEC_PATH}"\033[m')
+            print(f'\033[31mJá existe um repositório em "{exec_path}"\033[m')
         else:
             name, email = get_author()
             init_repo(name, email)
-            print(f'\033[1;32mNovo repositório inicializado em "{EXEC_PATH}"!\033[m')
+            print(f'\033[1;32mNovo repositório inicializado em "{exec_path}"!\033[m')
+    elif repo_exists and args.watch:
+        # the daemon runs outside a repository session
+        _run_watch(args)
     elif repo_exists:
-        if args.add is not None:
-            if args.a:
-                files_to_add = []
-
-                for root, dir, files in os.walk('./'):
-                    if not '.vestory' in root:
-                        for file in files:
-                            files_to_add.append(os.path.join(root, file))
-            else:
-                files_to_add = args.add
-
-            add_files(files_to_add)
-        elif args.submit is not None:
-            comment = args.c
-
-            if not get_files_changed():
-                print('No changes to be submitted.')
-                return None
-
-            if args.a:
-                if not comment:
-                    print('error: a comment on the change is required. Use "-c."')
-                    return None
-                files_to_submit = [file for file in get_files_tracked().keys()]
-            elif args.ac:
-                files_to_submit = [file for file in get_files_tracked().keys()]
-                comment = args.ac
-            else:
-                if not args.submit:
-                    print('error: specify the files to be submitted')
-                    return None
-                files_to_submit = args.submit
-
-            len_files = len(files_to_submit)
-            change_id = submit_change(files_to_submit, comment)
-            print(f'{len_files} changed (ID: {change_id})')
-        elif args.log:
-            changes = get_changes()
-            changes_list = []
-            invalid_changes = []
-
-            for change_id, change_token in changes.items():
-                change_info = decode_change(change_token)
-                if not change_token:
-                    invalid_changes.append(change_id)
-                else:
-                    changes_list.append((change_id, change_info))
-            
-            if invalid_changes:
-                print('error: invalid changes detected:')
-                for i in invalid_changes:
-                    print(f'    \033[31mINVALID\033[m: {i}')
-                    return None
-
-            # last changes first
-            changes_list.reverse()
-
-            for change_id, change_info in changes_list:
-                date = change_info.get('date')
-                comment = change_info.get('comment')
-                author = change_info.get('author')
-                author_email = change_info.get('author_email')
-
-                print(f'\033[33m{date} - {change_id}\033[m')
-                print(f'Author: {author} ({author_email})')
-                print(f'Comment: {comment}\n')
-        elif args.status:
-            changed_files = get_files_changed()
-
-            if not changed_files:
-                print('\033[32mno changes detected\033[m')
-            else:
-                print('files to submit:')
-                for file in changed_files:
-                    print(f'\033[31m    changed: {file}\033[m')
-
-            print('\nuse "vestory submit -a" to submit changes.')
-            print('to add files, use "vestory add".')
-        elif args.join:
-            print('\033[33mwarning: the "join" command will'
-                'replace the current files.\033[m')
-
-            while True:
-                confirm = input('\033[1m> Do you wish to proceed? [y/n] ').strip().lower()
-                if confirm not in ('y', 'n'):
-                    print('\033[31mSelect an option between "y" and "n"\033[m')
-                    continue
-                else:
-                    break
-
-            if confirm == 'n':
-                return None
+        exclusive = not _is_read_only(args)
+        timeout = _get_lock_timeout(args)
 
-            joined_changes = join_changes()
+        # the repository is not locked while
+        # the user answers
+        if args.join and not _confirm_join():
+            return None
 
-            for filepath, content in joined_changes.items():
-                file_lines = [line for line in content.values()]
-                write_file(filepath, ''.join(file_lines))
-                print(f'\033[32mfile "{filepath}" successfully completed\033[m')
-        
-            print('\nDone.')
+        try:
+            with open_repository(exclusive, timeout):
+                _run_command(args)
+        except (RepoFormatError, LockTimeoutError) as error:
+            print(f'\033[31merror: {error}\033[m')
+            raise SystemExit(1)
     else:
         print('\033[merror: .vestory repo not found\033[m')
 
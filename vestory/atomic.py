@@ -0,0 +1,62 @@
+import os
+from contextlib import contextmanager
+from typing import IO, Iterator
+
+
+def _sync_directory(dirname: str) -> None:
+    try:
+        dir_fd = os.open(dirname, os.O_RDONLY)
+    except OSError:
+        # directories cannot be opened on every system
+        return None
+
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+@contextmanager
+def atomic_write(filepath: str, mode: str = 'w', sync: bool = False) -> Iterator[IO]:
+    """Writes a file through a temporary file renamed
+    over it, so readers see the old or the new content,
+    never a partial one.
+
+    The temporary file is named after the process and
+    thread, so concurrent writers do not share it, and
+    it is removed if the writing fails.
+
+    :param filepath: File path.
+    :type filepath: str
+    :param mode: Mode of `open`, defaults to "w"
+    :type mode: str, optional
+    :param sync: Flush the content and the rename to
+    the disk, defaults to False
+    :type sync: bool, optional
+    :return: Returns the temporary file to write.
+    :rtype: Iterator[IO]
+    """
+
+    from threading import get_ident
+
+    temp_path = f'{filepath}.{os.getpid()}-{get_ident()}.tmp'
+
+    try:
+        with open(temp_path, mode) as file_w:
+            yield file_w
+
+            if sync:
+                file_w.flush()
+                os.fsync(file_w.fileno())
+
+        os.replace(temp_path, filepath)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+
+        raise
+
+    if sync:
+        _sync_directory(os.path.dirname(filepath) or '.')
@@ -0,0 +1,136 @@
+import json
+import os
+from typing import Union
+
+from .atomic import atomic_write
+
+# decoded changes of this process, shared by
+# all repositories and keyed by (key, token) digests
+_memo: dict = {}
+
+
+def _token_digest(token: str) -> str:
+    from hashlib import sha1
+    return sha1(token.encode()).hexdigest()
+
+
+def _copy(value):
+    # decoded changes hold only JSON values, copied
+    # faster than by `copy.deepcopy`
+    if isinstance(value, dict):
+        return {name: _copy(item) for name, item in value.items()}
+    elif isinstance(value, list):
+        return [_copy(item) for item in value]
+
+    return value
+
+
+class ChangeCache(object):
+    """Cache of decoded and verified change tokens.
+
+    Decoded changes are kept in memory for the whole
+    process and, if `persistent` is True, in a file per
+    change named by the token digest, so a read or a
+    write touches only its own changes. The files are
+    kept in a directory of the repository key, and
+    ignored when the key changes.
+
+    The cache keeps its own copy of each change, so
+    callers can change the dictionaries they get or set.
+    """
+
+    def __init__(self, cache_path: str, key: str, persistent: bool = True) -> None:
+        from hashlib import sha256
+
+        self.cache_path = cache_path
+        self.persistent = persistent
+
+        self._key_digest = sha256(key.encode()).hexdigest()
+        self._entries_path = os.path.join(cache_path, self._key_digest)
+        # changes set since the last save
+        self._pending = {}
+        self._cleared = False
+
+    def _read_entry(self, token_digest: str) -> Union[dict, None]:
+        if not self.persistent or self._cleared:
+            return None
+
+        try:
+            with open(os.path.join(self._entries_path, token_digest), 'r') as file_r:
+                return json.load(file_r)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def get(self, token: str) -> Union[dict, None]:
+        """Gets a decoded change.
+
+        :param token: Change token.
+        :type token: str
+        :return: Returns a copy of the decoded change,
+        or None if the token is not cached.
+        :rtype: Union[dict, None]
+        """
+
+        token_digest = _token_digest(token)
+        change_info = _memo.get((self._key_digest, token_digest))
+
+        if change_info is None:
+            change_info = self._read_entry(token_digest)
+
+            if change_info is None:
+                return None
+
+            _memo[(self._key_digest, token_digest)] = change_info
+
+        return _copy(change_info)
+
+    def set(self, token: str, change_info: dict, verified: bool = True) -> None:
+        """Caches a decoded change. Only verified
+        changes are written to the cache file.
+
+        :param token: Change token.
+        :type token: str
+        :param change_info: Decoded change.
+        :type change_info: dict
+        :param verified: If the token was verified with
+        the repository key, defaults to True
+        :type verified: bool, optional
+        """
+
+        token_digest = _token_digest(token)
+        change_info = _copy(change_info)
+        _memo[(self._key_digest, token_digest)] = change_info
+
+        if verified and self.persistent:
+            self._pending[token_digest] = change_info
+
+    def clear(self) -> None:
+        self._pending = {}
+        self._cleared = self.persistent
+
+    def save(self) -> None:
+        """Writes the changes set since the last save,
+        one file each."""
+
+        if self._cleared:
+            from shutil import rmtree
+
+            rmtree(self.cache_path, ignore_errors=True)
+            self._cleared = False
+
+        if not self._pending:
+            return None
+
+        # cache file of older versions, with every change
+        legacy_path = f'{self.cache_path}.json'
+
+        if os.path.isfile(legacy_path):
+            os.remove(legacy_path)
+
+        os.makedirs(self._entries_path, exist_ok=True)
+
+        for token_digest, change_info in self._pending.items():
+            with atomic_write(os.path.join(self._entries_path, token_digest)) as file_w:
+                json.dump(change_info, file_w)
+
+        self._pending = {}
@@ -0,0 +1,445 @@
+import json
+
+from .trace import span
+
+# stored deltas start with the version of their encoding
+# and the compression of the body. Contents stored before
+# the encoding are JSON, starting with "{"
+_DELTA_VERSION: int = 1
+_COMPRESSIONS: tuple = ('none', 'zlib', 'lzma')
+
+# valid levels of each compression; the level
+# is ignored by "none"
+COMPRESSION_LEVELS: dict = {
+    'none': range(0, 10),
+    'zlib': range(0, 10),
+    'lzma': range(0, 10)
+}
+
+
+# regions that need more edits than this are replaced
+# whole, so the work of the diff stays bounded
+_MAX_EDIT_COST: int = 1024
+
+
+def _myers_matches(old: list, new: list, old_start: int, old_end: int,
+                   new_start: int, new_end: int) -> list:
+    # Myers' greedy O(ND) diff of a region, returning the
+    # pairs of matching lines; no pairs if the region needs
+    # more than `_MAX_EDIT_COST` edits
+    n = old_end - old_start
+    m = new_end - new_start
+    max_cost = min(n + m, _MAX_EDIT_COST)
+    offset = max_cost + 1
+
+    v = [0] * (2 * max_cost + 3)
+    trace = []
+
+    for d in range(max_cost + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+
+            y = x - k
+
+            while x < n and y < m and old[old_start + x] == new[new_start + y]:
+                x += 1
+                y += 1
+
+            v[offset + k] = x
+
+            if x >= n and y >= m:
+                return _myers_backtrack(trace, d, n, m, old_start, new_start)
+
+        # values of the diagonals -d..d of this step
+        trace.append(v[offset - d:offset + d + 1])
+
+    return []
+
+
+def _myers_backtrack(trace: list, cost: int, x: int, y: int,
+                     old_start: int, new_start: int) -> list:
+    matches = []
+
+    for d in range(cost, 0, -1):
+        v = trace[d - 1]
+        k = x - y
+
+        # `v` holds the diagonals -(d - 1)..(d - 1)
+        if k == -d or (k != d and v[k - 1 + d - 1] < v[k + 1 + d - 1]):
+            previous_k = k + 1
+        else:
+            previous_k = k - 1
+
+        previous_x = v[previous_k + d - 1]
+        previous_y = previous_x - previous_k
+
+        # the edit moves one line, the rest is a snake
+        edit_x = previous_x if previous_k == k + 1 else previous_x + 1
+        edit_y = edit_x - k
+
+        while x > edit_x and y > edit_y:
+            x -= 1
+            y -= 1
+            matches.append((old_start + x, new_start + y))
+
+        x, y = previous_x, previous_y
+
+    while x > 0 and y > 0:
+        x -= 1
+        y -= 1
+        matches.append((old_start + x, new_start + y))
+
+    return matches
+
+
+def _unique_anchors(old: list, new: list, old_start: int, old_end: int,
+                    new_start: int, new_end: int) -> list:
+    # lines found once in both regions, in the longest
+    # sequence with the same order in both (patience diff)
+    old_count = {}
+    new_count = {}
+
+    for i in range(old_start, old_end):
+        line = old[i]
+        old_count[line] = i if line not in old_count else -1
+
+    for j in range(new_start, new_end):
+        line = new[j]
+        new_count[line] = j if line not in new_count else -1
+
+    pairs = [(i, new_count[line]) for line, i in old_count.items()
+             if i >= 0 and new_count.get(line, -1) >= 0]
+    pairs.sort()
+
+    from bisect import bisect_left
+
+    # longest increasing subsequence of the new positions
+    tails = []
+    tail_indexes = []
+    previous = [-1] * len(pairs)
+
+    for index, (__, j) in enumerate(pairs):
+        position = bisect_left(tails, j)
+
+        if position:
+            previous[index] = tail_indexes[position - 1]
+
+        if position == len(tails):
+            tails.append(j)
+            tail_indexes.append(index)
+        else:
+            tails[position] = j
+            tail_indexes[position] = index
+
+    anchors = []
+    index = tail_indexes[-1] if tail_indexes else -1
+
+    while index >= 0:
+        anchors.append(pairs[index])
+        index = previous[index]
+
+    anchors.reverse()
+    return anchors
+
+
+def diff_lines(old_lines: list, new_lines: list) -> list:
+    """Returns the hunks that turn `old_lines`
+    into `new_lines`.
+
+    Each hunk is a list `[start, end, lines]`: the old
+    lines from `start` to `end` (exclusive) are replaced
+    by `lines`. An insertion has `start == end` and a
+    deletion has no lines.
+
+    Lines found once in both versions anchor the diff
+    (patience diff), and the regions between anchors are
+    compared with Myers' algorithm, so repeated lines
+    (blank lines, braces) do not make the diff slow.
+
+    :param old_lines: Lines of the previous version.
+    :type old_lines: list
+    :param new_lines: Lines of the current version.
+    :type new_lines: list
+    :return: Returns a list of hunks.
+    :rtype: list
+    """
+
+    # common prefix and suffix are removed before the
+    # matching, so small edits on large files are cheap
+    prefix = 0
+    max_prefix = min(len(old_lines), len(new_lines))
+
+    while prefix < max_prefix and old_lines[prefix] == new_lines[prefix]:
+        prefix += 1
+
+    suffix = 0
+    max_suffix = max_prefix - prefix
+
+    while (suffix < max_suffix
+           and old_lines[-suffix - 1] == new_lines[-suffix - 1]):
+        suffix += 1
+
+    old_end = len(old_lines) - suffix
+    new_end = len(new_lines) - suffix
+    matches = []
+
+    with span('diff'):
+        # regions are split at their anchors without
+        # recursion, so long files do not overflow the stack
+        regions = [(prefix, old_end, prefix, new_end)]
+
+        while regions:
+            old_start, old_stop, new_start, new_stop = regions.pop()
+
+            # lines equal at both ends of the region
+            while (old_start < old_stop and new_start < new_stop
+                   and old_lines[old_start] == new_lines[new_start]):
+                matches.append((old_start, new_start))
+                old_start += 1
+                new_start += 1
+
+            while (old_start < old_stop and new_start < new_stop
+                   and old_lines[old_stop - 1] == new_lines[new_stop - 1]):
+                old_stop -= 1
+                new_stop -= 1
+                matches.append((old_stop, new_stop))
+
+            if old_start == old_stop or new_start == new_stop:
+                continue
+
+            anchors = _unique_anchors(old_lines, new_lines, old_start, old_stop, new_start, new_stop)
+
+            if not anchors:
+                matches.extend(_myers_matches(old_lines, new_lines, old_start,
+                                              old_stop, new_start, new_stop))
+                continue
+
+            for i, j in anchors:
+                matches.append((i, j))
+                regions.append((old_start, i, new_start, j))
+                old_start, new_start = i + 1, j + 1
+
+            regions.append((old_start, old_stop, new_start, new_stop))
+
+        # the matching lines do not cross, so they are in
+        # the same order in both versions
+        matches.sort()
+        matches.append((old_end, new_end))
+
+        hunks = []
+        old_position, new_position = prefix, prefix
+
+        for i, j in matches:
+            if i > old_position or j > new_position:
+                hunks.append([old_position, i, new_lines[new_position:j]])
+
+            old_position, new_position = i + 1, j + 1
+
+    return hunks
+
+
+def apply_hunks(lines: list, hunks: list) -> list:
+    """Applies hunks created by `diff_lines`.
+
+    :param lines: Lines of the previous version.
+    :type lines: list
+    :param hunks: Hunks to apply.
+    :type hunks: list
+    :return: Returns the lines of the new version.
+    :rtype: list
+    """
+
+    lines = list(lines)
+
+    # from the end, so the positions of the
+    # remaining hunks are still valid
+    for start, end, new_lines in reversed(hunks):
+        lines[start:end] = new_lines
+
+    return lines
+
+
+def apply_change(lines: list, content: dict) -> list:
+    """Applies the stored content of a change.
+
+    :param lines: Lines of the previous version.
+    :type lines: list
+    :param content: Decoded content of the change: a dict
+    with the hunks, or a dict of line number to line for
+    snapshots and deltas made before the hunks.
+    :type content: dict
+    :return: Returns the lines of the new version.
+    :rtype: list
+    """
+
+    hunks = content.get('hunks')
+
+    if hunks is not None:
+        return apply_hunks(lines, hunks)
+
+    # snapshots, and deltas made before the diff
+    # engine, are a dict of line number to line
+    lines = list(lines)
+
+    for nl, line in sorted(content.items(), key=lambda item: int(item[0])):
+        nl = int(nl)
+
+        if nl < len(lines):
+            lines[nl] = line
+        else:
+            lines.append(line)
+
+    return lines
+
+
+def _write_varint(buffer: bytearray, value: int) -> None:
+    while value > 0x7f:
+        buffer.append((value & 0x7f) | 0x80)
+        value >>= 7
+
+    buffer.append(value)
+
+
+def _read_varint(data: bytes, position: int) -> tuple:
+    value = 0
+    shift = 0
+
+    while True:
+        byte = data[position]
+        value |= (byte & 0x7f) << shift
+        position += 1
+
+        if byte < 0x80:
+            return (value, position)
+
+        shift += 7
+
+
+def encode_delta(hunks: list, compression: str = 'zlib', level: int = 6) -> bytes:
+    """Encodes hunks created by `diff_lines` to be stored.
+
+    Each hunk is stored as varints (the distance from the
+    end of the previous hunk, the number of replaced lines
+    and the number of new lines) followed by the new lines
+    as UTF-8, each one after its length. A snapshot is a
+    single hunk inserting every line.
+
+    :param hunks: Hunks to encode.
+    :type hunks: list
+    :param compression: "zlib", "lzma" or "none", defaults
+    to "zlib". Bodies that compression does not make smaller
+    are stored uncompressed.
+    :type compression: str, optional
+    :param level: Compression level, defaults to 6
+    :type level: int, optional
+    :raises ValueError: If the compression is unknown.
+    :return: Returns the encoded delta.
+    :rtype: bytes
+    """
+
+    if compression not in _COMPRESSIONS:
+        raise ValueError(f'Unknown compression "{compression}"')
+
+    body = bytearray()
+    _write_varint(body, len(hunks))
+    previous_end = 0
+
+    for start, end, lines in hunks:
+        _write_varint(body, start - previous_end)
+        _write_varint(body, end - start)
+        _write_varint(body, len(lines))
+
+        for line in lines:
+            line = line.encode()
+            _write_varint(body, len(line))
+            body += line
+
+        previous_end = end
+
+    if compression == 'zlib':
+        import zlib
+        compressed = zlib.compress(body, level)
+    elif compression == 'lzma':
+        import lzma
+        compressed = lzma.compress(body, format=lzma.FORMAT_ALONE, preset=level)
+    else:
+        compressed = body
+
+    # small deltas are larger when compressed
+    if len(compressed) >= len(body):
+        compression = 'none'
+        compressed = body
+
+    return bytes([_DELTA_VERSION, _COMPRESSIONS.index(compression)]) + compressed
+
+
+def _decompress(compression: int, body: bytes) -> bytes:
+    if compression == 0:
+        return body
+    elif compression == 1:
+        import zlib
+
+        try:
+            return zlib.decompress(body)
+        except zlib.error as error:
+            raise ValueError(f'Invalid zlib delta ({error})')
+    elif compression == 2:
+        import lzma
+
+        try:
+            return lzma.decompress(body, format=lzma.FORMAT_ALONE)
+        except lzma.LZMAError as error:
+            raise ValueError(f'Invalid lzma delta ({error})')
+
+    raise ValueError(f'Unknown delta compression {compression}')
+
+
+def decode_delta(content: bytes) -> dict:
+    """Decodes the stored content of a change.
+
+    :param content: Content created by `encode_delta`, or
+    the JSON stored by older versions.
+    :type content: bytes
+    :raises ValueError: If the content is not a delta.
+    :return: Returns the content to use in `apply_change`.
+    :rtype: dict
+    """
+
+    if content[:1] == b'{':
+        return json.loads(content)
+
+    if len(content) < 2 or content[0] != _DELTA_VERSION:
+        raise ValueError('Unknown delta encoding')
+
+    body = _decompress(content[1], content[2:])
+    hunks = []
+
+    try:
+        hunk_count, position = _read_varint(body, 0)
+        previous_end = 0
+
+        for __ in range(hunk_count):
+            distance, position = _read_varint(body, position)
+            replaced, position = _read_varint(body, position)
+            line_count, position = _read_varint(body, position)
+
+            start = previous_end + distance
+            lines = []
+
+            for __ in range(line_count):
+                length, position = _read_varint(body, position)
+                lines.append(body[position:position + length].decode())
+                position += length
+
+            hunks.append([start, start + replaced, lines])
+            previous_end = start + replaced
+    except IndexError:
+        raise ValueError('Truncated delta')
+
+    if position != len(body):
+        raise ValueError('Invalid delta length')
+
+    return {'hunks': hunks}
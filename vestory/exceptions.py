@@ -10,3 +10,13 @@ class RepoNotExistsError(Base):
 class InvalidChangeError(Base):
     def __init__(self, *args: object) -> None:
         super().__init__(*args)
+
+
+class RepoFormatError(Base):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class LockTimeoutError(Base):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
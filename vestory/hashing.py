@@ -0,0 +1,177 @@
+import codecs
+import io
+import json
+import os
+from typing import Iterable, NamedTuple, Union
+
+from .trace import count, span
+
+CHUNK_SIZE: int = 64 * 1024
+# size of the BLAKE2b digest, in bytes
+DIGEST_SIZE: int = 32
+
+
+# hash of the repositories in format 1, kept to
+# migrate them and to verify their old changes
+class LegacyFileHash(NamedTuple):
+    # MD5 of the raw bytes of the file
+    raw_hash: str
+    # MD5 of the enumerated lines for text files,
+    # the raw hash for binary files
+    content_hash: str
+    binary: bool
+
+
+def new_hash():
+    """Returns a new BLAKE2b hash, to hash a content in parts."""
+
+    from hashlib import blake2b
+    return blake2b(digest_size=DIGEST_SIZE)
+
+
+def hash_bytes(content: bytes) -> str:
+    """Returns the BLAKE2b of a content."""
+
+    content_hash = new_hash()
+    content_hash.update(content)
+    return content_hash.hexdigest()
+
+
+def hash_file(filepath: str) -> str:
+    """Hashes the raw bytes of a file with BLAKE2b.
+
+    The file is read in a single pass into a buffer of
+    `CHUNK_SIZE` bytes, reused for every chunk, so memory
+    usage does not depend on the file size. The result is
+    equal to `hash_bytes` of the file content.
+
+    :param filepath: File path.
+    :type filepath: str
+    :return: Returns the file hash.
+    :rtype: str
+    """
+
+    file_hash = new_hash()
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+
+    with span('hash', path=filepath), open(filepath, 'rb', buffering=0) as file_r:
+        while True:
+            size = file_r.readinto(buffer)
+            if not size:
+                break
+
+            count('bytes.read', size)
+            file_hash.update(view[:size])
+
+    return file_hash.hexdigest()
+
+
+def legacy_hash_bytes(content: bytes) -> str:
+    """Returns the MD5 of a content (format 1)."""
+
+    from hashlib import md5
+    return md5(content).hexdigest()
+
+
+def _new_text_decoder() -> io.IncrementalNewlineDecoder:
+    # same decoding of a file opened in text mode
+    utf8_decoder = codecs.getincrementaldecoder('utf-8')()
+    return io.IncrementalNewlineDecoder(utf8_decoder, translate=True)
+
+
+def legacy_hash_file(filepath: str) -> LegacyFileHash:
+    """Hashes a file as the repositories in format 1.
+
+    The raw bytes are hashed with MD5 and, for text files,
+    so are the enumerated lines, equivalent to
+    `md5(json.dumps(_enumerate_lines(lines)))`.
+
+    :param filepath: File path.
+    :type filepath: str
+    :return: Returns the file hashes.
+    :rtype: LegacyFileHash
+    """
+
+    from hashlib import md5
+
+    raw_hash = md5()
+    lines_hash = md5(b'{')
+    decoder = _new_text_decoder()
+
+    binary = False
+    line_number = 0
+    pending = ''
+
+    def update_line(line: str) -> None:
+        nonlocal line_number
+
+        separator = ', ' if line_number else ''
+        item = f'{separator}"{line_number}": {json.dumps(line)}'
+        lines_hash.update(item.encode())
+        line_number += 1
+
+    def update_lines(text: str) -> None:
+        nonlocal pending
+
+        lines = (pending + text).split('\n')
+        pending = lines.pop()
+
+        for line in lines:
+            update_line(line + '\n')
+
+    with open(filepath, 'rb') as file_r:
+        while True:
+            chunk = file_r.read(CHUNK_SIZE)
+            if not chunk:
+                break
+
+            raw_hash.update(chunk)
+
+            if not binary:
+                try:
+                    update_lines(decoder.decode(chunk))
+                except UnicodeDecodeError:
+                    binary = True
+
+    if not binary:
+        try:
+            update_lines(decoder.decode(b'', final=True))
+        except UnicodeDecodeError:
+            binary = True
+        else:
+            # last line without line break
+            if pending:
+                update_line(pending)
+
+    raw_digest = raw_hash.hexdigest()
+
+    if binary:
+        return LegacyFileHash(raw_digest, raw_digest, True)
+
+    lines_hash.update(b'}')
+    return LegacyFileHash(raw_digest, lines_hash.hexdigest(), False)
+
+
+def hash_files(files: Iterable[str], jobs: Union[int, None] = None) -> dict:
+    """Hashes files using a pool of workers.
+
+    :param files: Files to hash.
+    :type files: Iterable[str]
+    :param jobs: Number of workers, defaults to the
+    number of CPUs.
+    :type jobs: Union[int, None], optional
+    :return: Returns a dictionary of file path to hash.
+    :rtype: dict
+    """
+
+    files = list(files)
+    jobs = jobs or os.cpu_count() or 1
+
+    if jobs == 1 or len(files) < 2:
+        return {filepath: hash_file(filepath) for filepath in files}
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return dict(zip(files, executor.map(hash_file, files)))
@@ -0,0 +1,96 @@
+import os
+from typing import Iterable, Union
+
+from . import hashing
+from .atomic import atomic_write
+from .trace import count, span
+
+
+class HeadCache(object):
+    """Latest submitted content of each text file.
+
+    Each head is the content of the last version of a
+    file, compressed with zlib in `.vestory/heads` and
+    named by the hash of the file path, so a version is
+    read without replaying the changes of the file.
+
+    A head is used only if its content matches the hash
+    stored in the last change of the file. A head left
+    by an interrupted submit, or changed by something
+    else, is ignored and the changes are replayed.
+    """
+
+    def __init__(self, heads_path: str, level: int = 6) -> None:
+        self.heads_path = heads_path
+        self.level = level
+
+    def _head_path(self, filepath: str) -> str:
+        return os.path.join(self.heads_path, hashing.hash_bytes(filepath.encode()))
+
+    def get(self, filepath: str, content_hash: str) -> Union[bytes, None]:
+        """Gets the last version of a file.
+
+        :param filepath: File path.
+        :type filepath: str
+        :param content_hash: Hash stored in the last change
+        of the file.
+        :type content_hash: str
+        :return: Returns the content, or None if there is no
+        head matching the hash.
+        :rtype: Union[bytes, None]
+        """
+
+        import zlib
+
+        try:
+            with span('head.read', path=filepath), open(self._head_path(filepath), 'rb') as file_r:
+                content = zlib.decompress(file_r.read())
+        except (FileNotFoundError, zlib.error):
+            count('heads.missed')
+            return None
+
+        if hashing.hash_bytes(content) != content_hash:
+            count('heads.missed')
+            return None
+
+        count('heads.hit')
+        count('bytes.read', len(content))
+        return content
+
+    def put(self, filepath: str, content: bytes) -> None:
+        """Replaces the head of a file.
+
+        :param filepath: File path.
+        :type filepath: str
+        :param content: Content of the last version.
+        :type content: bytes
+        """
+
+        import zlib
+
+        os.makedirs(self.heads_path, exist_ok=True)
+        with span('head.write', path=filepath), atomic_write(self._head_path(filepath), 'wb') as file_w:
+            file_w.write(zlib.compress(content, self.level))
+
+    def prune(self, filepaths: Iterable[str]) -> int:
+        """Removes the heads of the files not given.
+
+        :param filepaths: Files whose heads are kept.
+        :type filepaths: Iterable[str]
+        :return: Returns the number of removed heads.
+        :rtype: int
+        """
+
+        if not os.path.isdir(self.heads_path):
+            return 0
+
+        keep = {os.path.basename(self._head_path(filepath)) for filepath in filepaths}
+        removed = 0
+
+        for filename in os.listdir(self.heads_path):
+            # heads being written by another process
+            if filename not in keep and not filename.endswith('.tmp'):
+                os.remove(os.path.join(self.heads_path, filename))
+                removed += 1
+
+        return removed
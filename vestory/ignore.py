@@ -0,0 +1,198 @@
+import os
+import re
+from typing import Iterator, NamedTuple, Pattern, Union
+
+REPO_DIR: str = '.vestory'
+
+
+class IgnoreRule(NamedTuple):
+    regex: Pattern
+    negate: bool
+    dir_only: bool
+    # rules with a "/" are matched against the path
+    # from the root, the others against the name
+    anchored: bool
+
+
+def _translate(pattern: str) -> str:
+    regex = ''
+    i = 0
+
+    while i < len(pattern):
+        char = pattern[i]
+
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+            continue
+        elif pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+            continue
+        elif char == '*':
+            regex += '[^/]*'
+        elif char == '?':
+            regex += '[^/]'
+        elif char == '[':
+            end = pattern.find(']', i + 1)
+
+            if end == -1:
+                regex += re.escape(char)
+            else:
+                char_class = pattern[i + 1:end]
+                if char_class.startswith('!'):
+                    char_class = '^' + char_class[1:]
+                regex += f'[{char_class}]'
+                i = end
+        else:
+            regex += re.escape(char)
+
+        i += 1
+
+    return f'(?:{regex})\\Z'
+
+
+def _normalize_path(filepath: str) -> str:
+    filepath = os.path.normpath(filepath).replace(os.sep, '/')
+    return '' if filepath == '.' else filepath
+
+
+class IgnoreMatcher(object):
+    """Compiled rules of a `.ignoreme` file.
+
+    Each line is a glob pattern (`*`, `?`, `[...]` and
+    `**`). Patterns ending with `/` match only directories,
+    patterns starting with `!` include again a path ignored
+    by a previous pattern, and the last matching pattern
+    wins. Everything under an ignored directory is ignored.
+    """
+
+    def __init__(self, patterns: list) -> None:
+        self.rules = []
+
+        for pattern in patterns:
+            pattern = pattern.strip()
+
+            if not pattern or pattern.startswith('#'):
+                continue
+
+            negate = pattern.startswith('!')
+            if negate:
+                pattern = pattern[1:]
+
+            dir_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+
+            if pattern.startswith('./'):
+                pattern = pattern[2:]
+
+            anchored = '/' in pattern
+            pattern = pattern.lstrip('/')
+
+            if pattern:
+                regex = re.compile(_translate(pattern))
+                self.rules.append(IgnoreRule(regex, negate, dir_only, anchored))
+
+    @classmethod
+    def from_file(cls, ignoreme_path: str) -> 'IgnoreMatcher':
+        if not os.path.isfile(ignoreme_path):
+            return cls([])
+
+        with open(ignoreme_path) as file_r:
+            return cls(file_r.readlines())
+
+    def match(self, filepath: str, is_dir: bool = False) -> bool:
+        """Matches a normalized path against the rules,
+        without checking its parent directories."""
+
+        name = filepath.rsplit('/', 1)[-1]
+        ignored = False
+
+        for rule in self.rules:
+            if rule.dir_only and not is_dir:
+                continue
+
+            if rule.regex.match(filepath if rule.anchored else name):
+                ignored = not rule.negate
+
+        return ignored
+
+    def is_ignored(self, filepath: str, is_dir: bool = False) -> bool:
+        """Checks if a path is ignored.
+
+        :param filepath: Path relative to the root of
+        the repository, with or without "./".
+        :type filepath: str
+        :param is_dir: If the path is a directory,
+        defaults to False
+        :type is_dir: bool, optional
+        :return: Returns True for ignored.
+        :rtype: bool
+        """
+
+        filepath = _normalize_path(filepath)
+
+        if not filepath or not self.rules:
+            return False
+
+        parts = filepath.split('/')
+
+        for i in range(1, len(parts)):
+            if self.match('/'.join(parts[:i]), True):
+                return True
+
+        return self.match(filepath, is_dir)
+
+
+def walk_files(
+    root: str = './',
+    matcher: Union[IgnoreMatcher, None] = None
+) -> Iterator[str]:
+    """Walks the files of a directory.
+
+    Ignored directories and the `.vestory` directory
+    are not entered. As in `os.walk`, links to
+    directories are not followed.
+
+    :param root: Directory to walk, defaults to "./"
+    :type root: str, optional
+    :param matcher: Ignore rules, defaults to None
+    :type matcher: Union[IgnoreMatcher, None], optional
+    :return: Yields the path of each file.
+    :rtype: Iterator[str]
+    """
+
+    directories = [(root, '')]
+
+    while directories:
+        dirpath, relpath = directories.pop()
+
+        with os.scandir(dirpath) as entries:
+            entries = sorted(entries, key=lambda entry: entry.name)
+
+        subdirectories = []
+
+        for entry in entries:
+            entry_relpath = f'{relpath}/{entry.name}' if relpath else entry.name
+
+            # links to directories are neither files nor
+            # walked, so the walk never loops
+            if entry.is_symlink() and entry.is_dir():
+                continue
+
+            is_dir = entry.is_dir(follow_symlinks=False)
+
+            if is_dir and entry.name == REPO_DIR:
+                continue
+
+            # parent directories were already checked
+            if matcher is not None and matcher.match(entry_relpath, is_dir):
+                continue
+
+            if is_dir:
+                subdirectories.append((os.path.join(dirpath, entry.name), entry_relpath))
+            else:
+                yield os.path.join(dirpath, entry.name)
+
+        # keeps the walk in name order
+        directories.extend(reversed(subdirectories))
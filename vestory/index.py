@@ -0,0 +1,87 @@
+import json
+import os
+from typing import Union
+
+from .atomic import atomic_write
+from .trace import span
+
+
+class Index(object):
+    """Stat cache of the tracked files.
+
+    For each file, the index records the size, mtime,
+    inode and the last computed hash. While the stat of
+    a file does not change, its hash is taken from the
+    index instead of reading the file again.
+
+    A file modified in the same timestamp as the index
+    was written ("racy" file) could keep the same stat
+    with another content, so its cached hash is not used.
+    """
+
+    def __init__(self, index_path: str) -> None:
+        self.index_path = index_path
+
+        self._entries = None
+        self._index_mtime = 0
+        self._dirty = False
+
+    @property
+    def entries(self) -> dict:
+        if self._entries is None:
+            try:
+                with span('index.load'), open(self.index_path, 'r') as file_r:
+                    self._entries = json.load(file_r)
+                self._index_mtime = os.stat(self.index_path).st_mtime_ns
+            except (FileNotFoundError, json.JSONDecodeError):
+                self._entries = {}
+
+        return self._entries
+
+    @staticmethod
+    def _stat_key(stat: os.stat_result) -> list:
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+    def get_hash(self, filepath: str, stat: os.stat_result) -> Union[str, None]:
+        """Gets the cached hash of a file.
+
+        :param filepath: File path.
+        :type filepath: str
+        :param stat: Current stat of the file.
+        :type stat: os.stat_result
+        :return: Returns the hash, or None if the file
+        must be hashed again.
+        :rtype: Union[str, None]
+        """
+
+        entry = self.entries.get(filepath)
+
+        if not entry or entry[:3] != self._stat_key(stat):
+            return None
+
+        if stat.st_mtime_ns >= self._index_mtime:
+            return None
+
+        return entry[3]
+
+    def update(self, filepath: str, stat: os.stat_result, file_hash: str) -> None:
+        self.entries[filepath] = self._stat_key(stat) + [file_hash]
+        self._dirty = True
+
+    def remove(self, filepath: str) -> None:
+        if self.entries.pop(filepath, None) is not None:
+            self._dirty = True
+
+    def clear(self) -> None:
+        self._entries = {}
+        self._dirty = True
+
+    def save(self) -> None:
+        if not self._dirty:
+            return None
+
+        with span('index.save'), atomic_write(self.index_path) as file_w:
+            json.dump(self._entries, file_w)
+
+        self._index_mtime = os.stat(self.index_path).st_mtime_ns
+        self._dirty = False
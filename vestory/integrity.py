@@ -1,16 +1,29 @@
 from typing import Union
 
-import utoken
-from utoken.exceptions import *
+from .trace import count, span
+
+
+# utoken is imported on the first use, commands
+# that do not read changes never load it
 
 
 def create_token(payload: dict, key: str) -> str:
-    return utoken.encode(payload, key)
+    import utoken
+
+    with span('token.encode'):
+        return utoken.encode(payload, key)
 
 
 def decode_token(token: str, key: str) -> Union[dict, bool]:
+    import utoken
+    from utoken.exceptions import (ExpiredTokenError, InvalidContentTokenError,
+                                   InvalidKeyError, InvalidTokenError)
+
+    count('tokens.decoded')
+
     try:
-        token_content = utoken.decode(token, key)
+        with span('token.decode'):
+            token_content = utoken.decode(token, key)
     except (
         InvalidContentTokenError,
         ExpiredTokenError,
@@ -40,8 +53,8 @@ def decode_tokens(tokens: list, key: str) -> list:
     decoded_tokens = []
     for t in tokens:
         content = decode_token(t, key)
-        decode_token.append(content)
-    
+        decoded_tokens.append(content)
+
     return decoded_tokens
 
 
@@ -58,6 +71,10 @@ def decode_without_key(token: str) -> dict:
     :rtype: dict
     """
 
+    import utoken
+    from utoken.exceptions import (ExpiredTokenError, InvalidContentTokenError,
+                                   InvalidTokenError)
+
     try:
         token_content = utoken.decode_without_key(token)
     except (
@@ -68,3 +85,109 @@ def decode_without_key(token: str) -> dict:
         return False
     else:
         return token_content
+
+
+def decode_change(token: str, key: str, author_email: str) -> tuple:
+    """Decodes a change token with the rule shared by
+    every verification of the history.
+
+    Tokens are verified with the repository key. Changes
+    of other authors, signed with their own key, are
+    decoded without it and kept as unverified; changes of
+    the repository author must be verified.
+
+    :param token: Change token.
+    :type token: str
+    :param key: Repository key.
+    :type key: str
+    :param author_email: Email of the repository author.
+    :type author_email: str
+    :return: Returns (decoded change, verified), with
+    False as the change of an invalid token.
+    :rtype: tuple
+    """
+
+    change_info = decode_token(token, key)
+
+    if change_info:
+        return change_info, True
+
+    change_info = decode_without_key(token)
+
+    if not change_info or change_info.get('author_email') == author_email:
+        return False, False
+
+    return change_info, False
+
+
+def link_digest(token: str) -> str:
+    """Digest of a change token, stored as the
+    "parent" of the next change of the history.
+
+    :param token: Change token.
+    :type token: str
+    :return: Returns the SHA-256 of the token.
+    :rtype: str
+    """
+
+    from hashlib import sha256
+    return sha256(token.encode()).hexdigest()
+
+
+def create_checkpoint(change_id: str, digest: str, count: int, key: str) -> str:
+    """Creates the signed "verified up to" checkpoint
+    of a hash-chained history.
+
+    :param change_id: ID of the last verified change.
+    :type change_id: str
+    :param digest: Link digest of the last verified change.
+    :type digest: str
+    :param count: Number of verified changes.
+    :type count: int
+    :param key: Repository key.
+    :type key: str
+    :return: Returns the checkpoint token.
+    :rtype: str
+    """
+
+    payload = {'change_id': change_id, 'digest': digest, 'count': count}
+    return create_token(payload, key)
+
+
+def check_chain(changes: list, checkpoint: Union[dict, None] = None) -> list:
+    """Checks the links of a hash-chained history.
+
+    Each change with a "parent" must point to the link
+    digest of the previous change. Changes made before
+    the chain have no "parent" and are not checked. The
+    checkpoint must point to a change still at its place,
+    so a truncated history is detected.
+
+    :param changes: List of (change ID, token, decoded
+    change) in the order of the history.
+    :type changes: list
+    :param checkpoint: Decoded checkpoint, defaults to None
+    :type checkpoint: Union[dict, None], optional
+    :return: Returns a list of (change ID, problem).
+    :rtype: list
+    """
+
+    problems = []
+    previous_digest = None
+
+    for change_id, token, change_info in changes:
+        if change_info and 'parent' in change_info:
+            if change_info['parent'] != previous_digest:
+                problems.append((change_id, 'broken link to the previous change'))
+
+        previous_digest = link_digest(token)
+
+    if checkpoint:
+        position = checkpoint['count'] - 1
+
+        if (position >= len(changes)
+                or changes[position][0] != checkpoint['change_id']
+                or link_digest(changes[position][1]) != checkpoint['digest']):
+            problems.append((checkpoint['change_id'], 'history truncated or rewritten'))
+
+    return problems
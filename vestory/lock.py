@@ -0,0 +1,99 @@
+from typing import Union
+
+from .exceptions import LockTimeoutError
+from .trace import count, span
+
+# seconds a session waits for the lock of the
+# repository before giving up
+DEFAULT_TIMEOUT: float = 30.0
+
+# bounds of the interval between two attempts
+_MIN_DELAY = 0.001
+_MAX_DELAY = 0.05
+
+
+class RepoLock(object):
+    """Advisory lock of a repository, on `.vestory/lock`.
+
+    Sessions that only read the history take a shared
+    lock, so readers run together. Sessions that change
+    `vestory.json` take an exclusive lock, held from the
+    first read of `vestory.json` until it is saved, so
+    two writers never overwrite each other's changes.
+
+    The lock is a `flock` of the process: it is released
+    when the session ends, or by the system when the
+    process dies. Without `fcntl` (Windows), repositories
+    are not locked.
+    """
+
+    def __init__(self, lock_path: str) -> None:
+        self.lock_path = lock_path
+        self.mode: Union[str, None] = None
+        self._file = None
+
+    @property
+    def exclusive(self) -> bool:
+        return self.mode == 'exclusive'
+
+    @property
+    def shared(self) -> bool:
+        return self.mode == 'shared'
+
+    def acquire(self, exclusive: bool = True, timeout: Union[float, None] = None) -> None:
+        """Waits for the lock.
+
+        :param exclusive: Exclusive lock, or shared
+        with other readers, defaults to True
+        :type exclusive: bool, optional
+        :param timeout: Seconds to wait, defaults to
+        `DEFAULT_TIMEOUT`.
+        :type timeout: Union[float, None], optional
+        :raises LockTimeoutError: If the lock is held by
+        another process after the timeout.
+        """
+
+        try:
+            import fcntl
+        except ImportError:
+            return None
+
+        import time
+
+        if timeout is None:
+            timeout = DEFAULT_TIMEOUT
+
+        mode = 'exclusive' if exclusive else 'shared'
+        operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+
+        lock_file = open(self.lock_path, 'a')
+        deadline = time.monotonic() + timeout
+        delay = _MIN_DELAY
+
+        with span('lock.wait', mode=mode):
+            while True:
+                try:
+                    fcntl.flock(lock_file.fileno(), operation | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    remaining = deadline - time.monotonic()
+
+                    if remaining <= 0:
+                        lock_file.close()
+                        raise LockTimeoutError(f'Repository locked by another process '
+                                               f'(waited {timeout:g} seconds)')
+
+                    count('lock.waits')
+                    time.sleep(min(delay, remaining))
+                    delay = min(delay * 2, _MAX_DELAY)
+
+        self._file = lock_file
+        self.mode = mode
+
+    def release(self) -> None:
+        if self._file is not None:
+            # closing the file releases the flock
+            self._file.close()
+
+        self._file = None
+        self.mode = None
@@ -0,0 +1,126 @@
+import json
+import os
+from typing import Iterator, TextIO
+
+from .atomic import atomic_write
+from .trace import count, span
+
+_BLOCK_SIZE = 64 * 1024
+
+
+def make_entry(change_id: str, change_info: dict) -> dict:
+    """Creates the log entry of a change.
+
+    :param change_id: Change ID.
+    :type change_id: str
+    :param change_info: Decoded change.
+    :type change_info: dict
+    :return: Returns the metadata of the change.
+    :rtype: dict
+    """
+
+    return {
+        'id': change_id,
+        'date': change_info.get('date'),
+        'author': change_info.get('author'),
+        'author_email': change_info.get('author_email'),
+        'comment': change_info.get('comment'),
+        'files': list(change_info.get('changed_files', {}))
+    }
+
+
+class ChangeLog(object):
+    """Metadata index of the changes.
+
+    Each line of `.vestory/log` is the JSON metadata of
+    one change (ID, date, author, comment and changed
+    files), oldest first, without the file contents. The
+    file is read from the end, so the last changes are
+    found without reading the whole history.
+
+    The log is touched every time `vestory.json` is
+    saved, so a `vestory.json` newer than the log was
+    changed by something else and the log is stale.
+    """
+
+    def __init__(self, log_path: str) -> None:
+        self.log_path = log_path
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.log_path)
+
+    def is_stale(self, vestory_file: str) -> bool:
+        try:
+            log_stat = os.stat(self.log_path)
+        except FileNotFoundError:
+            return True
+
+        if os.stat(vestory_file).st_mtime_ns > log_stat.st_mtime_ns:
+            return True
+
+        # an interrupted append leaves a partial line
+        if log_stat.st_size:
+            with open(self.log_path, 'rb') as file_r:
+                file_r.seek(-1, os.SEEK_END)
+                return file_r.read(1) != b'\n'
+
+        return False
+
+    @staticmethod
+    def _write_entries(file_w: TextIO, entries: list) -> None:
+        with span('log.write'):
+            for entry in entries:
+                file_w.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+    def append(self, entries: list) -> None:
+        with open(self.log_path, 'a') as file_w:
+            self._write_entries(file_w, entries)
+
+        # marks the log as up to date, even without entries
+        os.utime(self.log_path)
+
+    def rebuild(self, entries: list) -> None:
+        with atomic_write(self.log_path) as file_w:
+            self._write_entries(file_w, entries)
+
+    def _iter_lines_reversed(self) -> Iterator[bytes]:
+        with open(self.log_path, 'rb') as file_r:
+            position = file_r.seek(0, os.SEEK_END)
+            remainder = b''
+
+            while position > 0:
+                read_size = min(_BLOCK_SIZE, position)
+                position -= read_size
+                file_r.seek(position)
+
+                block = file_r.read(read_size) + remainder
+                count('bytes.read', read_size)
+                lines = block.split(b'\n')
+
+                # the first line may continue in the previous block
+                remainder = lines.pop(0)
+
+                for line in reversed(lines):
+                    if line:
+                        yield line
+
+            if remainder:
+                yield remainder
+
+    def iter_entries(self, reverse: bool = True) -> Iterator[dict]:
+        """Yields the entries of the log.
+
+        :param reverse: Last changes first, defaults to True
+        :type reverse: bool, optional
+        :return: Returns an iterator of entries.
+        :rtype: Iterator[dict]
+        """
+
+        if reverse:
+            for line in self._iter_lines_reversed():
+                yield json.loads(line)
+        else:
+            with open(self.log_path, 'rb') as file_r:
+                for line in file_r:
+                    if line.strip():
+                        yield json.loads(line)
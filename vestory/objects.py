@@ -0,0 +1,328 @@
+import json
+import os
+from typing import BinaryIO, Iterable, Iterator
+
+from .trace import count, span
+
+# each object starts with a byte saying how
+# its content was stored
+_RAW: bytes = b'r'
+_ZLIB: bytes = b'z'
+
+# a pack is the magic, the stored objects one after
+# another, the JSON index `object_id -> [offset, length]`
+# and the offset of the index as 8 bytes
+_PACK_MAGIC: bytes = b'VPK1'
+_PACK_TRAILER_SIZE: int = 8
+
+# size of the parts of streamed objects
+_CHUNK_SIZE: int = 1024 * 1024
+
+
+class ObjectStore(object):
+    """Content-addressed storage of file contents.
+
+    Each object is named by the SHA-1 of its content and
+    stored compressed with zlib in `.vestory/objects`,
+    so identical contents are stored only once.
+
+    New objects are written as loose files. `repack`
+    moves them to a single pack file, read by random
+    access through the index at the end of the pack.
+    """
+
+    def __init__(self, objects_path: str, level: int = 6) -> None:
+        self.objects_path = objects_path
+        self.pack_path = os.path.join(objects_path, 'pack', 'objects.pack')
+        self.level = level
+
+        self._pack_index = None
+
+    def _object_path(self, object_id: str) -> str:
+        return os.path.join(self.objects_path, object_id[:2], object_id[2:])
+
+    @property
+    def pack_index(self) -> dict:
+        if self._pack_index is None:
+            self._pack_index = {}
+
+            try:
+                with span('pack.index.load'), open(self.pack_path, 'rb') as file_r:
+                    file_r.seek(-_PACK_TRAILER_SIZE, os.SEEK_END)
+                    index_offset = int.from_bytes(file_r.read(), 'big')
+                    file_r.seek(index_offset)
+                    index = file_r.read()[:-_PACK_TRAILER_SIZE]
+                    self._pack_index = json.loads(index)
+            except FileNotFoundError:
+                pass
+
+        return self._pack_index
+
+    def has(self, object_id: str) -> bool:
+        return object_id in self.pack_index or os.path.isfile(self._object_path(object_id))
+
+    def put(self, content: bytes, compress: bool = True) -> str:
+        """Stores a content and returns its object ID.
+
+        :param content: Content to store.
+        :type content: bytes
+        :param compress: Compress the content with zlib,
+        False for contents already compressed, defaults to True
+        :type compress: bool, optional
+        :return: Returns the object ID.
+        :rtype: str
+        """
+
+        from hashlib import sha1
+
+        object_id = sha1(content).hexdigest()
+
+        if self.has(object_id):
+            return object_id
+
+        import zlib
+
+        compressed = zlib.compress(content, self.level) if compress else content
+
+        # already compressed contents are stored as is
+        if len(compressed) < len(content):
+            data = _ZLIB + compressed
+        else:
+            data = _RAW + content
+
+        temp_path = self._temp_path()
+
+        with span('object.write'), open(temp_path, 'wb') as file_w:
+            file_w.write(data)
+            count('bytes.written', len(data))
+
+        self._move_object(temp_path, object_id)
+        return object_id
+
+    def _temp_path(self) -> str:
+        os.makedirs(self.objects_path, exist_ok=True)
+
+        # the same object can be written by
+        # other workers of a parallel submit
+        from threading import get_ident
+        return os.path.join(self.objects_path, f'.{os.getpid()}-{get_ident()}.tmp')
+
+    def _move_object(self, temp_path: str, object_id: str) -> None:
+        object_path = self._object_path(object_id)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        os.replace(temp_path, object_path)
+
+    def put_chunks(self, chunks: Iterable[bytes]) -> str:
+        """Stores a content given in parts, compressing
+        each part while it is written, so the content is
+        never whole in memory.
+
+        :param chunks: Parts of the content.
+        :type chunks: Iterable[bytes]
+        :return: Returns the object ID.
+        :rtype: str
+        """
+
+        import zlib
+        from hashlib import sha1
+
+        content_hash = sha1()
+        compressor = zlib.compressobj(self.level)
+        temp_path = self._temp_path()
+
+        with span('object.write'), open(temp_path, 'wb') as file_w:
+            file_w.write(_ZLIB)
+
+            for chunk in chunks:
+                content_hash.update(chunk)
+                file_w.write(compressor.compress(chunk))
+
+            file_w.write(compressor.flush())
+            count('bytes.written', file_w.tell())
+
+        object_id = content_hash.hexdigest()
+
+        if self.has(object_id):
+            os.remove(temp_path)
+        else:
+            self._move_object(temp_path, object_id)
+
+        return object_id
+
+    def get(self, object_id: str) -> bytes:
+        """Gets the content of an object.
+
+        :param object_id: Object ID.
+        :type object_id: str
+        :raises FileNotFoundError: If the object does not exist.
+        :return: Returns the object content.
+        :rtype: bytes
+        """
+
+        data = self._read_stored(object_id)
+        count('bytes.read', len(data))
+
+        if data[:1] == _ZLIB:
+            import zlib
+            return zlib.decompress(data[1:])
+
+        return data[1:]
+
+    def iter_chunks(self, object_id: str) -> Iterator[bytes]:
+        """Yields the content of an object in parts, so
+        large objects are never whole in memory.
+
+        :param object_id: Object ID.
+        :type object_id: str
+        :raises FileNotFoundError: If the object does not exist.
+        :return: Returns an iterator of parts of the content.
+        :rtype: Iterator[bytes]
+        """
+
+        file_r, length = self._open_stored(object_id)
+
+        with file_r:
+            header = file_r.read(1)
+            length -= 1
+
+            if header == _ZLIB:
+                import zlib
+                decompressor = zlib.decompressobj()
+
+            while length > 0:
+                data = file_r.read(min(_CHUNK_SIZE, length))
+                if not data:
+                    break
+
+                length -= len(data)
+                count('bytes.read', len(data))
+
+                if header == _ZLIB:
+                    data = decompressor.decompress(data)
+
+                if data:
+                    yield data
+
+            if header == _ZLIB:
+                data = decompressor.flush()
+
+                if not decompressor.eof:
+                    raise zlib.error('Incomplete or truncated object')
+
+                if data:
+                    yield data
+
+    def _open_stored(self, object_id: str) -> tuple:
+        # returns the file positioned at the object,
+        # as stored with its header, and its length
+        try:
+            file_r = open(self._object_path(object_id), 'rb')
+        except FileNotFoundError:
+            if object_id not in self.pack_index:
+                raise
+        else:
+            return (file_r, os.fstat(file_r.fileno()).st_size)
+
+        offset, length = self.pack_index[object_id]
+        file_r = open(self.pack_path, 'rb')
+        file_r.seek(offset)
+
+        return (file_r, length)
+
+    def _read_stored(self, object_id: str) -> bytes:
+        # returns the object as stored, with its header
+        file_r, length = self._open_stored(object_id)
+
+        with span('object.read'), file_r:
+            return file_r.read(length)
+
+    def _copy_stored(self, object_id: str, file_w: BinaryIO) -> int:
+        # copies the stored object in parts, and
+        # returns the number of bytes copied
+        file_r, length = self._open_stored(object_id)
+        copied = 0
+
+        with file_r:
+            while copied < length:
+                data = file_r.read(min(_CHUNK_SIZE, length - copied))
+                if not data:
+                    break
+
+                file_w.write(data)
+                copied += len(data)
+
+        return copied
+
+    def iter_loose(self) -> Iterator[str]:
+        """Yields the IDs of the loose objects."""
+
+        if not os.path.isdir(self.objects_path):
+            return None
+
+        for dirname in sorted(os.listdir(self.objects_path)):
+            dirpath = os.path.join(self.objects_path, dirname)
+
+            if len(dirname) == 2 and os.path.isdir(dirpath):
+                for filename in sorted(os.listdir(dirpath)):
+                    if not filename.endswith('.tmp'):
+                        yield dirname + filename
+
+    def repack(self, object_ids: Iterable[str]) -> dict:
+        """Writes the given objects to a new pack and
+        removes every loose or packed object not in it.
+
+        :param object_ids: IDs of the objects to keep.
+        :type object_ids: Iterable[str]
+        :raises FileNotFoundError: If an object does not exist.
+        :return: Returns the number of packed and removed
+        objects and the size of the pack.
+        :rtype: dict
+        """
+
+        object_ids = sorted(set(object_ids))
+        previous_ids = set(self.pack_index) | set(self.iter_loose())
+
+        os.makedirs(os.path.dirname(self.pack_path), exist_ok=True)
+        temp_path = f'{self.pack_path}.tmp'
+        index = {}
+
+        with span('pack.write'), open(temp_path, 'wb') as file_w:
+            file_w.write(_PACK_MAGIC)
+
+            # stored objects are copied as they
+            # are, without compressing them again
+            for object_id in object_ids:
+                offset = file_w.tell()
+                index[object_id] = [offset, self._copy_stored(object_id, file_w)]
+
+            index_offset = file_w.tell()
+            file_w.write(json.dumps(index, separators=(',', ':')).encode())
+            file_w.write(index_offset.to_bytes(_PACK_TRAILER_SIZE, 'big'))
+
+            file_w.flush()
+            os.fsync(file_w.fileno())
+            pack_size = file_w.tell()
+
+        os.replace(temp_path, self.pack_path)
+        self._pack_index = index
+
+        # loose objects are removed only when
+        # the new pack is already in place
+        for dirname in os.listdir(self.objects_path):
+            dirpath = os.path.join(self.objects_path, dirname)
+
+            if len(dirname) != 2 or not os.path.isdir(dirpath):
+                continue
+
+            for filename in os.listdir(dirpath):
+                os.remove(os.path.join(dirpath, filename))
+
+            os.rmdir(dirpath)
+
+        count('objects.packed', len(object_ids))
+
+        return {
+            'packed': len(object_ids),
+            'removed': len(previous_ids - set(object_ids)),
+            'pack_size': pack_size
+        }
@@ -0,0 +1,339 @@
+import io
+import os
+from typing import Union
+
+from . import hashing
+from .diff import apply_change, decode_delta, diff_lines, encode_delta
+from .heads import HeadCache
+from .objects import ObjectStore
+from .trace import count, span
+from .workers import split_tasks
+
+# below this number of files, starting the
+# worker processes costs more than the work
+_MIN_PARALLEL_FILES = 8
+
+# pages of a mapped large file already read are
+# released every time this size is read
+_MAP_RELEASE_SIZE = 16 * 1024 * 1024
+
+
+def decode_lines(content: bytes) -> Union[list, None]:
+    """Splits a content in lines.
+
+    Line breaks are kept as they are, so the lines
+    joined are equal to the raw content.
+
+    :param content: File content.
+    :type content: bytes
+    :return: Returns the lines, or None if the content
+    is binary.
+    :rtype: Union[list, None]
+    """
+
+    try:
+        text = content.decode()
+    except UnicodeDecodeError:
+        return None
+
+    return io.StringIO(text, newline='').readlines()
+
+
+def read_content(objects: ObjectStore, file_info: dict) -> bytes:
+    """Reads the stored content of a change of a file.
+
+    :param objects: Object store of the repository.
+    :type objects: ObjectStore
+    :param file_info: Change of the file.
+    :type file_info: dict
+    :return: Returns the stored content.
+    :rtype: bytes
+    """
+
+    object_id = file_info.get('object')
+
+    if object_id:
+        return objects.get(object_id)
+
+    # changes made before the object store
+    # have their content inside the token
+    from base64 import b64decode
+    return b64decode(file_info['content'])
+
+
+def replay_lines(objects: ObjectStore, changes: list) -> list:
+    """Rebuilds the lines of a file from its changes.
+
+    :param objects: Object store of the repository.
+    :type objects: ObjectStore
+    :param changes: List of (change ID, file info).
+    :type changes: list
+    :raises ValueError: If a content is not a text change.
+    :return: Returns the lines of the last version.
+    :rtype: list
+    """
+
+    lines = []
+
+    # changes before the last snapshot are
+    # replaced by the snapshot content
+    start = 0
+
+    for i, (change_id, file_info) in enumerate(changes):
+        if file_info.get('snapshot'):
+            start = i
+
+    for change_id, file_info in changes[start:]:
+        content = decode_delta(read_content(objects, file_info))
+        lines = apply_change(lines, content)
+
+    return lines
+
+
+def build_content(
+    objects: ObjectStore,
+    filepath: str,
+    delta_chain: list,
+    heads: Union[HeadCache, None] = None
+) -> bytes:
+    """Builds the last version of a file.
+
+    :param objects: Object store of the repository.
+    :type objects: ObjectStore
+    :param filepath: File path.
+    :type filepath: str
+    :param delta_chain: Changes of the file from its
+    last snapshot.
+    :type delta_chain: list
+    :param heads: Head cache, None to always replay
+    the changes, defaults to None
+    :type heads: Union[HeadCache, None], optional
+    :return: Returns the content of the last version.
+    :rtype: bytes
+    """
+
+    last_file_info = delta_chain[-1][1]
+
+    if last_file_info.get('binary'):
+        return read_content(objects, last_file_info)
+
+    if heads is not None:
+        content = heads.get(filepath, last_file_info.get('hash'))
+        if content is not None:
+            return content
+
+    try:
+        lines = replay_lines(objects, delta_chain)
+    except ValueError:
+        # binary files submitted before the "binary"
+        # flag are stored as their raw content
+        return read_content(objects, last_file_info)
+
+    content = ''.join(lines).encode()
+
+    # the replayed version is kept for the next use
+    if heads is not None and hashing.hash_bytes(content) == last_file_info.get('hash'):
+        heads.put(filepath, content)
+
+    return content
+
+
+def _prepare_large_file(objects: ObjectStore, filepath: str, size: int) -> dict:
+    import mmap
+
+    file_hash = hashing.new_hash()
+
+    # the mapped file is hashed and compressed in parts,
+    # without copies of the content in memory
+    with open(filepath, 'rb') as file_r:
+        file_map = mmap.mmap(file_r.fileno(), 0, access=mmap.ACCESS_READ)
+
+    with file_map:
+        view = memoryview(file_map)
+
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            file_map.madvise(mmap.MADV_SEQUENTIAL)
+
+        def iter_chunks():
+            released = 0
+
+            for offset in range(0, size, hashing.CHUNK_SIZE):
+                chunk = view[offset:offset + hashing.CHUNK_SIZE]
+                file_hash.update(chunk)
+                count('bytes.read', len(chunk))
+                yield chunk
+
+                # the read pages do not stay in memory
+                if hasattr(mmap, 'MADV_DONTNEED') and offset - released >= _MAP_RELEASE_SIZE:
+                    file_map.madvise(mmap.MADV_DONTNEED, released, offset - released)
+                    released = offset
+
+        try:
+            with span('read', path=filepath):
+                object_id = objects.put_chunks(iter_chunks())
+        finally:
+            view.release()
+
+    # large files are stored whole, as binary files
+    return {
+        'hash': file_hash.hexdigest(),
+        'object': object_id,
+        'size': size,
+        'snapshot': True,
+        'binary': True
+    }
+
+
+def prepare_file(
+    objects: ObjectStore,
+    heads: Union[HeadCache, None],
+    filepath: str,
+    delta_chain: list,
+    use_delta: bool,
+    options: dict
+) -> tuple:
+    """Reads, hashes, diffs and stores a submitted file.
+
+    :param objects: Object store of the repository.
+    :type objects: ObjectStore
+    :param heads: Head cache, or None.
+    :type heads: Union[HeadCache, None]
+    :param filepath: File path.
+    :type filepath: str
+    :param delta_chain: Changes of the file from its
+    last snapshot.
+    :type delta_chain: list
+    :param use_delta: Store the difference from the last
+    version instead of a snapshot, if it is smaller.
+    :type use_delta: bool
+    :param options: Compression and level of the deltas,
+    and the size of the large files.
+    :type options: dict
+    :return: Returns the change of the file, without its
+    ID, and the stat of the file before reading it.
+    :rtype: tuple
+    """
+
+    file_stat = os.stat(filepath)
+
+    if file_stat.st_size >= options['large_file_threshold']:
+        return (_prepare_large_file(objects, filepath, file_stat.st_size), file_stat)
+
+    with span('read', path=filepath), open(filepath, 'rb') as file_r:
+        file_content = file_r.read()
+        count('bytes.read', len(file_content))
+
+    # a single pass over the raw bytes, equal
+    # to the hash of the file in `add_files`
+    file_hash = hashing.hash_bytes(file_content)
+    file_lines = decode_lines(file_content)
+
+    if file_lines is None:
+        file_info = {
+            'hash': file_hash,
+            'object': objects.put(file_content),
+            'size': len(file_content),
+            'snapshot': True,
+            'binary': True
+        }
+
+        return (file_info, file_stat)
+
+    compression = options['compression']
+    level = options['level']
+
+    # a snapshot is a single hunk with every line
+    stored_content = encode_delta([[0, 0, file_lines]], compression, level)
+    snapshot = True
+
+    if use_delta:
+        # the last version comes from the head cache,
+        # without replaying the changes of the file
+        previous_lines = decode_lines(build_content(objects, filepath, delta_chain, heads))
+
+        if previous_lines is not None:
+            hunks = diff_lines(previous_lines, file_lines)
+            difference_bytes = encode_delta(hunks, compression, level)
+
+            if len(difference_bytes) < len(stored_content):
+                stored_content = difference_bytes
+                snapshot = False
+
+    if heads is not None:
+        heads.put(filepath, file_content)
+
+    file_info = {
+        'hash': file_hash,
+        'object': objects.put(stored_content, compress=False),
+        'size': len(stored_content),
+        'snapshot': snapshot
+    }
+
+    return (file_info, file_stat)
+
+
+def _prepare_files(
+    objects_path: str,
+    heads_path: Union[str, None],
+    tasks: list,
+    options: dict
+) -> list:
+    objects = ObjectStore(objects_path)
+    heads = HeadCache(heads_path) if heads_path else None
+
+    return [prepare_file(objects, heads, *task, options) for task in tasks]
+
+
+def prepare_files(
+    objects_path: str,
+    heads_path: Union[str, None],
+    tasks: list,
+    options: dict,
+    jobs: Union[int, None] = None
+) -> list:
+    """Prepares the submitted files in a pool of processes.
+
+    Only the contents are written by the workers; the
+    change is created by the caller, so the result is
+    the same as preparing the files one by one.
+
+    :param objects_path: Path of the object store.
+    :type objects_path: str
+    :param heads_path: Path of the head cache, or None.
+    :type heads_path: Union[str, None]
+    :param tasks: List of (file path, delta chain, use delta).
+    :type tasks: list
+    :param options: Compression and level of the deltas,
+    and the size of the large files.
+    :type options: dict
+    :param jobs: Number of worker processes, defaults
+    to the number of CPUs.
+    :type jobs: Union[int, None], optional
+    :return: Returns a list of (file info, file stat), in
+    the order of the tasks.
+    :rtype: list
+    """
+
+    jobs = jobs or os.cpu_count() or 1
+
+    if jobs == 1 or len(tasks) < _MIN_PARALLEL_FILES:
+        return _prepare_files(objects_path, heads_path, tasks, options)
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    task_chunks = split_tasks(tasks, jobs)
+    results = []
+
+    with span('submit.workers'), ProcessPoolExecutor(max_workers=jobs) as executor:
+        chunk_results = executor.map(
+            _prepare_files,
+            [objects_path] * len(task_chunks),
+            [heads_path] * len(task_chunks),
+            task_chunks,
+            [options] * len(task_chunks)
+        )
+
+        for result in chunk_results:
+            results.extend(result)
+
+    return results
@@ -0,0 +1,324 @@
+import os
+from typing import Iterable, Union
+
+from .cache import ChangeCache
+from .heads import HeadCache
+from .index import Index
+from .lock import RepoLock
+from .log import ChangeLog, make_entry
+from .objects import ObjectStore
+from .storage import make_storage, open_storage
+from .trace import span
+
+# format of the repository: 2 hashes the raw bytes
+# of the files with BLAKE2b, 1 (repositories without
+# "format_version") hashed them with MD5
+FORMAT_VERSION: int = 2
+
+# settings that can be changed in the
+# "settings" field of `vestory.json`
+DEFAULT_SETTINGS: dict = {
+    # keep decoded changes in `.vestory/cache`
+    'change_cache': True,
+    # keep the last version of each text file
+    # in `.vestory/heads`
+    'head_cache': True,
+    # maximum number of changes of a file between
+    # two full snapshots of its content
+    'snapshot_interval': 10,
+    # maximum size, in bytes, of the changes stored
+    # after the last snapshot of a file
+    'snapshot_max_chain_size': 1024 * 1024,
+    # compression of the stored text changes:
+    # "zlib", "lzma" or "none"
+    'delta_compression': 'zlib',
+    # level of the compression, from 0 to 9
+    'delta_compression_level': 6,
+    # files from this size, in bytes, are streamed
+    # and stored whole, without reading them in memory
+    'large_file_threshold': 64 * 1024 * 1024
+}
+
+# smallest value of the numeric settings
+_SETTING_MINIMUMS: dict = {
+    'snapshot_interval': 1,
+    'snapshot_max_chain_size': 0,
+    'large_file_threshold': 1
+}
+
+
+def _check_setting(name: str, value) -> None:
+    """Checks a setting value against the type
+    of its default value and its allowed range.
+
+    :param name: Setting name.
+    :type name: str
+    :param value: Setting value.
+    :raises ValueError: If the value is not valid.
+    """
+
+    default = DEFAULT_SETTINGS[name]
+
+    # bool is a subclass of int, but "true" is
+    # not a valid snapshot interval
+    if type(value) is not type(default):
+        raise ValueError(f'"{name}" must be of type {type(default).__name__}')
+
+    minimum = _SETTING_MINIMUMS.get(name)
+
+    if minimum is not None and value < minimum:
+        raise ValueError(f'"{name}" must be at least {minimum}')
+
+
+def _check_compression(compression: str, level: int) -> None:
+    """Checks the compression of the stored
+    text changes and its level.
+
+    :param compression: Compression name.
+    :type compression: str
+    :param level: Compression level.
+    :type level: int
+    :raises ValueError: If the compression is unknown
+    or the level is out of its range.
+    """
+
+    from .diff import COMPRESSION_LEVELS
+
+    if compression not in COMPRESSION_LEVELS:
+        choices = ', '.join(f'"{name}"' for name in COMPRESSION_LEVELS)
+        raise ValueError(f'"delta_compression" must be one of {choices}')
+
+    levels = COMPRESSION_LEVELS[compression]
+
+    if level not in levels:
+        raise ValueError(f'"delta_compression_level" of "{compression}" must be '
+                         f'from {levels.start} to {levels.stop - 1}')
+
+
+class Repository(object):
+    """In-memory view of a `.vestory` repository.
+
+    The state of the repository is kept by its storage:
+    a `vestory.json` document, or a SQLite database (see
+    `storage`). Every change is kept in memory, or in a
+    transaction, until `save` is called, so readers never
+    see a partially written repository.
+
+    The lock is taken by the session (`open_repository`)
+    before the storage is read.
+    """
+
+    def __init__(self, repo_path: str) -> None:
+        self.repo_path = repo_path
+        self.storage = open_storage(repo_path)
+
+        self.objects = ObjectStore(os.path.join(repo_path, 'objects'))
+        self.index = Index(os.path.join(repo_path, 'index'))
+        self.log = ChangeLog(os.path.join(repo_path, 'log'))
+        self.heads = HeadCache(os.path.join(repo_path, 'heads'))
+        self.lock = RepoLock(os.path.join(repo_path, 'lock'))
+
+        self._change_cache = None
+        self._log_entries = []
+        self._log_stale = False
+
+    @property
+    def vestory_file(self) -> str:
+        # `vestory.json` or `vestory.db`
+        return self.storage.path
+
+    @property
+    def author(self) -> str:
+        return self.storage.get('author')
+
+    @property
+    def author_email(self) -> str:
+        return self.storage.get('author_email')
+
+    @property
+    def key(self) -> str:
+        return self.storage.get('key')
+
+    @property
+    def format_version(self) -> int:
+        return self.storage.get('format_version', 1)
+
+    def set_format_version(self, format_version: int) -> None:
+        self.storage.set('format_version', format_version)
+
+    @property
+    def tracked_files(self) -> dict:
+        return self.storage.tracked_files
+
+    @property
+    def changes(self) -> dict:
+        return self.storage.changes
+
+    @property
+    def change_cache(self) -> ChangeCache:
+        if self._change_cache is None:
+            self._change_cache = ChangeCache(
+                os.path.join(self.repo_path, 'cache', 'changes'),
+                self.key,
+                persistent=self.get_setting('change_cache')
+            )
+
+        return self._change_cache
+
+    def get_setting(self, name: str):
+        settings = self.storage.get('settings', {})
+        return settings.get(name, DEFAULT_SETTINGS[name])
+
+    def set_setting(self, name: str, value) -> None:
+        _check_setting(name, value)
+        settings = dict(self.storage.get('settings', {}))
+        settings[name] = value
+
+        if name in ('delta_compression', 'delta_compression_level'):
+            _check_compression(
+                settings.get('delta_compression', DEFAULT_SETTINGS['delta_compression']),
+                settings.get('delta_compression_level', DEFAULT_SETTINGS['delta_compression_level'])
+            )
+
+        self.storage.set('settings', settings)
+
+    def init(self, config: dict, backend: str = 'json') -> None:
+        """Creates the repository directory and
+        writes the initial configuration.
+
+        :param config: Initial repository configuration.
+        :type config: dict
+        :param backend: Storage, "json" or "sqlite",
+        defaults to "json"
+        :type backend: str, optional
+        """
+
+        os.mkdir(self.repo_path)
+        self.storage = make_storage(self.repo_path, backend)
+        self.storage.create(config)
+        self.log.rebuild([])
+
+    def convert_storage(self, backend: str) -> bool:
+        """Moves the repository to another storage.
+
+        The new storage is created before the current
+        one is removed, so an interrupted conversion
+        leaves a complete repository.
+
+        :param backend: "json" or "sqlite".
+        :type backend: str
+        :raises ValueError: If the backend is unknown.
+        :return: Returns False if the repository already
+        uses the storage.
+        :rtype: bool
+        """
+
+        if backend == self.storage.name:
+            return False
+
+        storage = make_storage(self.repo_path, backend)
+        self.save()
+
+        with span('storage.convert', backend=backend):
+            storage.create(self.storage.export())
+
+        self.storage.remove()
+        self.storage = storage
+
+        # the log has the same changes, it is
+        # marked as newer than the new storage
+        if self.log.exists():
+            os.utime(self.log.log_path)
+
+        return True
+
+    def mark_dirty(self) -> None:
+        self.storage.mark_dirty()
+
+    def set_tracked_files(self, files: dict) -> None:
+        self.storage.set_tracked_files(files)
+
+    def set_file_hash(self, filepath: str, file_hash: str) -> None:
+        self.storage.set_file_hash(filepath, file_hash)
+
+    @property
+    def checkpoint(self) -> Union[str, None]:
+        # signed "verified up to" checkpoint of the
+        # hash-chained history
+        return self.storage.get('checkpoint')
+
+    def set_checkpoint(self, checkpoint: str) -> None:
+        self.storage.set('checkpoint', checkpoint)
+
+    @property
+    def file_changes(self) -> Union[dict, None]:
+        # index of file path to the ordered list of
+        # IDs of the changes of that file. It is None
+        # in repositories created without the index.
+        return self.storage.file_changes
+
+    def set_file_changes(self, file_changes: dict) -> None:
+        self.storage.set_file_changes(file_changes)
+
+    def get_author_changes(self, author_email: str) -> Union[list, None]:
+        # IDs of the changes of an author, or None
+        # if the storage has no index of authors
+        return self.storage.get_author_changes(author_email)
+
+    def add_change(
+        self,
+        change_id: str,
+        change_token: str,
+        files: Iterable[str] = (),
+        change_info: Union[dict, None] = None
+    ) -> None:
+        self.storage.add_change(change_id, change_token, files)
+
+        # without the decoded change, the log
+        # is rebuilt on its next use
+        if change_info is None:
+            self._log_stale = True
+        else:
+            self._log_entries.append(make_entry(change_id, change_info))
+
+    def set_change_token(self, change_id: str, change_token: str) -> None:
+        self.storage.set_change_token(change_id, change_token)
+
+    def get_changes_from(self, position: int) -> list:
+        # (change ID, token) of the changes from a
+        # position of the history, counted from 0
+        return self.storage.get_changes_from(position)
+
+    def save(self) -> None:
+        """Writes the repository to disk if it was
+        changed since it was loaded.
+
+        With a shared lock, only the caches are written:
+        other readers may hold the same state, and changes
+        made in memory by a reader (such as the index of
+        file changes of older repositories) are made again
+        by the next session.
+        """
+
+        self.index.save()
+
+        if self._change_cache is not None:
+            self._change_cache.save()
+
+        if self.lock.shared:
+            self.storage.discard()
+            return None
+
+        if not self.storage.save():
+            return None
+
+        # the log is written after the storage, a
+        # failure between both leaves the log stale
+        if self.log.exists() and not self._log_stale:
+            self.log.append(self._log_entries)
+
+        self._log_entries = []
+        self._log_stale = False
+
+    def close(self) -> None:
+        self.storage.close()
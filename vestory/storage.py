@@ -0,0 +1,511 @@
+import json
+import os
+from collections.abc import Mapping, MutableMapping
+from itertools import islice
+from typing import Iterable, Iterator, Union
+
+from .atomic import atomic_write
+from .trace import count, span
+
+BACKENDS: tuple = ('json', 'sqlite')
+
+_SQLITE_SCHEMA = '''
+CREATE TABLE meta (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE authors (
+    id INTEGER PRIMARY KEY,
+    email TEXT NOT NULL UNIQUE,
+    name TEXT
+);
+CREATE TABLE changes (
+    seq INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    token TEXT NOT NULL,
+    author_id INTEGER REFERENCES authors (id)
+);
+CREATE INDEX changes_author ON changes (author_id);
+CREATE TABLE tracked_files (
+    path TEXT PRIMARY KEY,
+    hash TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE file_changes (
+    path TEXT NOT NULL,
+    seq INTEGER NOT NULL REFERENCES changes (seq),
+    PRIMARY KEY (path, seq)
+) WITHOUT ROWID;
+'''
+
+# fields of `vestory.json` stored in their own tables
+_TABLE_FIELDS = ('tracking_files', 'changes', 'file_changes')
+
+
+def _read_token(token: str) -> dict:
+    # the content only indexes the change: the token
+    # is still verified when the change is decoded
+    from . import integrity
+    return integrity.decode_without_key(token) or {}
+
+
+class JSONStorage(object):
+    """Repository state in a single `vestory.json`.
+
+    The document is read once, on first access, and
+    written whole when saved, through a temporary file
+    flushed to the disk and renamed over the original.
+    """
+
+    name = 'json'
+
+    def __init__(self, repo_path: str) -> None:
+        self.path = os.path.join(repo_path, 'vestory.json')
+
+        self._config = None
+        self._dirty = False
+
+    @property
+    def config(self) -> dict:
+        if self._config is None:
+            with span('config.load'), open(self.path, 'r') as file_r:
+                self._config = json.load(file_r)
+                count('bytes.read', file_r.tell())
+
+        return self._config
+
+    def get(self, name: str, default=None):
+        return self.config.get(name, default)
+
+    def set(self, name: str, value) -> None:
+        self.config[name] = value
+        self._dirty = True
+
+    @property
+    def tracked_files(self) -> dict:
+        return self.config['tracking_files']
+
+    def set_tracked_files(self, files: dict) -> None:
+        self.set('tracking_files', files)
+
+    def set_file_hash(self, filepath: str, file_hash: str) -> None:
+        self.tracked_files[filepath] = file_hash
+        self._dirty = True
+
+    @property
+    def changes(self) -> dict:
+        return self.config['changes']
+
+    @property
+    def file_changes(self) -> Union[dict, None]:
+        return self.config.get('file_changes')
+
+    def set_file_changes(self, file_changes: dict) -> None:
+        self.set('file_changes', file_changes)
+
+    def add_change(self, change_id: str, change_token: str, files: Iterable[str]) -> None:
+        self.changes[change_id] = change_token
+
+        if self.file_changes is not None:
+            for filepath in files:
+                self.file_changes.setdefault(filepath, []).append(change_id)
+
+        self._dirty = True
+
+    def set_change_token(self, change_id: str, change_token: str) -> None:
+        self.changes[change_id] = change_token
+        self._dirty = True
+
+    def get_changes_from(self, position: int) -> list:
+        return list(islice(self.changes.items(), position, None))
+
+    def get_author_changes(self, author_email: str) -> None:
+        # without an index of authors, the
+        # caller searches the log
+        return None
+
+    def mark_dirty(self) -> None:
+        self._dirty = True
+
+    def create(self, config: dict) -> None:
+        self._config = config
+        self._dirty = True
+        self.save()
+
+    def export(self) -> dict:
+        return self.config
+
+    def save(self) -> bool:
+        if not self._dirty:
+            return False
+
+        with span('config.save'), atomic_write(self.path, sync=True) as file_w:
+            json.dump(self._config, file_w, ensure_ascii=False, indent=4)
+            count('bytes.written', file_w.tell())
+
+        self._dirty = False
+        return True
+
+    def discard(self) -> None:
+        self._dirty = False
+
+    def close(self) -> None:
+        pass
+
+    def remove(self) -> None:
+        os.remove(self.path)
+
+
+class _SQLiteChanges(MutableMapping):
+    # change ID to token, in the order of the changes;
+    # each access is a query on the indexed table
+
+    def __init__(self, storage: 'SQLiteStorage') -> None:
+        self._storage = storage
+
+    def __getitem__(self, change_id: str) -> str:
+        row = self._storage.execute('SELECT token FROM changes WHERE id = ?', (change_id,)).fetchone()
+
+        if row is None:
+            raise KeyError(change_id)
+
+        return row[0]
+
+    def __setitem__(self, change_id: str, change_token: str) -> None:
+        if change_id in self:
+            self._storage.set_change_token(change_id, change_token)
+        else:
+            self._storage.add_change(change_id, change_token, ())
+
+    def __delitem__(self, change_id: str) -> None:
+        if change_id not in self:
+            raise KeyError(change_id)
+
+        seq = self._storage.execute('SELECT seq FROM changes WHERE id = ?', (change_id,)).fetchone()[0]
+        self._storage.execute('DELETE FROM file_changes WHERE seq = ?', (seq,))
+        self._storage.execute('DELETE FROM changes WHERE seq = ?', (seq,))
+
+        # sequence numbers stay the positions of the changes
+        self._storage.execute('UPDATE changes SET seq = seq - 1 WHERE seq > ?', (seq,))
+        self._storage.execute('UPDATE file_changes SET seq = seq - 1 WHERE seq > ?', (seq,))
+
+    def __contains__(self, change_id: object) -> bool:
+        return self._storage.execute('SELECT 1 FROM changes WHERE id = ?',
+                                     (change_id,)).fetchone() is not None
+
+    def __iter__(self) -> Iterator[str]:
+        for row in self._storage.execute('SELECT id FROM changes ORDER BY seq'):
+            yield row[0]
+
+    def __reversed__(self) -> Iterator[str]:
+        for row in self._storage.execute('SELECT id FROM changes ORDER BY seq DESC'):
+            yield row[0]
+
+    def __len__(self) -> int:
+        return self._storage.execute('SELECT COUNT(*) FROM changes').fetchone()[0]
+
+    def items(self) -> list:
+        return self._storage.execute('SELECT id, token FROM changes ORDER BY seq').fetchall()
+
+    def values(self) -> list:
+        return [row[0] for row in self._storage.execute('SELECT token FROM changes ORDER BY seq')]
+
+
+class _SQLiteFileChanges(Mapping):
+    # file path to the IDs of its changes, in order
+
+    def __init__(self, storage: 'SQLiteStorage') -> None:
+        self._storage = storage
+
+    def __getitem__(self, filepath: str) -> list:
+        rows = self._storage.execute(
+            'SELECT changes.id FROM file_changes JOIN changes USING (seq) '
+            'WHERE file_changes.path = ? ORDER BY seq', (filepath,)
+        ).fetchall()
+
+        if not rows:
+            raise KeyError(filepath)
+
+        return [row[0] for row in rows]
+
+    def __contains__(self, filepath: object) -> bool:
+        return self._storage.execute('SELECT 1 FROM file_changes WHERE path = ? LIMIT 1',
+                                     (filepath,)).fetchone() is not None
+
+    def __iter__(self) -> Iterator[str]:
+        # in the order of the first change of each file
+        for row in self._storage.execute('SELECT path FROM file_changes '
+                                         'GROUP BY path ORDER BY MIN(seq)'):
+            yield row[0]
+
+    def __len__(self) -> int:
+        return self._storage.execute('SELECT COUNT(DISTINCT path) FROM file_changes').fetchone()[0]
+
+
+class SQLiteStorage(object):
+    """Repository state in a SQLite database,
+    `vestory.db`, in WAL mode.
+
+    Tracked files, changes, the changes of each file and
+    the authors are indexed tables, so a change, the
+    history of a file or the changes of an author are
+    found without reading the whole repository, and an
+    update writes only its rows. The other fields of
+    `vestory.json` (key, author, settings...) are rows
+    of the `meta` table, with JSON values.
+
+    Updates are kept in a transaction committed by
+    `save`, or rolled back by `discard`.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, repo_path: str) -> None:
+        self.path = os.path.join(repo_path, 'vestory.db')
+
+        self._connection = None
+        self._meta = None
+        self._tracked_files = None
+
+    def _connect(self, db_path: str):
+        import sqlite3
+
+        connection = sqlite3.connect(db_path)
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.execute('PRAGMA synchronous = FULL')
+
+        return connection
+
+    def execute(self, sql: str, parameters: tuple = ()):
+        if self._connection is None:
+            with span('config.load'):
+                if not os.path.isfile(self.path):
+                    raise FileNotFoundError(self.path)
+
+                self._connection = self._connect(self.path)
+
+        count('storage.queries')
+        return self._connection.execute(sql, parameters)
+
+    @property
+    def meta(self) -> dict:
+        if self._meta is None:
+            rows = self.execute('SELECT name, value FROM meta').fetchall()
+            self._meta = {name: json.loads(value) for name, value in rows}
+
+        return self._meta
+
+    def get(self, name: str, default=None):
+        return self.meta.get(name, default)
+
+    def set(self, name: str, value) -> None:
+        self.execute('INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)',
+                     (name, json.dumps(value, ensure_ascii=False)))
+        self.meta[name] = value
+
+    @property
+    def tracked_files(self) -> dict:
+        # "status" checks every tracked file,
+        # so the table is read at once
+        if self._tracked_files is None:
+            self._tracked_files = dict(self.execute('SELECT path, hash FROM tracked_files'))
+
+        return self._tracked_files
+
+    def set_tracked_files(self, files: dict) -> None:
+        files = dict(files)
+        tracked_files = self.tracked_files
+
+        # only the rows of removed, added and
+        # changed files are written
+        removed = [(filepath,) for filepath in tracked_files if filepath not in files]
+        changed = [(filepath, file_hash) for filepath, file_hash in files.items()
+                   if tracked_files.get(filepath) != file_hash]
+
+        self._connection.executemany('DELETE FROM tracked_files WHERE path = ?', removed)
+        self._connection.executemany('INSERT OR REPLACE INTO tracked_files (path, hash) VALUES (?, ?)',
+                                     changed)
+        self._tracked_files = files
+
+    def set_file_hash(self, filepath: str, file_hash: str) -> None:
+        self.execute('INSERT OR REPLACE INTO tracked_files (path, hash) VALUES (?, ?)',
+                     (filepath, file_hash))
+        self.tracked_files[filepath] = file_hash
+
+    @property
+    def changes(self) -> _SQLiteChanges:
+        return _SQLiteChanges(self)
+
+    @property
+    def file_changes(self) -> _SQLiteFileChanges:
+        return _SQLiteFileChanges(self)
+
+    def set_file_changes(self, file_changes: dict) -> None:
+        self.execute('DELETE FROM file_changes')
+
+        for filepath, change_ids in file_changes.items():
+            for change_id in change_ids:
+                self.execute('INSERT OR IGNORE INTO file_changes (path, seq) '
+                             'SELECT ?, seq FROM changes WHERE id = ?', (filepath, change_id))
+
+    def _get_author_id(self, author: Union[str, None], author_email: Union[str, None]) -> Union[int, None]:
+        if author_email is None:
+            return None
+
+        self.execute('INSERT OR IGNORE INTO authors (email, name) VALUES (?, ?)', (author_email, author))
+        return self.execute('SELECT id FROM authors WHERE email = ?', (author_email,)).fetchone()[0]
+
+    def add_change(self, change_id: str, change_token: str, files: Iterable[str]) -> None:
+        change_info = _read_token(change_token)
+        author_id = self._get_author_id(change_info.get('author'), change_info.get('author_email'))
+
+        seq = self.execute('INSERT INTO changes (id, token, author_id) VALUES (?, ?, ?)',
+                           (change_id, change_token, author_id)).lastrowid
+
+        self._connection.executemany('INSERT OR IGNORE INTO file_changes (path, seq) VALUES (?, ?)',
+                                     [(filepath, seq) for filepath in files])
+
+    def set_change_token(self, change_id: str, change_token: str) -> None:
+        self.execute('UPDATE changes SET token = ? WHERE id = ?', (change_token, change_id))
+
+    def get_changes_from(self, position: int) -> list:
+        # changes are numbered from 1 in the order of
+        # the history, so the range is read by the key
+        return self.execute('SELECT id, token FROM changes WHERE seq > ? ORDER BY seq',
+                            (position,)).fetchall()
+
+    def get_author_changes(self, author_email: str) -> list:
+        rows = self.execute(
+            'SELECT changes.id FROM changes JOIN authors ON authors.id = changes.author_id '
+            'WHERE authors.email = ? ORDER BY changes.seq', (author_email,)
+        )
+
+        return [row[0] for row in rows]
+
+    def mark_dirty(self) -> None:
+        # updates are written to the transaction directly
+        pass
+
+    def create(self, config: dict) -> None:
+        """Creates the database from the fields of
+        a `vestory.json` document."""
+
+        temp_path = f'{self.path}.tmp'
+
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(temp_path + suffix):
+                os.remove(temp_path + suffix)
+
+        self._connection = self._connect(temp_path)
+        self._connection.executescript(_SQLITE_SCHEMA)
+
+        file_changes = config.get('file_changes')
+
+        for name, value in config.items():
+            if name not in _TABLE_FIELDS:
+                self.set(name, value)
+
+        self.set_tracked_files(config['tracking_files'])
+
+        for change_id, change_token in config['changes'].items():
+            files = ()
+
+            # repositories without the index of file changes
+            # are indexed with the files of each token
+            if file_changes is None:
+                files = _read_token(change_token).get('changed_files', {})
+
+            self.add_change(change_id, change_token, files)
+
+        if file_changes is not None:
+            self.set_file_changes(file_changes)
+
+        self._connection.commit()
+        self.close()
+
+        os.replace(temp_path, self.path)
+
+    def export(self) -> dict:
+        config = dict(self.meta)
+        config['tracking_files'] = dict(self.tracked_files)
+        config['changes'] = dict(self.changes.items())
+
+        file_changes = {}
+
+        for filepath, change_id in self.execute('SELECT file_changes.path, changes.id FROM file_changes '
+                                                'JOIN changes USING (seq) ORDER BY seq'):
+            file_changes.setdefault(filepath, []).append(change_id)
+
+        config['file_changes'] = file_changes
+        return config
+
+    def save(self) -> bool:
+        if self._connection is None or not self._connection.in_transaction:
+            return False
+
+        with span('config.save'):
+            self._connection.commit()
+
+            # the changes reach the database file before the
+            # log is written, so a newer log is up to date
+            self._connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+        return True
+
+    def discard(self) -> None:
+        if self._connection is not None and self._connection.in_transaction:
+            self._connection.rollback()
+            self._meta = None
+            self._tracked_files = None
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+        self._meta = None
+        self._tracked_files = None
+
+    def remove(self) -> None:
+        self.close()
+
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+
+def make_storage(repo_path: str, backend: str) -> Union[JSONStorage, SQLiteStorage]:
+    """Creates the storage of a backend.
+
+    :param repo_path: Repository path.
+    :type repo_path: str
+    :param backend: "json" or "sqlite".
+    :type backend: str
+    :raises ValueError: If the backend is unknown.
+    :return: Returns the storage, not created yet.
+    :rtype: Union[JSONStorage, SQLiteStorage]
+    """
+
+    if backend == 'json':
+        return JSONStorage(repo_path)
+    elif backend == 'sqlite':
+        return SQLiteStorage(repo_path)
+
+    raise ValueError(f'Unknown storage "{backend}"')
+
+
+def open_storage(repo_path: str) -> Union[JSONStorage, SQLiteStorage]:
+    """Opens the storage of a repository: the SQLite
+    database if it exists, `vestory.json` otherwise.
+
+    :param repo_path: Repository path.
+    :type repo_path: str
+    :return: Returns the storage.
+    :rtype: Union[JSONStorage, SQLiteStorage]
+    """
+
+    # a conversion creates the database before
+    # removing `vestory.json`, so it wins
+    if os.path.isfile(os.path.join(repo_path, 'vestory.db')):
+        return SQLiteStorage(repo_path)
+
+    return JSONStorage(repo_path)
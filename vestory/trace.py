@@ -0,0 +1,146 @@
+# annotations are not evaluated, so the startup of
+# the CLI does not import `typing`
+from __future__ import annotations
+
+import os
+import sys
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+# "VESTORY_TRACE=1" prints a summary to stderr, any
+# other value is the path of a JSON file for the trace
+TRACE_ENV: str = 'VESTORY_TRACE'
+
+
+class Tracer(object):
+    """Collects timing spans and counters.
+
+    A span measures one phase of a command, such as
+    loading `vestory.json` or hashing a file. Counters
+    accumulate values, such as bytes read or tokens decoded.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.spans = []
+        self.counters = {}
+
+        self._start = time.perf_counter()
+        self._lock = None
+
+    def enable(self) -> None:
+        # threading is imported only when tracing
+        from threading import Lock
+
+        self.enabled = True
+        self._lock = Lock()
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[None]:
+        if not self.enabled:
+            yield None
+            return None
+
+        start = time.perf_counter()
+
+        try:
+            yield None
+        finally:
+            duration = time.perf_counter() - start
+            span = {
+                'name': name,
+                'start': start - self._start,
+                'duration': duration,
+                **attributes
+            }
+
+            with self._lock:
+                self.spans.append(span)
+
+    def count(self, name: str, value: int = 1) -> None:
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self) -> dict:
+        """Returns the total time, the number of spans and
+        the maximum duration of each span name."""
+
+        phases = {}
+
+        for span in self.spans:
+            phase = phases.setdefault(span['name'], {'count': 0, 'total': 0.0, 'max': 0.0})
+            phase['count'] += 1
+            phase['total'] += span['duration']
+            phase['max'] = max(phase['max'], span['duration'])
+
+        return phases
+
+    def to_dict(self) -> dict:
+        return {
+            'duration': time.perf_counter() - self._start,
+            'summary': self.summary(),
+            'counters': self.counters,
+            'spans': self.spans
+        }
+
+    def print_summary(self, file=sys.stderr) -> None:
+        print(f'\n{"phase":<24} {"count":>8} {"total (ms)":>12} {"max (ms)":>10}', file=file)
+
+        phases = sorted(self.summary().items(), key=lambda item: -item[1]['total'])
+
+        for name, phase in phases:
+            print(f'{name:<24} {phase["count"]:>8} '
+                  f'{phase["total"] * 1000:>12.2f} {phase["max"] * 1000:>10.2f}', file=file)
+
+        for name, value in sorted(self.counters.items()):
+            print(f'{name:<24} {value:>8}', file=file)
+
+        total = (time.perf_counter() - self._start) * 1000
+        print(f'{"total":<24} {"":>8} {total:>12.2f}', file=file)
+
+    def save(self, trace_path: str) -> None:
+        import json
+
+        with open(trace_path, 'w') as file_w:
+            json.dump(self.to_dict(), file_w, indent=2)
+
+
+tracer = Tracer()
+span = tracer.span
+count = tracer.count
+
+
+def setup_from_env() -> str | None:
+    """Enables the tracer if `VESTORY_TRACE` is set.
+
+    :return: Returns the value of `VESTORY_TRACE`.
+    :rtype: Union[str, None]
+    """
+
+    trace_value = os.getenv(TRACE_ENV)
+
+    if trace_value:
+        tracer.enable()
+
+    return trace_value
+
+
+def report(trace_value: str | None) -> None:
+    """Prints the summary of the trace or saves it
+    as JSON, according to `VESTORY_TRACE` or `--profile`.
+
+    :param trace_value: "1" to print the summary, or the
+    path of the JSON file.
+    :type trace_value: Union[str, None]
+    """
+
+    if not tracer.enabled:
+        return None
+
+    if trace_value and trace_value not in ('1', 'true', 'yes'):
+        tracer.save(trace_value)
+    else:
+        tracer.print_summary()
@@ -0,0 +1,242 @@
+import json
+import os
+from typing import Iterable, Union
+
+from . import hashing, integrity
+from .diff import apply_change, decode_delta
+from .objects import ObjectStore
+from .trace import span
+from .workers import split_tasks
+
+
+def verify_tokens(key: str, author_email: str, changes: list) -> list:
+    """Verifies change tokens with the repository key,
+    as `integrity.decode_change` does.
+
+    :param key: Repository key.
+    :type key: str
+    :param author_email: Email of the repository author.
+    :type author_email: str
+    :param changes: List of (change ID, token).
+    :type changes: list
+    :return: Returns a list of (change ID, decoded change),
+    with False as the change of invalid tokens.
+    :rtype: list
+    """
+
+    return [(change_id, integrity.decode_change(token, key, author_email)[0])
+            for change_id, token in changes]
+
+
+def _hash_chunks(chunks: Iterable[bytes], format_version: int) -> str:
+    if format_version < 2:
+        from hashlib import md5
+        content_hash = md5()
+    else:
+        content_hash = hashing.new_hash()
+
+    for chunk in chunks:
+        content_hash.update(chunk)
+
+    return content_hash.hexdigest()
+
+
+def _hash_content(content: bytes, format_version: int) -> str:
+    return _hash_chunks([content], format_version)
+
+
+def _hash_lines(lines: list, format_version: int) -> str:
+    if format_version < 2:
+        enumerated = {str(i): line for i, line in enumerate(lines)}
+        return hashing.legacy_hash_bytes(json.dumps(enumerated).encode())
+
+    return hashing.hash_bytes(''.join(lines).encode())
+
+
+def verify_file(objects_path: str, filepath: str, changes: list) -> list:
+    """Replays the changes of a file and compares each
+    version with the hash stored in its change.
+
+    :param objects_path: Path of the object store.
+    :type objects_path: str
+    :param filepath: File path.
+    :type filepath: str
+    :param changes: List of (change ID, file info, format
+    version of the change) in the order of the history, with
+    None as the file info of changes with an invalid token.
+    :type changes: list
+    :return: Returns a list of (change ID, problem).
+    :rtype: list
+    """
+
+    import zlib
+    from base64 import b64decode
+
+    objects = ObjectStore(objects_path)
+    problems = []
+    lines = []
+    # after a missing or invalid change, the versions
+    # can be verified again only from the next snapshot
+    broken = False
+
+    for change_id, file_info, format_version in changes:
+        if file_info is None:
+            broken = True
+            continue
+
+        if file_info.get('snapshot'):
+            lines = []
+            broken = False
+        elif broken:
+            continue
+
+        try:
+            if file_info.get('binary') and file_info.get('object'):
+                # binary and large files are hashed in parts
+                chunks = objects.iter_chunks(file_info['object'])
+                file_hash = _hash_chunks(chunks, format_version)
+            elif file_info.get('object'):
+                content = objects.get(file_info['object'])
+            else:
+                content = b64decode(file_info['content'])
+        except (OSError, ValueError, KeyError, zlib.error) as error:
+            problems.append((change_id, f'{filepath}: content not readable ({error})'))
+            broken = True
+            continue
+
+        if file_info.get('binary'):
+            if not file_info.get('object'):
+                file_hash = _hash_content(content, format_version)
+        else:
+            try:
+                delta = decode_delta(content)
+            except ValueError:
+                delta = None
+
+            if delta is None and format_version < 2:
+                # binary files submitted before the "binary"
+                # flag are stored as their raw content
+                file_hash = _hash_content(content, format_version)
+            else:
+                try:
+                    lines = apply_change(lines, delta)
+                except (AttributeError, TypeError, ValueError, IndexError):
+                    problems.append((change_id, f'{filepath}: corrupt content'))
+                    broken = True
+                    continue
+
+                file_hash = _hash_lines(lines, format_version)
+
+        if file_hash != file_info.get('hash'):
+            problems.append((change_id, f'{filepath}: hash does not match the content'))
+
+    return problems
+
+
+def _verify_files(objects_path: str, files: list) -> list:
+    problems = []
+
+    for filepath, changes in files:
+        problems.extend(verify_file(objects_path, filepath, changes))
+
+    return problems
+
+
+def check(
+    key: str,
+    author_email: str,
+    objects_path: str,
+    changes: list,
+    full: bool = True,
+    jobs: Union[int, None] = None,
+    checkpoint: Union[dict, None] = None
+) -> list:
+    """Verifies the history of a repository.
+
+    The tokens, and in full mode the content of every
+    version of every file, are verified in a pool of
+    processes.
+
+    :param key: Repository key.
+    :type key: str
+    :param author_email: Email of the repository author,
+    whose changes must be verified by the key.
+    :type author_email: str
+    :param objects_path: Path of the object store.
+    :type objects_path: str
+    :param changes: List of (change ID, token), in order.
+    :type changes: list
+    :param full: Replay the changes of each file and
+    verify their hashes, defaults to True
+    :type full: bool, optional
+    :param jobs: Number of worker processes, defaults
+    to the number of CPUs.
+    :type jobs: Union[int, None], optional
+    :param checkpoint: Decoded checkpoint of the history,
+    defaults to None
+    :type checkpoint: Union[dict, None], optional
+    :return: Returns a list of (change ID, problem), in
+    the order of the history.
+    :rtype: list
+    """
+
+    jobs = jobs or os.cpu_count() or 1
+
+    if jobs == 1:
+        executor = None
+        map_tasks = map
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        map_tasks = executor.map
+
+    try:
+        with span('fsck.tokens'):
+            decoded = []
+            token_chunks = split_tasks(changes, jobs)
+
+            keys = [key] * len(token_chunks)
+            emails = [author_email] * len(token_chunks)
+
+            for result in map_tasks(verify_tokens, keys, emails, token_chunks):
+                decoded.extend(result)
+
+        problems = [(change_id, 'invalid token') for change_id, info in decoded if not info]
+        tokens = dict(changes)
+
+        # removed or reordered changes break the chain
+        chain = [(change_id, tokens[change_id], info) for change_id, info in decoded]
+        problems.extend(integrity.check_chain(chain, checkpoint))
+
+        if full:
+            files = {}
+
+            for change_id, change_info in decoded:
+                if change_info:
+                    format_version = change_info.get('format_version', 1)
+
+                    for filepath, file_info in change_info['changed_files'].items():
+                        files.setdefault(filepath, []).append((change_id, file_info, format_version))
+                else:
+                    # the payload of an invalid change is not trusted,
+                    # its paths only stop the replay of those files
+                    unverified = integrity.decode_without_key(tokens[change_id]) or {}
+
+                    for filepath in unverified.get('changed_files', {}):
+                        files.setdefault(filepath, []).append((change_id, None, None))
+
+            with span('fsck.files'):
+                file_chunks = split_tasks(list(files.items()), jobs)
+                paths = [objects_path] * len(file_chunks)
+
+                for result in map_tasks(_verify_files, paths, file_chunks):
+                    problems.extend(result)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    order = {change_id: i for i, (change_id, __) in enumerate(changes)}
+    problems.sort(key=lambda problem: order.get(problem[0], -1))
+
+    return problems
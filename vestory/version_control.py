@@ -1,24 +1,152 @@
-import json
 import os
-from base64 import b64decode, b64encode
-from datetime import datetime
-from hashlib import md5
-from os import getcwd, mkdir, path
-from random import choice
-from string import ascii_letters, digits
-from typing import Final, Union
+from contextlib import contextmanager
+from os import getcwd, path
+from typing import TYPE_CHECKING, Iterable, Iterator, Union
+
+from . import hashing, integrity
+from .atomic import atomic_write
+from .exceptions import (InvalidChangeError, LockTimeoutError, RepoFormatError,
+                         RepoNotExistsError)
+from .trace import count, span
+
+if TYPE_CHECKING:
+    from .heads import HeadCache
+    from .ignore import IgnoreMatcher
+    from .repository import Repository
+
+_session: Union['Repository', None] = None
+_ignore_matcher: Union[tuple, None] = None
+
+# names of other modules exported by this module,
+# imported on the first use to keep the startup fast
+_LAZY_NAMES = {
+    'apply_change': 'diff',
+    'apply_hunks': 'diff',
+    'decode_delta': 'diff',
+    'diff_lines': 'diff',
+    'encode_delta': 'diff',
+    'HeadCache': 'heads',
+    'IgnoreMatcher': 'ignore',
+    'walk_files': 'ignore',
+    'make_entry': 'log',
+    'DEFAULT_SETTINGS': 'repository',
+    'FORMAT_VERSION': 'repository',
+    'Repository': 'repository'
+}
+
+
+def get_repo_path() -> str:
+    """Gets the path of the `.vestory` directory.
+
+    The path is resolved on each call, so importing
+    Vestory does not depend on the current directory.
+
+    :return: Returns the repository path.
+    :rtype: str
+    """
+
+    return path.join(getcwd(), '.vestory')
+
+
+def _get_ignoreme_path() -> str:
+    return path.join(getcwd(), '.ignoreme')
+
+
+def __getattr__(name: str):
+    # paths that were constants computed on import
+    if name == 'LOCAL':
+        return getcwd()
+    elif name == 'REPO_PATH':
+        return get_repo_path()
+    elif name == 'VESTORY_FILE':
+        return path.join(get_repo_path(), 'vestory.json')
+    elif name == 'IGNOREME_PATH':
+        return _get_ignoreme_path()
+    elif name in _LAZY_NAMES:
+        from importlib import import_module
+
+        module = import_module(f'.{_LAZY_NAMES[name]}', __package__)
+        return getattr(module, name)
+
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__() -> list:
+    return sorted(set(globals()) | set(_LAZY_NAMES))
+
+
+@contextmanager
+def open_repository(
+    exclusive: bool = True,
+    timeout: Union[float, None] = None
+) -> Iterator['Repository']:
+    """Opens a repository session.
+
+    Inside the session, every function of this module
+    shares the same in-memory repository, so
+    `vestory.json` is read once and written once,
+    when the session ends without errors.
+
+    The session holds the lock of the repository: an
+    exclusive lock to change it, or a shared lock to
+    read it along with other readers. Nested sessions
+    use the lock of the outer session.
+
+    :param exclusive: Take an exclusive lock, defaults
+    to True
+    :type exclusive: bool, optional
+    :param timeout: Seconds to wait for the lock,
+    defaults to `lock.DEFAULT_TIMEOUT`.
+    :type timeout: Union[float, None], optional
+    :raises LockTimeoutError: If the repository is locked
+    by another process after the timeout.
+    :return: Returns the repository of the session.
+    :rtype: Iterator[Repository]
+    """
+
+    from .repository import Repository
+
+    global _session
+
+    if _session is not None:
+        # a shared lock cannot be upgraded without
+        # letting another writer in between
+        if exclusive and _session.lock.shared:
+            raise RuntimeError('Repository opened for reading, '
+                               'use "open_repository()" to change it')
+
+        yield _session
+        return None
+
+    _session = Repository(get_repo_path())
+
+    try:
+        # repositories are locked before `vestory.json`
+        # is read, except while they are created
+        if check_repo_exists():
+            _session.lock.acquire(exclusive, timeout)
+
+        yield _session
+        _session.save()
+    finally:
+        _session.close()
+        _session.lock.release()
+        _session = None
+
 
-from . import integrity
-from .exceptions import InvalidChangeError, RepoNotExistsError
+def _get_repository() -> 'Repository':
+    if _session is not None:
+        return _session
 
-LOCAL: Final = getcwd()
+    from .repository import Repository
 
-REPO_PATH: Final = path.join(LOCAL, '.vestory')
-VESTORY_FILE: Final = path.join(REPO_PATH, 'vestory.json')
-IGNOREME_PATH: Final = path.join(LOCAL, '.ignoreme')
+    return Repository(get_repo_path())
 
 
 def _generate_id() -> str:
+    from random import choice
+    from string import ascii_letters, digits
+
     char = ascii_letters + digits
     return ''.join([choice(char) for __ in range(32)])
 
@@ -30,27 +158,34 @@ def get_files_tracked() -> dict:
     :rtype: dict
     """
 
-    with open(VESTORY_FILE, 'r') as file_r:
-        vestory_config = json.load(file_r)
+    return _get_repository().tracked_files
 
-    return vestory_config['tracking_files']
 
+def get_ignore_matcher() -> 'IgnoreMatcher':
+    """Gets the compiled rules of `.ignoreme`.
 
-def _get_files_to_ignore() -> list:
-    if not os.path.isfile(IGNOREME_PATH):
-        return []
+    The file is parsed again only when it changes.
 
-    ignored_files = []
-    with open(IGNOREME_PATH) as file_r:
-        content = file_r.readlines()
+    :return: Returns the ignore matcher.
+    :rtype: IgnoreMatcher
+    """
 
-    for file in content:
-        file = file.replace('\n', '')
-        if not file.startswith('./'):
-            file = os.path.join('./', file)
-        ignored_files.append(file)
+    from .ignore import IgnoreMatcher
 
-    return ignored_files
+    global _ignore_matcher
+
+    ignoreme_path = _get_ignoreme_path()
+
+    try:
+        ignoreme_stat = os.stat(ignoreme_path)
+        stat_key = (ignoreme_stat.st_size, ignoreme_stat.st_mtime_ns)
+    except FileNotFoundError:
+        stat_key = None
+
+    if _ignore_matcher is None or _ignore_matcher[0] != stat_key:
+        _ignore_matcher = (stat_key, IgnoreMatcher.from_file(ignoreme_path))
+
+    return _ignore_matcher[1]
 
 
 def check_ignored(dir_or_file: str) -> bool:
@@ -62,28 +197,29 @@ def check_ignored(dir_or_file: str) -> bool:
     :rtype: bool
     """
 
-    ignored_files = _get_files_to_ignore()
+    return get_ignore_matcher().is_ignored(dir_or_file, path.isdir(dir_or_file))
 
-    if dir_or_file in ignored_files:
-        return True
-    else:
-        for file in ignored_files:
-            if file in dir_or_file:
-                return True
 
+def get_all_files() -> list:
+    """Gets all files of the working directory, except
+    ignored files and the `.vestory` directory.
 
-def _update_tracked_files(files: dict) -> None:
-    with open(VESTORY_FILE, 'r') as file_r:
-        vestory_config = json.load(file_r)
+    :return: Returns a list of files.
+    :rtype: list
+    """
+
+    from .ignore import walk_files
 
-    vestory_config['tracking_files'] = files
+    return list(walk_files('./', get_ignore_matcher()))
 
-    with open(VESTORY_FILE, 'w') as file_w:
-        json.dump(vestory_config, file_w, indent=4)
+
+def _update_tracked_files(files: dict) -> None:
+    with open_repository() as repo:
+        repo.set_tracked_files(files)
 
 
 def check_repo_exists() -> bool:
-    return path.isdir(REPO_PATH)
+    return path.isdir(get_repo_path())
 
 
 def _enumerate_lines(lines: list) -> dict:
@@ -97,14 +233,18 @@ def _enumerate_lines(lines: list) -> dict:
     return result
 
 
-def _update_file_hash(filename: str, new_hash: str) -> None:
-    with open(VESTORY_FILE, 'r') as file_r:
-        vestory_config = json.load(file_r)
+def _check_format(repo: 'Repository') -> None:
+    from .repository import FORMAT_VERSION
+
+    # hashes of older formats are not comparable
+    # with the hashes computed now
+    if repo.format_version < FORMAT_VERSION:
+        raise RepoFormatError(f'Repository format {repo.format_version} is outdated, '
+                              'use "vestory migrate" to upgrade it')
 
-    vestory_config['tracking_files'][filename] = new_hash
 
-    with open(VESTORY_FILE, 'w') as file_w:
-        json.dump(vestory_config, file_w, indent=4)
+def _update_file_hash(repo: 'Repository', filename: str, new_hash: str) -> None:
+    repo.set_file_hash(filename, new_hash)
 
 
 def decode_change(change_token: str) -> Union[bool, dict]:
@@ -120,31 +260,25 @@ def decode_change(change_token: str) -> Union[bool, dict]:
     :rtype: Union[bool, dict]
     """
     
-    change_info = integrity.decode_without_key(change_token)
-    author, author_email = get_author_info()
-    repo_key = get_repo_key()
-
-    if change_info['author_email'] == author_email:
-        change_info = integrity.decode_token(change_token, repo_key)
-        if not change_info:
-            return False
+    repo = _get_repository()
+    change_info = repo.change_cache.get(change_token)
 
-    return change_info
+    if change_info is not None:
+        count('tokens.cached')
+        return change_info
 
+    change_info, verified = integrity.decode_change(change_token, repo.key, repo.author_email)
 
-def _is_binary(filepath: str) -> bool:
-    try:
-        with open(filepath, 'r') as file_r:
-            file_r.read(1024)
-    except UnicodeDecodeError:
-        return True
+    if not change_info:
+        return False
 
-    return False
+    repo.change_cache.set(change_token, change_info, verified=verified)
+    return change_info
 
 
 def check_file_has_changed(filename: str) -> bool:
     """Checks if the file has been changed.
-    Checking works through the use of MD5 hash.
+    Checking works through the use of BLAKE2b hash.
 
     :param filename: Name of the file to be checked.
     :type filename: str
@@ -156,59 +290,106 @@ def check_file_has_changed(filename: str) -> bool:
     if not check_repo_exists():
         raise RepoNotExistsError('Repositório não encontrado')
 
-    tracked_files = get_files_tracked()
+    # only the stat index is written when checking
+    with open_repository(exclusive=False) as repo:
+        return _check_file_has_changed(repo, filename)
 
-    if filename in tracked_files:
-        previous_hash = tracked_files.get(filename) 
 
-        if _is_binary(filename):
-            with open(filename, 'rb') as file_r:
-                file_content = file_r.read()
+def _check_file_has_changed(repo: 'Repository', filename: str) -> bool:
+    return bool(_check_files_changed(repo, [filename]))
 
-            hash_content = md5(file_content).hexdigest()
-        else:
-            with open(filename, 'r') as file_r:
-                file_lines = file_r.readlines()
 
-                enum_lines = _enumerate_lines(file_lines)
-                enum_lines_str = json.dumps(enum_lines)
-                hash_content = md5(enum_lines_str.encode()).hexdigest()
+def _check_files_changed(
+    repo: 'Repository',
+    files: list,
+    jobs: Union[int, None] = None
+) -> list:
+    _check_format(repo)
 
-        return hash_content != previous_hash
-    else:
-        return False
+    tracked_files = repo.tracked_files
+    files_hash = {}
+    files_stat = {}
+
+    for filepath in files:
+        if filepath in tracked_files:
+            # files with the same stat of the last
+            # check are not read again
+            file_stat = os.stat(filepath)
+            files_hash[filepath] = repo.index.get_hash(filepath, file_stat)
+            files_stat[filepath] = file_stat
+
+    to_hash = [file for file, file_hash in files_hash.items() if file_hash is None]
+
+    for filepath, file_hash in hashing.hash_files(to_hash, jobs).items():
+        files_hash[filepath] = file_hash
+        repo.index.update(filepath, files_stat[filepath], file_hash)
 
+    changed_files = []
+    file_changes = repo.file_changes
+
+    for filepath, file_hash in files_hash.items():
+        # files without changes in the history are new,
+        # even with the same hash recorded by "add"
+        if file_hash != tracked_files[filepath] or (file_changes is not None and filepath not in file_changes):
+            changed_files.append(filepath)
 
-def get_files_changed() -> list:
+    return changed_files
+
+
+def get_files_changed(jobs: Union[int, None] = None) -> list:
     """Get all changed files.
 
+    :param jobs: Number of hashing workers, defaults
+    to the number of CPUs.
+    :type jobs: Union[int, None], optional
     :return: Returns a list of files that have changed.
     :rtype: list
     """
 
-    tracked_files = get_files_tracked()
-    changed_files = []
+    from . import watch
 
-    for filepath in tracked_files.keys():
-        has_changed = check_file_has_changed(filepath)
-        if has_changed:
-            changed_files.append(filepath)
+    if not check_repo_exists():
+        raise RepoNotExistsError('Repositório não encontrado')
+
+    with open_repository(exclusive=False) as repo:
+        tracked_files = repo.tracked_files
+
+        # with the watch daemon running, only the files
+        # touched since the last check are checked again
+        candidates = watch.get_candidates(repo.repo_path)
+
+        if candidates is None:
+            files = list(tracked_files)
+        else:
+            files = [file for file in candidates if file in tracked_files]
+
+        changed_files = _check_files_changed(repo, files, jobs)
+
+        if candidates is not None:
+            changed = set(changed_files)
+            unchanged = {file: candidates[file] for file in files if file not in changed}
+            watch.prune(repo.repo_path, unchanged)
 
     return changed_files
 
 
-def init_repo(author: str, author_email: str) -> bool:
+def init_repo(author: str, author_email: str, storage: str = 'json') -> bool:
     """Initializes an empty repository.
 
     :param local: Repository location.
     :type local: str
+    :param storage: Storage of the repository, "json"
+    or "sqlite", defaults to "json"
+    :type storage: str, optional
     """
 
+    from .repository import FORMAT_VERSION, Repository
+
     if check_repo_exists():
         return False
 
-    # criando diretório ".vestory"
-    mkdir(REPO_PATH)
+    from datetime import datetime
+
     init_date = str(datetime.now())
 
     repo_config = {
@@ -216,46 +397,51 @@ def init_repo(author: str, author_email: str) -> bool:
         'author_email': author_email,
         'key': _generate_id(),
         'init_date': init_date,
+        'format_version': FORMAT_VERSION,
         'tracking_files': dict(),
-        'changes': dict()
+        'changes': dict(),
+        'file_changes': dict()
     }
 
-    # salvando configurações    
-    with open(VESTORY_FILE, 'w') as file_w:
-        json.dump(repo_config, file_w, indent=4)
+    # criando diretório ".vestory" e
+    # salvando configurações
+    Repository(get_repo_path()).init(repo_config, storage)
 
     return True
 
 
-def add_files(files: list) -> None:
+def add_files(files: list, jobs: Union[int, None] = None) -> None:
     """Add the files the trace tree.
 
     :param files: Files to add.
     :type files: list
+    :param jobs: Number of hashing workers, defaults
+    to the number of CPUs.
+    :type jobs: Union[int, None], optional
     """
 
     if not check_repo_exists():
         raise RepoNotExistsError('Repositório não encontrado')
     
-    tracked_files = get_files_tracked()
-    to_add = dict()
+    with open_repository() as repo:
+        _check_format(repo)
 
-    for file in files:
-        if file not in tracked_files and not check_ignored(file):
-            if not file.startswith('./'):
-                file = os.path.join('./', file)
+        tracked_files = repo.tracked_files
+        to_hash = []
 
-            if path.isfile(file):
-                with open(file, 'rb') as file_r:
-                    file_content = file_r.read()
+        for file in files:
+            if file not in tracked_files and not check_ignored(file):
+                if not file.startswith('./'):
+                    file = os.path.join('./', file)
 
-                content_hash = md5(file_content).hexdigest()
-                to_add[file] = content_hash
-            else:
-                print(f'error: "{file}" não encontrado')
+                if path.isfile(file):
+                    to_hash.append(file)
+                else:
+                    print(f'error: "{file}" não encontrado')
 
-    tracked_files.update(to_add)
-    _update_tracked_files(tracked_files)
+        # only the new files are written to the storage
+        for filepath, file_hash in hashing.hash_files(to_hash, jobs).items():
+            repo.set_file_hash(filepath, file_hash)
 
 
 def get_author_info() -> tuple:    
@@ -266,17 +452,44 @@ def get_author_info() -> tuple:
     :rtype: tuple
     """
 
-    with open(VESTORY_FILE, 'r') as file_r:
-        config = json.load(file_r)
-
-    return (config['author'], config['author_email'])
+    repo = _get_repository()
+    return (repo.author, repo.author_email)
 
 
 def get_repo_key() -> str:
-    with open(VESTORY_FILE, 'r') as file_r:
-        config = json.load(file_r)
+    return _get_repository().key
+
+
+def get_repo_setting(name: str):
+    """Gets a setting of the repository.
+
+    :param name: Setting name.
+    :type name: str
+    :raises KeyError: If the setting does not exist.
+    :return: Returns the setting value.
+    """
+
+    return _get_repository().get_setting(name)
+
+
+def set_repo_setting(name: str, value) -> None:
+    """Changes a setting of the repository.
+
+    :param name: Setting name.
+    :type name: str
+    :param value: Setting value.
+    :raises KeyError: If the setting does not exist.
+    :raises ValueError: If the value is not valid
+    for the setting.
+    """
+
+    from .repository import DEFAULT_SETTINGS
 
-    return config['key']
+    if name not in DEFAULT_SETTINGS:
+        raise KeyError(name)
+
+    with open_repository() as repo:
+        repo.set_setting(name, value)
 
 
 def get_file_changes(_filepath: str) -> list:
@@ -289,19 +502,92 @@ def get_file_changes(_filepath: str) -> list:
     :rtype: list
     """
 
-    file_changes = []
-    changes = get_changes()
-    
-    for change_id, token in changes.items():
-        change_info = decode_change(token)
+    with open_repository(exclusive=False) as repo:
+        return list(_iter_file_changes(repo, _filepath))
+
+
+def get_file_delta_chain(_filepath: str) -> list:
+    """Get the changes needed to rebuild a file: the
+    last full snapshot of the file and the changes
+    made after it.
+
+    :param _filepath: Filepath
+    :type _filepath: str
+    :raises InvalidChangeError: If change validation fails.
+    :return: Returns a list of file changes.
+    :rtype: list
+    """
+
+    with open_repository(exclusive=False) as repo:
+        return _get_file_delta_chain(repo, _filepath)
+
+
+def _iter_file_changes(
+    repo: 'Repository',
+    filepath: str,
+    reverse: bool = False
+) -> Iterator[tuple]:
+    if repo.file_changes is None:
+        _rebuild_file_index(repo)
+
+    change_ids = repo.file_changes.get(filepath, [])
+
+    if reverse:
+        change_ids = reversed(change_ids)
+
+    for change_id in change_ids:
+        change_token = repo.changes.get(change_id)
+        change_info = change_token and decode_change(change_token)
+
         if change_info:
-            for filepath, fileinfo in change_info['changed_files'].items():
-                if filepath == _filepath:
-                    file_changes.append((change_id, fileinfo))
+            yield (change_id, change_info['changed_files'][filepath])
         else:
             raise InvalidChangeError(f'Change "{change_id}" invalid')
 
-    return file_changes
+
+def _get_file_delta_chain(repo: 'Repository', filepath: str) -> list:
+    delta_chain = []
+
+    # changes made before the snapshots have
+    # no "snapshot" flag, so the chain goes back
+    # to the first change of the file
+    for file_change in _iter_file_changes(repo, filepath, reverse=True):
+        delta_chain.append(file_change)
+
+        if file_change[1].get('snapshot'):
+            break
+
+    delta_chain.reverse()
+    return delta_chain
+
+
+def _rebuild_file_index(repo: 'Repository') -> None:
+    file_changes = {}
+
+    for change_id, token in repo.changes.items():
+        change_info = decode_change(token)
+        if not change_info:
+            raise InvalidChangeError(f'Change "{change_id}" invalid')
+
+        for filepath in change_info['changed_files'].keys():
+            file_changes.setdefault(filepath, []).append(change_id)
+
+    repo.set_file_changes(file_changes)
+
+
+def rebuild_file_index() -> None:
+    """Rebuilds the index of changes of each
+    file from all changes of the repository.
+
+    :raises RepoNotExistsError: non-existent repository
+    :raises InvalidChangeError: If change validation fails.
+    """
+
+    if not check_repo_exists():
+        raise RepoNotExistsError('Repositório não encontrado')
+
+    with open_repository() as repo:
+        _rebuild_file_index(repo)
 
 
 def get_change_info_by_id(change_id: str) -> dict:
@@ -314,9 +600,10 @@ def get_change_info_by_id(change_id: str) -> dict:
     :rtype: Union[dict, None]
     """
 
-    all_changes = get_changes()
-    change_token = all_changes.get(change_id)
-    change_info = decode_change(change_token)
+    with open_repository(exclusive=False):
+        all_changes = get_changes()
+        change_token = all_changes.get(change_id)
+        change_info = decode_change(change_token)
 
     if not change_info:
         raise InvalidChangeError(f'Change "{change_id}" invalid')
@@ -331,11 +618,7 @@ def get_changes() -> dict:
     :rtype: dict
     """
 
-    with open(VESTORY_FILE, 'r') as file_r:
-        vestory_config = json.load(file_r)
-
-    changes = vestory_config.get('changes')
-    return changes
+    return _get_repository().changes
 
 
 def get_changes_by_author(author_email: str) -> dict:
@@ -348,66 +631,317 @@ def get_changes_by_author(author_email: str) -> dict:
     :rtype: dict
     """
 
-    all_changes = get_changes()
     all_changes_decoded = []
 
-    for change_id, change_token in all_changes.items():
-        change_info = decode_change(change_token)
-        if change_info:
-            if author_email == change_info['author_email']:
+    with open_repository(exclusive=False) as repo:
+        # only the changes of the author are decoded,
+        # found by the index of authors of the storage
+        # or by the log
+        change_ids = repo.get_author_changes(author_email)
+
+        if change_ids is None:
+            change_ids = [entry['id'] for entry in _iter_log(repo, reverse=False)
+                          if entry['author_email'] == author_email]
+
+        for change_id in change_ids:
+            change_info = decode_change(repo.changes[change_id])
+            if change_info and change_info['author_email'] == author_email:
                 all_changes_decoded.append(change_info)
-        else:
-            raise InvalidChangeError(f'Change "{change_id}" invalid')
+            else:
+                raise InvalidChangeError(f'Change "{change_id}" invalid')
 
     return all_changes_decoded
 
 
+def _rebuild_log(repo: 'Repository') -> None:
+    from .log import make_entry
+
+    entries = []
+
+    for change_id, token in repo.changes.items():
+        change_info = decode_change(token)
+        if not change_info:
+            raise InvalidChangeError(f'Change "{change_id}" invalid')
+
+        entries.append(make_entry(change_id, change_info))
+
+    repo.log.rebuild(entries)
+
+
+def rebuild_log() -> None:
+    """Rebuilds the metadata index of the
+    changes (`.vestory/log`).
+
+    :raises RepoNotExistsError: non-existent repository
+    :raises InvalidChangeError: If change validation fails.
+    """
+
+    if not check_repo_exists():
+        raise RepoNotExistsError('Repositório não encontrado')
+
+    with open_repository() as repo:
+        _rebuild_log(repo)
+
+
+def _iter_log(repo: 'Repository', reverse: bool = True) -> Iterator[dict]:
+    # a log older than `vestory.json` misses changes
+    # and is rebuilt from the verified tokens
+    if repo.log.is_stale(repo.vestory_file):
+        _rebuild_log(repo)
+
+    return repo.log.iter_entries(reverse)
+
+
+def _match_log_entry(
+    entry: dict,
+    author: Union[str, None],
+    since: Union[str, None],
+    until: Union[str, None],
+    paths: Union[list, None]
+) -> bool:
+    if author is not None:
+        entry_author = f'{entry["author"]} <{entry["author_email"]}>'
+        if author.lower() not in entry_author.lower():
+            return False
+
+    # dates are compared as strings, so "2022-01-01"
+    # includes every change of that day
+    date = entry['date'] or ''
+
+    if since is not None and date[:len(since)] < since:
+        return False
+
+    if until is not None and date[:len(until)] > until:
+        return False
+
+    if paths and not any(_match_paths(filepath, paths) for filepath in entry['files']):
+        return False
+
+    return True
+
+
+def get_log(
+    limit: Union[int, None] = None,
+    author: Union[str, None] = None,
+    since: Union[str, None] = None,
+    until: Union[str, None] = None,
+    paths: Union[list, None] = None
+) -> Iterator[dict]:
+    """Yields the metadata of the changes, last
+    changes first, from the log of the repository.
+
+    Only the entries needed are read, so the last
+    changes are found in constant time.
+
+    :param limit: Maximum number of changes, defaults to None
+    :type limit: Union[int, None], optional
+    :param author: Part of the author name or email, defaults to None
+    :type author: Union[str, None], optional
+    :param since: First date (such as "2022-01-31"), defaults to None
+    :type since: Union[str, None], optional
+    :param until: Last date, defaults to None
+    :type until: Union[str, None], optional
+    :param paths: Files or directories changed, defaults to None
+    :type paths: Union[list, None], optional
+    :raises RepoNotExistsError: non-existent repository
+    :raises InvalidChangeError: If the log is rebuilt and
+    change validation fails.
+    :return: Returns an iterator of dicts with the ID, date,
+    author, author email, comment and files of each change.
+    :rtype: Iterator[dict]
+    """
+
+    if not check_repo_exists():
+        raise RepoNotExistsError('Repositório não encontrado')
+
+    if limit is not None and limit < 1:
+        return None
+
+    found = 0
+
+    with open_repository(exclusive=False) as repo:
+        for entry in _iter_log(repo):
+            if since is not None and (entry['date'] or '')[:len(since)] < since:
+                # entries are in submission order, the
+                # older ones are before the date too
+                break
+
+            if _match_log_entry(entry, author, since, until, paths):
+                yield entry
+                found += 1
+
+                if found == limit:
+                    break
+
+
 def _add_new_change(
+    repo: 'Repository',
     change_id: str,
     change_info: dict
-) -> None:
-    with open(VESTORY_FILE, 'r') as file_r:
-        vestory_config = json.load(file_r)
+) -> str:
+    change_info_token = integrity.create_token(change_info, repo.key)
+    changed_files = change_info['changed_files'].keys()
 
-    repo_key = get_repo_key()
-    change_info_token = integrity.create_token(change_info, repo_key)
-    vestory_config['changes'][change_id] = change_info_token
+    if repo.file_changes is None:
+        _rebuild_file_index(repo)
 
-    with open(VESTORY_FILE, 'w') as file_w:
-        json.dump(vestory_config, file_w, ensure_ascii=False, indent=4)
+    repo.add_change(change_id, change_info_token, changed_files, change_info)
+    repo.change_cache.set(change_info_token, change_info)
+
+    return change_info_token
 
 
 def join_file_changes(changes: list) -> dict:
     """Merge all changes to a file"""
 
-    joined_changes = {}
-    for change_id, file_info in changes:
-        content = json.loads(b64decode(file_info['content']))
-        for nl, line in content.items():
-            joined_changes[nl] = line
+    from . import pipeline
 
-    return joined_changes
+    repo = _get_repository()
+    return _enumerate_lines(pipeline.replay_lines(repo.objects, changes))
+
+
+def _get_heads(repo: 'Repository') -> Union['HeadCache', None]:
+    if repo.get_setting('head_cache'):
+        return repo.heads
+
+    return None
+
+
+def _build_file_content(repo: 'Repository', filepath: str, delta_chain: list) -> bytes:
+    from . import pipeline
+
+    return pipeline.build_content(repo.objects, filepath, delta_chain, _get_heads(repo))
+
+
+def _write_file_atomic(filepath: str, chunks: Iterable[bytes]) -> None:
+    dirname = os.path.dirname(filepath) or '.'
+    os.makedirs(dirname, exist_ok=True)
+
+    file_mode = None
+    if os.path.isfile(filepath):
+        file_mode = os.stat(filepath).st_mode
+
+    # concurrent joins write their own temporary files
+    with span('write', path=filepath), atomic_write(filepath, 'wb') as file_w:
+        for chunk in chunks:
+            file_w.write(chunk)
+            count('bytes.written', len(chunk))
+
+        if file_mode is not None:
+            os.chmod(file_w.fileno(), file_mode)
+
+
+def _join_file(repo: 'Repository', filepath: str, delta_chain: list) -> bool:
+    last_file_info = delta_chain[-1][1]
+
+    # binary and large files are copied from the
+    # object store in parts, without reading them whole
+    if last_file_info.get('binary') and last_file_info.get('object'):
+        if (path.isfile(filepath)
+                and os.stat(filepath).st_size == last_file_info.get('size')
+                and hashing.hash_file(filepath) == last_file_info.get('hash')):
+            return False
+
+        _write_file_atomic(filepath, repo.objects.iter_chunks(last_file_info['object']))
+        return True
+
+    content = _build_file_content(repo, filepath, delta_chain)
+
+    # files equal to the joined content are not rewritten
+    if path.isfile(filepath) and os.stat(filepath).st_size == len(content):
+        if hashing.hash_file(filepath) == hashing.hash_bytes(content):
+            return False
+
+    _write_file_atomic(filepath, [content])
+    return True
+
+
+def _match_paths(filepath: str, paths: list) -> bool:
+    for path_filter in paths:
+        if not path_filter.startswith('./'):
+            path_filter = os.path.join('./', path_filter)
+
+        path_filter = path_filter.rstrip('/')
+
+        if filepath == path_filter or filepath.startswith(f'{path_filter}/'):
+            return True
+
+    return False
+
+
+def join_files(
+    paths: Union[list, None] = None,
+    jobs: Union[int, None] = None
+) -> Iterator[tuple]:
+    """Restores files with the merge of their changes.
+
+    Files are rebuilt one at a time by a pool of workers,
+    and only files that differ from the joined content are
+    rewritten, through a temporary file and a rename.
+
+    :param paths: Files or directories to restore,
+    defaults to all files with changes.
+    :type paths: Union[list, None], optional
+    :param jobs: Number of workers, defaults to
+    the number of CPUs.
+    :type jobs: Union[int, None], optional
+    :raises InvalidChangeError: If change validation fails.
+    :return: Yields the file path and True if
+    the file was rewritten.
+    :rtype: Iterator[tuple]
+    """
+
+    if not check_repo_exists():
+        raise RepoNotExistsError('Repositório não encontrado')
+
+    with open_repository(exclusive=False) as repo:
+        if repo.file_changes is None:
+            _rebuild_file_index(repo)
+
+        filepaths = list(repo.file_changes.keys())
+
+        if paths:
+            filepaths = [file for file in filepaths if _match_paths(file, paths)]
+
+        # the changes are decoded here, so the
+        # workers only read and write contents
+        delta_chains = [_get_file_delta_chain(repo, file) for file in filepaths]
+        jobs = jobs or os.cpu_count() or 1
+
+        def join_file(filepath: str, delta_chain: list) -> tuple:
+            return (filepath, _join_file(repo, filepath, delta_chain))
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            yield from executor.map(join_file, filepaths, delta_chains)
 
 
 def join_changes() -> dict:
     """Returns the merge of all changes from all files."""
 
-    changes = get_changes()
-    joined_changes = {}
+    with open_repository(exclusive=False) as repo:
+        joined_changes = {}
 
-    for change_token in changes.values():
-        change_info = integrity.decode_without_key(change_token)
-        changed_files = change_info['changed_files']
+        if repo.file_changes is None:
+            _rebuild_file_index(repo)
 
-        for filepath in changed_files.keys():
-            file_changes = get_file_changes(filepath)
-            joined_changes[filepath] = join_file_changes(file_changes)
+        for filepath in repo.file_changes.keys():
+            delta_chain = _get_file_delta_chain(repo, filepath)
+
+            # binary files have no lines to join
+            if delta_chain[-1][1].get('binary'):
+                continue
+
+            joined_changes[filepath] = join_file_changes(delta_chain)
 
     return joined_changes
 
 
 def check_diff(joined_changes: dict, current_change: dict) -> dict:
-    """Returns the difference between two files"""
+    """Returns the difference between two files, by line
+    number. Kept for compatibility; submits store the
+    hunks of `diff_lines` instead."""
 
     diff = {}
 
@@ -422,72 +956,439 @@ def check_diff(joined_changes: dict, current_change: dict) -> dict:
     return diff
 
 
-def submit_change(files: list, comment: str) -> None:
+def _needs_snapshot(repo: 'Repository', delta_chain: list) -> bool:
+    # the first change of a chain is the snapshot,
+    # and its size does not count in the chain size
+    if len(delta_chain) >= repo.get_setting('snapshot_interval'):
+        return True
+
+    chain_size = sum(file_info.get('size', 0) for __, file_info in delta_chain[1:])
+    return chain_size >= repo.get_setting('snapshot_max_chain_size')
+
+
+def submit_change(
+    files: list,
+    comment: str,
+    jobs: Union[int, None] = None
+) -> None:
     """Saves the change to the specified files.
 
     :param files: Files to be submitted.
     :type files: list
+    :param comment: Comment of the change.
+    :type comment: str
+    :param jobs: Number of hashing workers, defaults
+    to the number of CPUs.
+    :type jobs: Union[int, None], optional
     """
 
     if not check_repo_exists():
         raise RepoNotExistsError('Repositório não encontrado')
 
-    author, author_email = get_author_info()
+    with open_repository() as repo:
+        return _submit_change(repo, files, comment, jobs)
+
+
+def _submit_change(
+    repo: 'Repository',
+    files: list,
+    comment: str,
+    jobs: Union[int, None]
+) -> str:
+    from datetime import datetime
+
+    from . import pipeline
+    from .repository import FORMAT_VERSION
+
+    # a new change is never linked to a tampered history,
+    # and after the verification the checkpoint points to
+    # the last change
+    _verify_chain(repo)
+    checkpoint = _get_checkpoint(repo)
+
+    files_changed = set(_check_files_changed(repo, files, jobs))
     change_id = _generate_id()
     changed_files = {}
 
     change_info = {
-        'author': author,
-        'author_email': author_email,
+        'author': repo.author,
+        'author_email': repo.author_email,
         'date': str(datetime.now()),
         'comment': comment,
+        'parent': checkpoint['digest'] if checkpoint else None,
+        'format_version': FORMAT_VERSION,
         'changed_files': dict()
     }
 
-    for filepath in files:
-        if check_file_has_changed(filepath):
-            file_id = _generate_id()
+    # the changes are decoded here, so the workers
+    # only read, diff and store the contents
+    tasks = []
+
+    for filepath in dict.fromkeys(files):
+        if filepath in files_changed:
+            delta_chain = _get_file_delta_chain(repo, filepath)
+            # a delta is never made over a binary or large
+            # file, stored whole instead of as lines
+            use_delta = (bool(delta_chain)
+                         and not delta_chain[-1][1].get('binary')
+                         and not _needs_snapshot(repo, delta_chain))
+            tasks.append((filepath, delta_chain, use_delta))
+
+    heads = _get_heads(repo)
+    options = {
+        'compression': repo.get_setting('delta_compression'),
+        'level': repo.get_setting('delta_compression_level'),
+        'large_file_threshold': repo.get_setting('large_file_threshold')
+    }
 
-            if _is_binary(filepath):
-                with open(filepath, 'rb') as file_r:
-                    file_content = file_r.read()
+    results = pipeline.prepare_files(
+        repo.objects.objects_path,
+        heads.heads_path if heads else None,
+        tasks, options, jobs
+    )
 
-                hash_file = md5(file_content).hexdigest()
-                file_content_b64 = b64encode(file_content)
+    # the results are in the order of the files,
+    # as in a submit of one file at a time
+    for (filepath, __, __), (file_info, file_stat) in zip(tasks, results):
+        changed_files[filepath] = {'file_id': _generate_id(), **file_info}
+        _update_file_hash(repo, filepath, file_info['hash'])
+        repo.index.update(filepath, file_stat, file_info['hash'])
 
-                changed_files[filepath] = {
-                    'file_id': file_id,
-                    'hash': hash_file,
-                    'content': file_content_b64.decode()
-                }
-            else:
-                with open(filepath, 'r') as file_r:
-                    file_content = file_r.readlines()
+    change_info['changed_files'] = changed_files
+    change_token = _add_new_change(repo, change_id, change_info)
+    _set_checkpoint(repo, change_id, change_token, checkpoint['count'] + 1 if checkpoint else 1)
 
-                file_lines = _enumerate_lines(file_content)
-                file_lines_str = json.dumps(file_lines)
-                file_lines_b64 = b64encode(file_lines_str.encode()).decode()
-                hash_file = md5(file_lines_str.encode()).hexdigest()
+    return change_id
 
-                changed_files[filepath] = {
-                    'file_id': file_id,
-                    'hash': hash_file,
-                    'content': file_lines_b64
-                }
 
-                all_changes = get_file_changes(filepath)
+def _set_checkpoint(
+    repo: 'Repository',
+    change_id: str,
+    change_token: str,
+    position: int
+) -> None:
+    # the position is the number of changes up to
+    # the change, so the history is never counted
+    checkpoint = integrity.create_checkpoint(
+        change_id, integrity.link_digest(change_token),
+        position, repo.key
+    )
 
-                if all_changes:
-                    joined_changes = join_file_changes(all_changes)
+    repo.set_checkpoint(checkpoint)
 
-                    difference = check_diff(joined_changes, file_lines)
-                    difference_bytes = json.dumps(difference).encode()
-                    difference_b64 = b64encode(difference_bytes).decode()
-                    changed_files[filepath]['content'] = difference_b64
 
-            _update_file_hash(filepath, hash_file)
-            
-        change_info['changed_files'] = changed_files
-        _add_new_change(change_id, change_info)
+def _get_checkpoint(repo: 'Repository') -> Union[dict, None]:
+    if repo.checkpoint is None:
+        return None
 
-    return change_id
+    checkpoint = integrity.decode_token(repo.checkpoint, repo.key)
+
+    if not checkpoint:
+        raise InvalidChangeError('Invalid checkpoint')
+
+    return checkpoint
+
+
+def _verify_chain(repo: 'Repository') -> int:
+    checkpoint = _get_checkpoint(repo)
+    previous_digest = None
+    start = 0
+
+    # the changes up to the checkpoint were already
+    # verified, only the change of the checkpoint and
+    # the changes after it are read
+    if checkpoint is not None:
+        start = checkpoint['count']
+        changes = repo.get_changes_from(start - 1)
+
+        if (not changes
+                or changes[0][0] != checkpoint['change_id']
+                or integrity.link_digest(changes[0][1]) != checkpoint['digest']):
+            raise InvalidChangeError(
+                f'History truncated or rewritten after change "{checkpoint["change_id"]}"'
+            )
+
+        previous_digest = checkpoint['digest']
+        changes = changes[1:]
+    else:
+        changes = repo.get_changes_from(0)
+
+    for change_id, change_token in changes:
+        change_info, __ = integrity.decode_change(change_token, repo.key, repo.author_email)
+
+        if not change_info:
+            raise InvalidChangeError(f'Change "{change_id}" invalid')
+
+        # changes made before the chain have no parent
+        if 'parent' in change_info and change_info['parent'] != previous_digest:
+            raise InvalidChangeError(f'Change "{change_id}" not linked to the previous change')
+
+        previous_digest = integrity.link_digest(change_token)
+
+    if changes:
+        _set_checkpoint(repo, changes[-1][0], changes[-1][1], start + len(changes))
+
+    return len(changes)
+
+
+def verify_history() -> int:
+    """Verifies the changes made after the
+    "verified up to" checkpoint of the history.
+
+    Each change points to the digest of the previous
+    one, so only the changes after the checkpoint are
+    verified, and a removed or reordered change breaks
+    the chain. The checkpoint is then moved to the
+    last change.
+
+    :raises RepoNotExistsError: non-existent repository
+    :raises InvalidChangeError: If change validation fails.
+    :return: Returns the number of verified changes.
+    :rtype: int
+    """
+
+    if not check_repo_exists():
+        raise RepoNotExistsError('Repositório não encontrado')
+
+    with open_repository() as repo:
+        return _verify_chain(repo)
+
+
+def _migrate_file_hash(repo: 'Repository', filepath: str, old_hash: str) -> str:
+    # files not changed since the last check are
+    # hashed again from the working tree
+    if path.isfile(filepath):
+        legacy_hash = hashing.legacy_hash_file(filepath)
+
+        if old_hash in (legacy_hash.raw_hash, legacy_hash.content_hash):
+            return hashing.hash_file(filepath)
+
+    # changed files keep the hash of their last version
+    delta_chain = _get_file_delta_chain(repo, filepath)
+
+    if delta_chain:
+        return hashing.hash_bytes(_build_file_content(repo, filepath, delta_chain))
+
+    # files changed after "add" keep the old hash,
+    # that never matches, so they are still changed
+    return old_hash
+
+
+def migrate() -> bool:
+    """Upgrades the repository to the current format.
+
+    The hashes of the tracked files are computed again
+    with the hash of the current format and the stat
+    cache is cleared. The changes of the history are not
+    changed: each one is verified with the hash of the
+    format it was made with.
+
+    :raises RepoNotExistsError: non-existent repository
+    :raises InvalidChangeError: If change validation fails.
+    :return: Returns False if the repository is already
+    in the current format.
+    :rtype: bool
+    """
+
+    from .repository import FORMAT_VERSION
+
+    if not check_repo_exists():
+        raise RepoNotExistsError('Repositório não encontrado')
+
+    with open_repository() as repo:
+        if repo.format_version >= FORMAT_VERSION:
+            return False
+
+        # new files are found by the index of file changes
+        if repo.file_changes is None:
+            _rebuild_file_index(repo)
+
+        tracked_files = {}
+
+        with span('migrate'):
+            for filepath, old_hash in repo.tracked_files.items():
+                tracked_files[filepath] = _migrate_file_hash(repo, filepath, old_hash)
+
+        repo.set_tracked_files(tracked_files)
+        repo.index.clear()
+        repo.set_format_version(FORMAT_VERSION)
+
+    return True
+
+
+def convert_storage(backend: str) -> bool:
+    """Converts the repository to another storage.
+
+    The JSON storage keeps everything in `vestory.json`.
+    The SQLite storage keeps tracked files, changes, the
+    changes of each file and the authors in indexed
+    tables of `vestory.db`, so looking up a change, the
+    history of a file or the changes of an author does
+    not read the whole repository.
+
+    :param backend: "json" or "sqlite".
+    :type backend: str
+    :raises RepoNotExistsError: non-existent repository
+    :raises ValueError: If the backend is unknown.
+    :return: Returns False if the repository already
+    uses the storage.
+    :rtype: bool
+    """
+
+    if not check_repo_exists():
+        raise RepoNotExistsError('Repositório não encontrado')
+
+    with open_repository() as repo:
+        return repo.convert_storage(backend)
+
+
+def _gc(repo: 'Repository') -> dict:
+    from base64 import b64decode
+
+    object_ids = set()
+    resigned = 0
+    vestory_size = os.path.getsize(repo.vestory_file)
+    changes = []
+    unverified = set()
+
+    for change_id, token in repo.changes.items():
+        change_info, verified = integrity.decode_change(token, repo.key, repo.author_email)
+
+        if not change_info:
+            raise InvalidChangeError(f'Change "{change_id}" invalid')
+
+        # changes of other authors are kept as is
+        if not verified:
+            unverified.add(change_id)
+
+        changes.append((change_id, token, change_info))
+
+    # the chain is rebuilt only from an intact history
+    problems = integrity.check_chain(changes, _get_checkpoint(repo))
+
+    if problems:
+        change_id, problem = problems[0]
+        raise InvalidChangeError(f'Change "{change_id}": {problem}')
+
+    repo.change_cache.clear()
+    previous_digest = None
+
+    for change_id, token, change_info in changes:
+        if change_id in unverified:
+            object_ids.update(
+                file_info['object'] for file_info in change_info['changed_files'].values()
+                if file_info.get('object')
+            )
+            previous_digest = integrity.link_digest(token)
+            continue
+
+        resign = change_info.get('parent', False) != previous_digest
+
+        # contents stored inside the token (before the
+        # object store) are moved to the pack
+        for file_info in change_info['changed_files'].values():
+            if 'content' in file_info:
+                content = b64decode(file_info.pop('content'))
+                file_info['object'] = repo.objects.put(content)
+                file_info['size'] = len(content)
+                resign = True
+
+            object_ids.add(file_info['object'])
+
+        # changes signed again, or made before the chain,
+        # are linked to the digest of the previous change
+        if resign:
+            change_info['parent'] = previous_digest
+            token = integrity.create_token(change_info, repo.key)
+            repo.set_change_token(change_id, token)
+            resigned += 1
+
+        repo.change_cache.set(token, change_info)
+        previous_digest = integrity.link_digest(token)
+
+    if changes:
+        _set_checkpoint(repo, changes[-1][0], repo.changes[changes[-1][0]], len(changes))
+
+    with span('gc.repack'):
+        pack_stats = repo.objects.repack(object_ids)
+
+    # heads of files no longer tracked
+    repo.heads.prune(repo.tracked_files)
+
+    repo.save()
+
+    return {
+        'changes': len(repo.changes),
+        'resigned': resigned,
+        'objects': pack_stats['packed'],
+        'removed': pack_stats['removed'],
+        'pack_size': pack_stats['pack_size'],
+        'vestory_size': (vestory_size, os.path.getsize(repo.vestory_file)),
+        'vestory_file': path.basename(repo.vestory_file)
+    }
+
+
+def gc() -> dict:
+    """Repacks the history of the repository.
+
+    Every object referenced by a change is written to a
+    single pack file, read by random access, and the
+    unreferenced objects are removed. Contents stored
+    inside old change tokens are moved to the pack, and
+    these changes are signed again with the repository
+    key, so `vestory.json` keeps only metadata. The
+    hash chain of the history is rebuilt, linking the
+    changes made before it.
+
+    :raises RepoNotExistsError: non-existent repository
+    :raises InvalidChangeError: If change validation fails.
+    :return: Returns the number of changes, re-signed
+    changes, packed and removed objects, the pack size and
+    the size of the storage (`vestory.json` or `vestory.db`)
+    before and after.
+    :rtype: dict
+    """
+
+    if not check_repo_exists():
+        raise RepoNotExistsError('Repositório não encontrado')
+
+    with open_repository() as repo:
+        return _gc(repo)
+
+
+def fsck(full: bool = True, jobs: Union[int, None] = None) -> list:
+    """Verifies the integrity of the history.
+
+    Every change token is verified with the repository
+    key, and so are the links of the hash chain. In full
+    mode, the changes of each file are also replayed and
+    every version is compared with the hash stored in its
+    change. The work is spread across a pool of processes.
+
+    :param full: Verify the content of the files, not
+    only the tokens, defaults to True
+    :type full: bool, optional
+    :param jobs: Number of worker processes, defaults
+    to the number of CPUs.
+    :type jobs: Union[int, None], optional
+    :raises RepoNotExistsError: non-existent repository
+    :return: Returns a list of (change ID, problem), in
+    the order of the history.
+    :rtype: list
+    """
+
+    from . import verify
+
+    if not check_repo_exists():
+        raise RepoNotExistsError('Repositório não encontrado')
+
+    with open_repository(exclusive=False) as repo:
+        changes = list(repo.changes.items())
+
+        try:
+            checkpoint = _get_checkpoint(repo)
+        except InvalidChangeError:
+            return [('checkpoint', 'invalid checkpoint')]
+
+        return verify.check(repo.key, repo.author_email, repo.objects.objects_path,
+                            changes, full, jobs, checkpoint)
@@ -1,29 +1,46 @@
 import os
-import json
 
-HOME = os.getenv('HOME')
-CONFIG_FILE = os.path.join(HOME, '.vestoryconfig')
 CONFIG = {'user': {'author': None, 'author_email': None}}
 
 
+def _get_config_file() -> str:
+    # resolved on each call, not on import
+    return os.path.join(os.getenv('HOME'), '.vestoryconfig')
+
+
+def __getattr__(name: str) -> str:
+    if name == 'HOME':
+        return os.getenv('HOME')
+    elif name == 'CONFIG_FILE':
+        return _get_config_file()
+
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
 def create_config() -> None:
-    if not os.path.isfile(CONFIG_FILE):
+    if not os.path.isfile(_get_config_file()):
         _save_config(CONFIG)
 
 
 def _get_config() -> dict:
-    if not os.path.isfile(CONFIG_FILE):
+    config_file = _get_config_file()
+
+    if not os.path.isfile(config_file):
         create_config()
         return CONFIG
 
-    with open(CONFIG_FILE, 'r') as file_r:
+    import json
+
+    with open(config_file, 'r') as file_r:
         config = json.load(file_r)
 
     return config
 
 
 def _save_config(config: dict) -> None:
-    with open(CONFIG_FILE, 'w') as file_w:
+    import json
+
+    with open(_get_config_file(), 'w') as file_w:
         json.dump(config, file_w, indent=2, ensure_ascii=False)
 
 
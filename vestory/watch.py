@@ -0,0 +1,459 @@
+import json
+import os
+from typing import Union
+
+from .repository import Repository
+from .trace import count, span
+
+SOCKET_NAME: str = 'watch.sock'
+
+# flags of <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_DIR_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+             | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+# struct inotify_event: wd, mask, cookie, len and the name
+_EVENT_HEADER_SIZE = 16
+
+_CLIENT_TIMEOUT = 2.0
+
+
+class Inotify(object):
+    """Minimal binding of the Linux inotify API."""
+
+    def __init__(self) -> None:
+        import ctypes
+        import ctypes.util
+
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError('inotify não está disponível neste sistema')
+
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self, dirpath: str, mask: int = _DIR_MASK) -> int:
+        import ctypes
+
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(dirpath), mask)
+
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), dirpath)
+
+        return wd
+
+    def rm_watch(self, wd: int) -> None:
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self) -> list:
+        """Reads the pending events without blocking.
+
+        :return: Returns a list of (wd, mask, name) tuples.
+        :rtype: list
+        """
+
+        import struct
+
+        events = []
+
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+
+            offset = 0
+
+            while offset < len(data):
+                wd, mask, __, name_len = struct.unpack_from('iIII', data, offset)
+                offset += _EVENT_HEADER_SIZE
+                name = data[offset:offset + name_len].rstrip(b'\0')
+                offset += name_len
+                events.append((wd, mask, os.fsdecode(name)))
+
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class Watcher(object):
+    """Dirty set of the tracked files.
+
+    Each directory with tracked files is watched. A file
+    touched by an event is marked as dirty with a new
+    sequence number, and stays dirty until a client checks
+    it and prunes it with the same sequence number, so an
+    event received during the check is not lost.
+
+    Every tracked file starts dirty, so the first check
+    covers the changes made before the watcher started.
+    """
+
+    def __init__(self, repo_path: str, inotify: Inotify) -> None:
+        self.repo_path = repo_path
+        self.inotify = inotify
+
+        # directory -> names of the tracked files
+        self.tracked = {}
+        self.dirty = {}
+        self.seq = 0
+
+        # wd -> directory and directory -> wd
+        self._dirs = {}
+        self._wds = {}
+        # directories that could not be watched,
+        # their files are always dirty
+        self._unwatched = set()
+        # stat of the storage when the tracked files were read
+        self._storage_stat = None
+
+        self._repo_wd = inotify.add_watch(repo_path)
+        self._root_wd = None
+
+        self.load_tracked()
+
+    def _mark_dirty(self, filepath: str) -> None:
+        self.seq += 1
+        self.dirty[filepath] = self.seq
+        count('watch.dirty')
+
+    def _mark_all_dirty(self) -> None:
+        for dirpath, filenames in self.tracked.items():
+            for filename in filenames:
+                self._mark_dirty(os.path.join(dirpath, filename))
+
+    def _watch_dir(self, dirpath: str) -> None:
+        try:
+            wd = self.inotify.add_watch(dirpath)
+        except OSError:
+            self._unwatched.add(dirpath)
+        else:
+            self._unwatched.discard(dirpath)
+            self._dirs[wd] = dirpath
+            self._wds[dirpath] = wd
+
+            if dirpath == '.':
+                self._root_wd = wd
+
+    def _unwatch_dir(self, wd: int) -> None:
+        dirpath = self._dirs.pop(wd, None)
+
+        if dirpath is not None:
+            # a moved directory keeps its watch, the
+            # directory is watched again by its path
+            self.inotify.rm_watch(wd)
+            del self._wds[dirpath]
+            self._unwatched.add(dirpath)
+
+            for filename in self.tracked.get(dirpath, ()):
+                self._mark_dirty(os.path.join(dirpath, filename))
+
+            if wd == self._root_wd:
+                self._root_wd = None
+
+    def load_tracked(self) -> None:
+        """Reads the tracked files of the storage and
+        watches the directories of new tracked files."""
+
+        repo = Repository(self.repo_path)
+        storage_stat = os.stat(repo.vestory_file)
+        storage_stat = (storage_stat.st_ino, storage_stat.st_mtime_ns, storage_stat.st_size)
+
+        # `vestory.db` is also closed after being read, by
+        # this daemon and by commands that do not change it
+        if storage_stat == self._storage_stat:
+            return None
+
+        with span('watch.load'):
+            tracked_files = repo.tracked_files
+            repo.close()
+
+        self._storage_stat = storage_stat
+
+        tracked = {}
+
+        for filepath in tracked_files:
+            dirpath, filename = os.path.split(filepath)
+            tracked.setdefault(dirpath, set()).add(filename)
+
+        # "." is watched to follow `.ignoreme`
+        tracked.setdefault('.', set())
+
+        previous = self.tracked
+        self.tracked = tracked
+
+        for dirpath, filenames in tracked.items():
+            if dirpath not in self._wds:
+                self._watch_dir(dirpath)
+
+            for filename in filenames - previous.get(dirpath, set()):
+                self._mark_dirty(os.path.join(dirpath, filename))
+
+        for dirpath in list(self._wds):
+            if dirpath not in tracked:
+                wd = self._wds.pop(dirpath)
+                del self._dirs[wd]
+                self.inotify.rm_watch(wd)
+
+        self._unwatched.intersection_update(tracked)
+
+        for filepath in list(self.dirty):
+            dirpath, filename = os.path.split(filepath)
+
+            if filename not in tracked.get(dirpath, ()):
+                del self.dirty[filepath]
+
+    def _is_tracked(self, filepath: str) -> bool:
+        dirpath, filename = os.path.split(filepath)
+        return filename in self.tracked.get(dirpath, ())
+
+    def process_events(self) -> None:
+        for wd, mask, name in self.inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                # events were lost
+                self._mark_all_dirty()
+            elif wd == self._repo_wd:
+                if name in ('vestory.json', 'vestory.db') and mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    self.load_tracked()
+            elif mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                self._unwatch_dir(wd)
+            elif wd in self._dirs:
+                filepath = os.path.join(self._dirs[wd], name)
+
+                if wd == self._root_wd and name == '.ignoreme':
+                    # the ignore rules changed, all
+                    # tracked files are checked again
+                    self._mark_all_dirty()
+                elif self._is_tracked(filepath):
+                    self._mark_dirty(filepath)
+
+    def get_candidates(self) -> dict:
+        """Returns the dirty files and their
+        sequence numbers.
+
+        :return: Returns a dict `path -> seq`.
+        :rtype: dict
+        """
+
+        for dirpath in list(self._unwatched):
+            if os.path.isdir(dirpath):
+                self._watch_dir(dirpath)
+
+            # files changed before the watch was added
+            for filename in self.tracked.get(dirpath, ()):
+                self._mark_dirty(os.path.join(dirpath, filename))
+
+        self.process_events()
+        return dict(sorted(self.dirty.items()))
+
+    def prune(self, candidates: dict) -> None:
+        """Removes files checked by a client.
+
+        :param candidates: Checked files and their
+        sequence numbers, as given by `get_candidates`.
+        :type candidates: dict
+        """
+
+        self.process_events()
+
+        for filepath, seq in candidates.items():
+            dirpath = os.path.dirname(filepath)
+
+            if self.dirty.get(filepath) == seq and dirpath not in self._unwatched:
+                del self.dirty[filepath]
+
+    def handle(self, request: dict) -> dict:
+        command = request.get('command')
+
+        if command == 'candidates':
+            return {'candidates': self.get_candidates()}
+        elif command == 'prune':
+            self.prune(request.get('candidates', {}))
+            return {'ok': True}
+        elif command == 'ping':
+            return {'ok': True, 'tracked': sum(map(len, self.tracked.values()))}
+
+        return {'error': f'unknown command "{command}"'}
+
+
+def get_socket_path(repo_path: str) -> str:
+    return os.path.join(repo_path, SOCKET_NAME)
+
+
+def _request(repo_path: str, request: dict) -> Union[dict, None]:
+    socket_path = get_socket_path(repo_path)
+
+    # without the socket, the daemon is not running
+    if not os.path.exists(socket_path):
+        return None
+
+    import socket
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(_CLIENT_TIMEOUT)
+            sock.connect(socket_path)
+            sock.sendall(json.dumps(request).encode() + b'\n')
+
+            with sock.makefile('rb') as sock_file:
+                response = sock_file.readline()
+    except OSError:
+        return None
+
+    try:
+        return json.loads(response)
+    except json.JSONDecodeError:
+        return None
+
+
+def get_candidates(repo_path: str) -> Union[dict, None]:
+    """Gets the files that may have changed from
+    the watch daemon.
+
+    :param repo_path: Path of `.vestory`.
+    :type repo_path: str
+    :return: Returns a dict `path -> seq`, or None if
+    the daemon is not running.
+    :rtype: Union[dict, None]
+    """
+
+    with span('watch.query'):
+        response = _request(repo_path, {'command': 'candidates'})
+
+    if response is None:
+        return None
+
+    return response.get('candidates')
+
+
+def prune(repo_path: str, candidates: dict) -> None:
+    """Tells the watch daemon which candidates
+    were checked and did not change.
+
+    :param repo_path: Path of `.vestory`.
+    :type repo_path: str
+    :param candidates: Unchanged files and their
+    sequence numbers.
+    :type candidates: dict
+    """
+
+    if candidates:
+        _request(repo_path, {'command': 'prune', 'candidates': candidates})
+
+
+def stop(repo_path: str) -> bool:
+    """Stops the watch daemon.
+
+    :param repo_path: Path of `.vestory`.
+    :type repo_path: str
+    :return: Returns True if the daemon was running.
+    :rtype: bool
+    """
+
+    return _request(repo_path, {'command': 'stop'}) is not None
+
+
+def is_running(repo_path: str) -> bool:
+    return _request(repo_path, {'command': 'ping'}) is not None
+
+
+def serve(repo_path: str, ready=None) -> None:
+    """Runs the watch daemon until a "stop"
+    request or a signal is received.
+
+    :param repo_path: Path of `.vestory`.
+    :type repo_path: str
+    :param ready: Function called with the number of
+    tracked files when the daemon is ready, defaults to None
+    :type ready: callable, optional
+    :raises OSError: If the daemon is already running or
+    inotify is not available.
+    """
+
+    import selectors
+    import signal
+    import socket
+
+    socket_path = get_socket_path(repo_path)
+
+    if is_running(repo_path):
+        raise OSError(f'o daemon já está em execução em "{socket_path}"')
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    inotify = Inotify()
+    watcher = Watcher(repo_path, inotify)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen()
+
+    selector = selectors.DefaultSelector()
+    selector.register(inotify.fd, selectors.EVENT_READ)
+    selector.register(server, selectors.EVENT_READ)
+
+    def handle_signal(signum, frame):
+        raise SystemExit(0)
+
+    previous_handler = signal.signal(signal.SIGTERM, handle_signal)
+
+    if ready is not None:
+        ready(sum(map(len, watcher.tracked.values())))
+
+    try:
+        running = True
+
+        while running:
+            for key, __ in selector.select():
+                if key.fileobj == inotify.fd:
+                    watcher.process_events()
+                    continue
+
+                conn, __ = server.accept()
+
+                with conn:
+                    conn.settimeout(_CLIENT_TIMEOUT)
+
+                    try:
+                        with conn.makefile('rb') as conn_file:
+                            request = json.loads(conn_file.readline())
+
+                        if request.get('command') == 'stop':
+                            response = {'ok': True}
+                            running = False
+                        else:
+                            response = watcher.handle(request)
+
+                        conn.sendall(json.dumps(response).encode() + b'\n')
+                    except (OSError, ValueError, AttributeError):
+                        continue
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+        selector.close()
+        server.close()
+        inotify.close()
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
@@ -0,0 +1,20 @@
+# work is sent to the worker processes in chunks,
+# so each process receives a few large tasks
+CHUNKS_PER_WORKER = 4
+
+
+def split_tasks(tasks: list, jobs: int) -> list:
+    """Splits a list of tasks in chunks for a pool
+    of worker processes, keeping their order.
+
+    :param tasks: List of tasks.
+    :type tasks: list
+    :param jobs: Number of worker processes.
+    :type jobs: int
+    :return: Returns a list of chunks, about
+    `CHUNKS_PER_WORKER` for each process.
+    :rtype: list
+    """
+
+    size = max(1, -(-len(tasks) // (jobs * CHUNKS_PER_WORKER)))
+    return [tasks[i:i + size] for i in range(0, len(tasks), size)]